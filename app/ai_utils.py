@@ -4,6 +4,7 @@ import os
 
 import requests
 
+from app.arabic_text import clean_line
 from app.config import ROUTER_SYSTEM_PROMPT
 from app.storage import SETTINGS
 
@@ -54,7 +55,9 @@ def classify_intent(user_text: str, lang: str = "ar-SA"):
     if not api_key:
         return {"intent": "unknown", "need_rag": False, "assistant_reply": "Missing OpenAI API key."}
 
-    msg = f"LANG={lang}\nTEXT={user_text}"
+    # same cleaning as the book text (tatweel, spaces, "اال"): speech-to-text
+    # noise does not change the routing
+    msg = f"LANG={lang}\nTEXT={clean_line(user_text or '')}"
 
     payload = {
         "model": "gpt-4.1-mini",
@@ -0,0 +1,93 @@
+# arabic_text.py
+"""
+Arabic text normalization and sentence segmentation, shared by book
+ingestion (rag_utils), the keyword index (lexical_index), quiz answer
+grading (storage.normalize_ans) and the intent router (ai_utils).
+
+Patterns and tables are built once here. A book is cleaned one Word
+paragraph at a time with C-level str operations only (split, join,
+replace): once spaces are collapsed, punctuation spacing and sentence ends
+are fixed strings, so the six re.sub passes over the whole book and the
+look-behind split are not needed.
+"""
+import re
+
+# ------------------ CHARACTER TABLES ------------------
+ARABIC_DIGITS = str.maketrans("٠١٢٣٤٥٦٧٨٩", "0123456789")
+# search folding: hamza/alef variants, alef maqsura, taa marbuta
+_LETTER_FOLD = str.maketrans({
+    "أ": "ا", "إ": "ا", "آ": "ا", "ٱ": "ا",
+    "ى": "ي", "ة": "ه", "ؤ": "و", "ئ": "ي",
+})
+# tashkeel, superscript alef and tatweel
+_MARKS = re.compile(r"[\u064B-\u0652\u0670\u0640]+")
+
+# ------------------ PATTERNS ------------------
+# one space after these and none before
+_SPACED_PUNCT = "،؛:.؟"
+_SENTENCE_ENDS = ".؟!"
+# quiz answers keep letters/digits, spaces, math signs and Arabic marks
+_ANSWER_DROP = re.compile(r"[^\w\s\-\+\=x/آأإءؤئًٌٍَُِّٰٔٱٔ]")
+WORD = re.compile(r"\w+")
+
+
+def clean_line(text):
+    """Book cleaning rules for one line: no tatweel, single spaces, "اال" -> "ال"."""
+    return " ".join(text.replace("ـ", "").split()).replace("اال", "ال")
+
+
+def _space_punctuation(text):
+    """Single-spaced text -> no space before ، ؛ : . ؟ and exactly one after (trimmed)."""
+    for p in _SPACED_PUNCT:
+        text = text.replace(" " + p, p)
+    for p in _SPACED_PUNCT:
+        text = text.replace(p, p + " ")
+    return " ".join(text.split())
+
+
+def _split_sentences(text):
+    for p in _SENTENCE_ENDS:
+        text = text.replace(p + " ", p + "\n")
+    return text.split("\n")
+
+
+def feed_sentences(pending, raw):
+    """
+    One more raw paragraph read after `pending` (the unfinished sentence so
+    far, "" at the start) -> (finished sentences, new pending).
+    """
+    text = pending + " " + clean_line(raw) if pending else clean_line(raw)
+    # the last piece stays pending even after a sentence end: punctuation
+    # opening the next paragraph may still pull the space in
+    sentences = _split_sentences(_space_punctuation(text))
+    pending = sentences.pop()
+    return [s for s in sentences if s], pending
+
+
+def iter_sentences(raw_paragraphs):
+    """
+    Sentences of a stream of raw paragraphs (Word paragraphs, lines), with
+    the same result as cleaning and splitting the whole text at once: only
+    the unfinished sentence at the end of the text read so far is carried
+    over to the next paragraph.
+    """
+    pending = ""
+    for raw in raw_paragraphs:
+        sentences, pending = feed_sentences(pending, raw)
+        yield from sentences
+    if pending:
+        yield pending
+
+
+def fold_arabic(text):
+    """Search form: no diacritics/tatweel, one letter per hamza/alef variant, lower case."""
+    text = _MARKS.sub("", text).replace("اال", "ال")
+    return text.translate(_LETTER_FOLD).lower()
+
+
+def normalize_answer(s):
+    """Comparable form of a quiz answer (digits, case, punctuation, spaces)."""
+    if s is None:
+        return ""
+    t = str(s).lower().translate(ARABIC_DIGITS)
+    return " ".join(_ANSWER_DROP.sub("", t).split())
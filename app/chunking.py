@@ -0,0 +1,193 @@
+# chunking.py
+"""
+How a subject book is cut into retrieval chunks.
+
+A book arrives as (heading level, text) blocks, one per Word paragraph
+(level 0 = body text). Strategies (RAG_CHUNKING, or chosen per subject on
+the book page):
+    sentences  3 sentences per chunk, headings are plain text (original)
+    tokens     as many sentences as fit in RAG_CHUNK_TOKENS, headings are plain text
+    headings   like tokens, but a chunk never crosses a Word heading and
+               starts with its section heading
+    window     like headings, each chunk repeating the last
+               RAG_CHUNK_OVERLAP sentences of the previous one
+
+Every chunk gets metadata:
+    {"headings": [heading path], "position": chunk number,
+     "sentences": [first, end) sentence numbers in the book}
+Sentence numbers mean the same for every strategy: positions in the book's
+sentence stream with headings read as plain text (what "sentences" cuts).
+
+Chunking streams: blocks are read once, in order, and a chunk is emitted as
+soon as it is cut. Only the unfinished sentence, the sentences of the chunk
+being filled and a running sentence number are kept, never the whole book.
+"""
+import bisect
+import itertools
+
+from app.arabic_text import clean_line, feed_sentences, iter_sentences
+from app.config import RAG_CHUNKING, RAG_CHUNK_TOKENS, RAG_CHUNK_OVERLAP
+
+CHUNKING_STRATEGIES = ("sentences", "tokens", "headings", "window")
+SENTENCES_PER_CHUNK = 3
+
+
+def chunking_strategy(name=None):
+    name = (name or RAG_CHUNKING or "sentences").strip().lower()
+    return name if name in CHUNKING_STRATEGIES else "sentences"
+
+
+def estimate_tokens(text):
+    """
+    LLM token estimate without a tokenizer: about 4 characters per token for
+    Latin text and 2.5 for Arabic (BPE vocabularies split Arabic words more).
+    """
+    ascii_chars = len(text.encode("ascii", "ignore"))
+    return int(ascii_chars / 4 + (len(text) - ascii_chars) / 2.5) + 1
+
+
+def _pack(items, max_tokens, overlap=0):
+    """
+    Groups of consecutive items whose costs fit max_tokens (an oversized item
+    is alone), read lazily from (cost, item) pairs: a group is yielded once
+    the next item does not fit, the next group starts `overlap` items back.
+    """
+    buf = []
+    for entry in itertools.chain(items, [None]):
+        if entry is not None:
+            buf.append(entry)
+        while buf:
+            end, total = 0, 0
+            while end < len(buf) and (end == 0 or total + buf[end][0] <= max_tokens):
+                total += buf[end][0]
+                end += 1
+            if end == len(buf) and entry is not None:
+                # everything read so far fits: the group may still grow
+                break
+            yield [item for _, item in buf[:end]]
+            if end == len(buf):
+                buf = []
+            else:
+                buf = buf[max(end - overlap, 1):]
+
+
+def _stream(blocks):
+    """
+    (level, text, sentences finished by the block, unfinished sentence) per
+    block of the book's sentence stream (headings as plain text), then a last
+    (0, None, [final sentence], "").
+    """
+    pending = ""
+    for level, text in blocks:
+        finished, pending = feed_sentences(pending, text)
+        yield level, text, finished, pending
+    yield 0, None, [pending] if pending else [], ""
+
+
+def _locate(book, sentence):
+    """
+    Number of the stream sentence a section's body sentence starts in.
+    book["buf"] holds the stream sentences from the one the previous search
+    ended in (numbered from book["first"]), book["pending"] the unfinished one.
+    """
+    sentences = book["buf"] + ([book["pending"]] if book["pending"] else [])
+    text = " ".join(sentences)
+    starts, at = [], 0
+    for s in sentences:
+        starts.append(at)
+        at += len(s) + 1
+    found = text.find(sentence, book["pos"])
+    if found < 0:
+        # cleaning differed at a heading join: stay where we are
+        found = book["pos"]
+    else:
+        book["pos"] = found + len(sentence)
+    number = book["first"] + max(bisect.bisect_right(starts, found) - 1, 0)
+    # forget the sentences before the one the next search starts in
+    drop = min(max(bisect.bisect_right(starts, book["pos"]) - 1, 0), len(book["buf"]))
+    if drop:
+        book["pos"] -= starts[drop]
+        book["first"] += drop
+        del book["buf"][:drop]
+    return number
+
+
+def _flowing(blocks, strategy, max_tokens):
+    """Chunks over the whole sentence stream (headings are ordinary text)."""
+    def sentences():
+        path, number = [], 0
+        for level, text, finished, _ in _stream(blocks):
+            for s in finished:
+                yield s, path, number
+                number += 1
+            # the path moves to a heading once its text was read
+            heading = clean_line(text) if level else ""
+            if heading:
+                path = path[:level - 1] + [heading]
+
+    if strategy == "sentences":
+        groups = _pack(((1, s) for s in sentences()), SENTENCES_PER_CHUNK)
+    else:
+        groups = _pack(((estimate_tokens(s[0]), s) for s in sentences()), max_tokens)
+    for group in groups:
+        yield " ".join(s for s, _, _ in group), group[0][1], group[0][2], group[-1][2] + 1
+
+
+def _by_section(blocks, max_tokens, overlap):
+    """Chunks per Word heading section, each starting with its heading."""
+    book = {"buf": [], "pending": "", "first": 0, "pos": 0}
+    sections = {"n": 0}
+
+    def read():
+        # the stream runs ahead of the section bodies, so body sentences
+        # can be numbered by their place in it
+        for level, text, finished, pending in _stream(blocks):
+            book["buf"] += finished
+            book["pending"] = pending
+            yield level, text
+
+    def section_of(block):
+        level, text = block
+        if level and clean_line(text):
+            sections["n"] += 1
+        return sections["n"]
+
+    path = []
+    for _, section in itertools.groupby(read(), section_of):
+        first = next(section)
+        level, text = first
+        heading = clean_line(text) if level else ""
+        if heading:
+            path = path[:level - 1] + [heading]
+        else:
+            section = itertools.chain([first], section)
+        prefix = f"{path[-1]}: " if path else ""
+        budget = max_tokens - (estimate_tokens(prefix) if prefix else 0)
+        body = iter_sentences(t for _, t in section if t is not None)
+        numbered = ((s, _locate(book, s)) for s in body)
+        for group in _pack(((estimate_tokens(s), (s, n)) for s, n in numbered), budget, overlap):
+            yield prefix + " ".join(s for s, _ in group), path, group[0][1], group[-1][1] + 1
+
+
+def iter_chunks(blocks, strategy=None, max_tokens=RAG_CHUNK_TOKENS, overlap=RAG_CHUNK_OVERLAP):
+    """(chunk text, chunk metadata) of a book given as (heading level, text) blocks, as they are cut."""
+    strategy = chunking_strategy(strategy)
+    if strategy in ("headings", "window"):
+        chunks = _by_section(blocks, max_tokens, overlap if strategy == "window" else 0)
+    else:
+        chunks = _flowing(blocks, strategy, max_tokens)
+    position = 0
+    for text, path, start, end in chunks:
+        if not text:
+            continue
+        yield text, {"headings": path, "position": position, "sentences": [start, end]}
+        position += 1
+
+
+def chunk_blocks(blocks, strategy=None, max_tokens=RAG_CHUNK_TOKENS, overlap=RAG_CHUNK_OVERLAP):
+    """(chunk texts, chunk metadata) lists, see iter_chunks."""
+    texts, meta = [], []
+    for text, m in iter_chunks(blocks, strategy, max_tokens, overlap):
+        texts.append(text)
+        meta.append(m)
+    return texts, meta
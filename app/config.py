@@ -1,10 +1,17 @@
 # config.py
 import os
 import json
+import hashlib
 import datetime
 import random
 import string
 import threading
+import atexit
+import contextlib
+import shutil
+import signal
+import sys
+import time
 import re
 
 # ------------------ CONFIG & STORAGE PATHS ------------------
@@ -26,10 +33,70 @@ QUIZ_STATS_PATH = os.path.join(DATA_DIR, "quiz_stats.json")
 ATTENDANCE_PATH = os.path.join(DATA_DIR, "attendance.json")
 PROGRESS_PATH   = os.path.join(DATA_DIR, "progress.json")
 
+# attendance is partitioned per month: attendance/2025-09.json, ...
+# (ATTENDANCE_PATH is the legacy single file, split on first start)
+ATTENDANCE_DIR = os.path.join(DATA_DIR, "attendance")
+os.makedirs(ATTENDANCE_DIR, exist_ok=True)
+ATTENDANCE_PAGE_SIZE = int(os.environ.get("ATTENDANCE_PAGE_SIZE", "31"))
+
+# collection name -> JSON file (also used by the SQLite migrator)
+COLLECTION_PATHS = {
+    "settings":   SETTINGS_PATH,
+    "robots":     ROBOTS_PATH,
+    "stages":     STAGES_PATH,
+    "quizzes":    QUIZ_PATH,
+    "quiz_stats": QUIZ_STATS_PATH,
+    "attendance": ATTENDANCE_PATH,
+    "progress":   PROGRESS_PATH,
+}
+
+# "json" (files + journal) or "sqlite" (single WAL database)
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "json").strip().lower()
+SQLITE_PATH     = os.environ.get("SQLITE_PATH", os.path.join(DATA_DIR, "kebbi.db"))
+
+# several gunicorn workers: every worker keeps its in-memory cache but writes
+# go through one SQLite transaction and stale caches are reloaded per request
+# (the JSON journal is single-process only, so shared mode implies sqlite)
+SHARED_STATE = os.environ.get("SHARED_STATE", "0").strip() == "1"
+if SHARED_STATE:
+    STORAGE_BACKEND = "sqlite"
+
+# quiz sessions (/quizzes/api/start -> next -> answer -> finish)
+SESSION_TTL_SECONDS = int(os.environ.get("SESSION_TTL_SECONDS", str(3 * 60 * 60)))
+SESSION_MAX         = int(os.environ.get("SESSION_MAX", "5000"))
+# persist sessions in SQLITE_PATH (survive restarts, shared by all workers)
+SESSIONS_PERSIST    = os.environ.get("SESSIONS_PERSIST", "1" if SHARED_STATE else "0").strip() == "1"
+
 SUBJECT_RAG_DIR = os.path.join(PROJECT_DIR, "subject_rag_books")
 os.makedirs(SUBJECT_RAG_DIR, exist_ok=True)
 
-FILE_LOCK = threading.Lock()
+# per-file locks instead of one global lock: writing attendance.json never
+# waits for quiz_stats.json
+_REGISTRY_LOCK = threading.Lock()
+_PATH_LOCKS = {}        # path -> lock held while a snapshot is written
+_JOURNAL_LOCKS = {}     # path -> lock held while appending / sealing the journal
+_SNAPSHOT_LOCKS = {}    # path -> collection lock held while serializing
+
+# append-only journal: every mutation appends one record to "<file>.journal",
+# the compactor folds it back into the JSON snapshot
+JOURNAL_COMPACT_RECORDS = int(os.environ.get("JOURNAL_COMPACT_RECORDS", "1000"))
+JOURNAL_COMPACT_SECONDS = float(os.environ.get("JOURNAL_COMPACT_SECONDS", "60"))
+# a record is in the OS page cache once appended: it survives the process
+# crashing, but a power loss / kernel crash can drop the last seconds of
+# records (up to the kernel's writeback delay). JOURNAL_FSYNC=1 fsyncs every
+# append instead: nothing acknowledged is lost, each write pays a disk flush
+JOURNAL_FSYNC = os.environ.get("JOURNAL_FSYNC", "0") == "1"
+
+# save_json only marks a file dirty; a flusher thread writes it after this
+# window, so a burst of saves on the same file costs one write (0 = write
+# inline). Journal compactions go through it too, and coalesce with a full
+# rewrite of the same file that is already waiting
+SAVE_DEBOUNCE_MS = int(os.environ.get("SAVE_DEBOUNCE_MS", "200"))
+
+# every snapshot starts with a sha256 header line; the previous
+# SNAPSHOT_GENERATIONS snapshots are kept as "<file>.1" .. "<file>.N"
+SNAPSHOT_GENERATIONS = int(os.environ.get("SNAPSHOT_GENERATIONS", "3"))
+SNAPSHOT_HEADER = "#kebbi-snapshot sha256="
 
 # ------------------ DEFAULTS ------------------
 DEFAULT_SETTINGS = {
@@ -130,25 +197,439 @@ SUBJECT_RAG_DIR = "subject_rag_books"
 os.makedirs(SUBJECT_RAG_DIR, exist_ok=True)
 
 RAG_MODEL_NAME = "intfloat/multilingual-e5-base"
-RAG_TOP_K = 8
+RAG_TOP_K = int(os.environ.get("RAG_TOP_K", "8"))
+# the embedding model loads on first RAG use; RAG_WARMUP=1 starts loading it
+# in a background thread at startup so the first question doesn't wait
+RAG_WARMUP = os.environ.get("RAG_WARMUP", "1") == "1"
+
+# vector search: exact below RAG_ANN_MIN_PARAGRAPHS, IVF (k-means lists) above.
+# NLIST=0 -> sqrt(paragraphs); more NPROBE = better recall, slower queries
+RAG_ANN_MIN_PARAGRAPHS = int(os.environ.get("RAG_ANN_MIN_PARAGRAPHS", "4000"))
+RAG_IVF_NLIST = int(os.environ.get("RAG_IVF_NLIST", "0"))
+RAG_IVF_NPROBE = int(os.environ.get("RAG_IVF_NPROBE", "8"))
+RAG_IVF_TRAIN_ITERS = int(os.environ.get("RAG_IVF_TRAIN_ITERS", "10"))
+
+# default book chunking (each subject can pick its own on the book page):
+# sentences (3 per chunk) | tokens | headings | window, see app/chunking.py.
+# token-budgeted strategies hold up to RAG_CHUNK_TOKENS (estimated LLM
+# tokens) per chunk; window repeats RAG_CHUNK_OVERLAP sentences
+RAG_CHUNKING = os.environ.get("RAG_CHUNKING", "sentences").strip().lower()
+RAG_CHUNK_TOKENS = int(os.environ.get("RAG_CHUNK_TOKENS", "160"))
+RAG_CHUNK_OVERLAP = int(os.environ.get("RAG_CHUNK_OVERLAP", "1"))
+
+# prompt context: retrieved chunks are packed in MMR order (RAG_MMR_LAMBDA:
+# 1 = relevance only, lower = more diverse) up to RAG_CONTEXT_TOKENS
+# estimated tokens (0 = no limit); chunks at least RAG_CONTEXT_DEDUP-similar
+# to one already packed are dropped
+RAG_CONTEXT_TOKENS = int(os.environ.get("RAG_CONTEXT_TOKENS", "1000"))
+RAG_MMR_LAMBDA = float(os.environ.get("RAG_MMR_LAMBDA", "0.7"))
+RAG_CONTEXT_DEDUP = float(os.environ.get("RAG_CONTEXT_DEDUP", "0.95"))
+
+# optional re-ranking of book hits (app/reranker.py): off | lexical |
+# cross-encoder. When on, RAG_RERANK_CANDIDATES hits are retrieved and the
+# best RAG_RERANK_KEEP (after re-scoring) reach the LLM
+RAG_RERANKER = os.environ.get("RAG_RERANKER", "off").strip().lower()
+RAG_RERANK_CANDIDATES = int(os.environ.get("RAG_RERANK_CANDIDATES", "24"))
+RAG_RERANK_KEEP = int(os.environ.get("RAG_RERANK_KEEP", "3"))
+RAG_CROSS_ENCODER_MODEL = os.environ.get(
+    "RAG_CROSS_ENCODER_MODEL", "cross-encoder/mmarco-mMiniLMv2-L12-H384-v1"
+)
+
+# ingestion encodes RAG_EMBED_WINDOW paragraphs at a time (sorted by length,
+# RAG_EMBED_BATCH per model batch) straight into the book store on disk, so
+# peak memory is one window whatever the size of the book
+RAG_EMBED_BATCH = int(os.environ.get("RAG_EMBED_BATCH", "32"))
+RAG_EMBED_WINDOW = int(os.environ.get("RAG_EMBED_WINDOW", "512"))
+
+# retrieval: "hybrid" (dense + BM25 keyword scores), "dense" or "lexical"
+# (BM25 only, never touches the embedding model). Hybrid answers from BM25
+# alone while the model is still loading or failed to load.
+# fused score = cosine + RAG_BM25_WEIGHT * bm25 / best bm25 of the question
+RAG_RETRIEVAL = os.environ.get("RAG_RETRIEVAL", "hybrid").strip().lower()
+RAG_BM25_WEIGHT = float(os.environ.get("RAG_BM25_WEIGHT", "0.1"))
+RAG_BM25_K1 = float(os.environ.get("RAG_BM25_K1", "1.2"))
+RAG_BM25_B = float(os.environ.get("RAG_BM25_B", "0.75"))
+
+# resident embedding precision: float32 | float16 | int8 (per-row scale).
+# Quantized scores pick RAG_RERANK_FACTOR * k candidates, which are re-ranked
+# with the float32 rows read from the memory-mapped book store
+RAG_EMB_DTYPE = os.environ.get("RAG_EMB_DTYPE", "float32").strip().lower()
+RAG_RERANK_FACTOR = int(os.environ.get("RAG_RERANK_FACTOR", "4"))
+
+# repeated student questions reuse their query embedding (0 = no cache)
+RAG_QUERY_CACHE_SIZE = int(os.environ.get("RAG_QUERY_CACHE_SIZE", "2048"))
+RAG_QUERY_CACHE_TTL = int(os.environ.get("RAG_QUERY_CACHE_TTL", str(24 * 3600)))
+
+# memory budget for loaded books (paragraphs + embeddings + index); least
+# recently used books are dropped and reloaded from the book store on demand
+RAG_CACHE_MAX_MB = int(os.environ.get("RAG_CACHE_MAX_MB", "192"))
+
+# /api/book/query answer cache: a question whose embedding is at least
+# THRESHOLD-similar to an answered one (same book version) reuses the answer
+RAG_ANSWER_CACHE_SIZE = int(os.environ.get("RAG_ANSWER_CACHE_SIZE", "256"))  # per book, 0 = off
+RAG_ANSWER_CACHE_TTL = int(os.environ.get("RAG_ANSWER_CACHE_TTL", str(7 * 24 * 3600)))
+RAG_ANSWER_CACHE_THRESHOLD = float(os.environ.get("RAG_ANSWER_CACHE_THRESHOLD", "0.95"))
 
 # ------------------ GENERIC HELPERS ------------------
 
 
+def journal_path(path):
+    return path + ".journal"
+
+
+def sealed_journal_path(path):
+    # journal segment already folded into a snapshot that is being written
+    return path + ".journal.sealed"
+
+
+def _lock_for(registry, path):
+    with _REGISTRY_LOCK:
+        lock = registry.get(path)
+        if lock is None:
+            lock = registry[path] = threading.Lock()
+        return lock
+
+
+def _apply_journal_record(obj, rec):
+    keys = rec.get("k") or []
+    if not keys:
+        return
+    node = obj
+    for k in keys[:-1]:
+        node = node.setdefault(k, {})
+    if rec.get("op") == "del":
+        node.pop(keys[-1], None)
+    else:
+        node[keys[-1]] = rec.get("v")
+
+
+def _replay_journal(path, obj):
+    for jpath in (sealed_journal_path(path), journal_path(path)):
+        if not os.path.exists(jpath):
+            continue
+        with open(jpath, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    rec = json.loads(line)
+                except Exception:
+                    # record torn by a crash mid-append
+                    continue
+                _apply_journal_record(obj, rec)
+    return obj
+
+
+def snapshot_generations(path):
+    return [path] + [f"{path}.{i}" for i in range(1, SNAPSHOT_GENERATIONS + 1)]
+
+
+def _read_snapshot(path):
+    with open(path, "rb") as f:
+        raw = f.read()
+    header = SNAPSHOT_HEADER.encode("utf-8")
+    if raw.startswith(header):
+        first, _, body = raw.partition(b"\n")
+        digest = first[len(header):].decode("ascii").strip()
+        if hashlib.sha256(body).hexdigest() != digest:
+            raise ValueError("checksum mismatch")
+        return json.loads(body.decode("utf-8"))
+    # legacy plain JSON file (before checksummed snapshots)
+    return json.loads(raw.decode("utf-8"))
+
+
 def load_json(path, default):
-    if os.path.exists(path):
+    """
+    Newest snapshot generation whose checksum verifies, plus the journal.
+    """
+    obj = default
+    for i, candidate in enumerate(snapshot_generations(path)):
+        if not os.path.exists(candidate):
+            continue
         try:
-            with open(path, "r", encoding="utf-8") as f:
-                return json.load(f)
-        except Exception:
-            pass
-    return default
+            obj = _read_snapshot(candidate)
+        except Exception as e:
+            print(f"⚠️ corrupt snapshot {candidate}: {e}")
+            continue
+        if i:
+            print(f"⚠️ {path} restored from older snapshot {candidate}")
+        break
+    return _replay_journal(path, obj)
+
+
+def _fsync_dir(dirname):
+    try:
+        fd = os.open(dirname or ".", os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _rotate_generations(path):
+    gens = snapshot_generations(path)
+    for i in range(len(gens) - 1, 0, -1):
+        if os.path.exists(gens[i - 1]):
+            os.replace(gens[i - 1], gens[i])
+
+
+def _write_json(path, body):
+    # temp file + fsync + os.replace: a crash leaves either the old or the new
+    # snapshot on disk, never a truncated one
+    header = (SNAPSHOT_HEADER + hashlib.sha256(body).hexdigest() + "\n").encode("utf-8")
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(header)
+        f.write(body)
+        f.flush()
+        os.fsync(f.fileno())
+    _rotate_generations(path)
+    os.replace(tmp_path, path)
+    _fsync_dir(os.path.dirname(path))
+
+
+def _seal_journal(path):
+    jpath = journal_path(path)
+    sealed = sealed_journal_path(path)
+    with _lock_for(_JOURNAL_LOCKS, path):
+        if os.path.exists(jpath):
+            if os.path.exists(sealed):
+                # previous snapshot never landed: keep both segments
+                with open(sealed, "ab") as dst, open(jpath, "rb") as src:
+                    dst.write(b"\n")
+                    shutil.copyfileobj(src, dst)
+                os.remove(jpath)
+            else:
+                os.replace(jpath, sealed)
+        _JOURNAL_COUNTS[path] = 0
+
+
+def _write_snapshot(path, obj):
+    """
+    Serialize `obj` under its collection lock (consistent copy, writers wait
+    only for the dump), then write it to disk holding just this file's lock.
+    """
+    with _lock_for(_PATH_LOCKS, path):
+        with _SNAPSHOT_LOCKS.get(path) or contextlib.nullcontext():
+            body = json.dumps(obj, ensure_ascii=False, indent=2).encode("utf-8")
+            # records appended from here on go to a fresh journal
+            _seal_journal(path)
+        _write_json(path, body)
+        sealed = sealed_journal_path(path)
+        if os.path.exists(sealed):
+            os.remove(sealed)
 
 
 def save_json(path, obj):
-    with FILE_LOCK:
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump(obj, f, ensure_ascii=False, indent=2)
+    if SAVE_DEBOUNCE_MS <= 0:
+        _write_snapshot(path, obj)
+        return
+    with _DIRTY_LOCK:
+        _DIRTY[path] = obj
+    _start_flusher()
+    _FLUSH_WAKE.set()
+
+
+# ------------------ DEBOUNCED FLUSHER ------------------
+
+_DIRTY = {}             # path -> object waiting to be written
+_DIRTY_LOCK = threading.Lock()
+_FLUSH_WAKE = threading.Event()
+_FLUSH_THREAD = None
+
+
+def flush_json():
+    """Write every pending save_json now (flusher thread, shutdown, tests)."""
+    global _DIRTY
+    with _DIRTY_LOCK:
+        pending, _DIRTY = _DIRTY, {}
+    for path, obj in pending.items():
+        try:
+            _write_snapshot(path, obj)
+        except Exception as e:
+            print(f"⚠️ save failed for {path}, retrying:", e)
+            with _DIRTY_LOCK:
+                _DIRTY.setdefault(path, obj)
+            _FLUSH_WAKE.set()
+
+
+def _flusher_loop():
+    while True:
+        _FLUSH_WAKE.wait()
+        # coalesce everything that arrives within the window into one write
+        time.sleep(SAVE_DEBOUNCE_MS / 1000.0)
+        _FLUSH_WAKE.clear()
+        flush_json()
+
+
+def _flush_on_sigterm(signum, frame):
+    # Render stops the service with SIGTERM; exit normally so atexit flushes
+    sys.exit(0)
+
+
+def _start_flusher():
+    global _FLUSH_THREAD
+    if _FLUSH_THREAD is not None:
+        return
+    with _DIRTY_LOCK:
+        if _FLUSH_THREAD is not None:
+            return
+        _FLUSH_THREAD = threading.Thread(
+            target=_flusher_loop, name="json-flusher", daemon=True
+        )
+        _FLUSH_THREAD.start()
+    atexit.register(flush_json)
+    try:
+        # leave gunicorn's own handlers alone
+        if signal.getsignal(signal.SIGTERM) is signal.SIG_DFL:
+            signal.signal(signal.SIGTERM, _flush_on_sigterm)
+    except ValueError:
+        # not in the main thread
+        pass
+
+
+# ------------------ JOURNAL ------------------
+
+_JOURNAL_TARGETS = {}   # path -> live object folded into the snapshot
+_JOURNAL_COUNTS = {}    # path -> records appended since last snapshot
+_JOURNAL_WAKE = threading.Event()
+_JOURNAL_THREAD = None
+
+
+def _journal_append(path, rec):
+    line = json.dumps(rec, ensure_ascii=False, separators=(",", ":"))
+    with _lock_for(_JOURNAL_LOCKS, path):
+        with open(journal_path(path), "a", encoding="utf-8") as f:
+            f.write(line + "\n")
+            if JOURNAL_FSYNC:
+                f.flush()
+                os.fsync(f.fileno())
+        n = _JOURNAL_COUNTS.get(path, 0) + 1
+        _JOURNAL_COUNTS[path] = n
+    if n >= JOURNAL_COMPACT_RECORDS:
+        _JOURNAL_WAKE.set()
+
+
+def journal_set(path, keys, value):
+    """
+    تسجيل تعديل واحد (keys -> value) بدل إعادة كتابة الملف كاملاً.
+    records are idempotent, so replaying one twice after a compaction is harmless.
+    Call it while holding the collection lock: `value` is serialized here.
+    """
+    _journal_append(path, {"op": "set", "k": list(keys), "v": value})
+
+
+def journal_delete(path, keys):
+    _journal_append(path, {"op": "del", "k": list(keys)})
+
+
+def track_json(path, obj, lock=None):
+    """
+    Register the live object behind `path` (and the lock its writers hold) so
+    snapshots of it are taken consistently and the compactor can fold it.
+    """
+    _JOURNAL_TARGETS[path] = obj
+    if lock is not None:
+        _SNAPSHOT_LOCKS[path] = lock
+
+
+def _journal_pending(path):
+    if _JOURNAL_COUNTS.get(path):
+        return True
+    # records left over from a previous run (replayed by load_json)
+    jpath = journal_path(path)
+    if os.path.exists(jpath) and os.path.getsize(jpath) > 0:
+        return True
+    return os.path.exists(sealed_journal_path(path))
+
+
+def compact_journal(path):
+    """Fold the journal into a snapshot, written by the debounced flusher (save_json)."""
+    obj = _JOURNAL_TARGETS.get(path)
+    if obj is None or not _journal_pending(path):
+        return False
+    save_json(path, obj)
+    return True
+
+
+def compact_all_journals():
+    for path in list(_JOURNAL_TARGETS):
+        compact_journal(path)
+
+
+def _journal_compactor_loop():
+    while True:
+        _JOURNAL_WAKE.wait(JOURNAL_COMPACT_SECONDS)
+        _JOURNAL_WAKE.clear()
+        try:
+            compact_all_journals()
+        except Exception as e:
+            print("⚠️ journal compaction failed:", e)
+
+
+def start_journal_compactor():
+    global _JOURNAL_THREAD
+    if _JOURNAL_THREAD is not None:
+        return
+    _JOURNAL_THREAD = threading.Thread(
+        target=_journal_compactor_loop, name="journal-compactor", daemon=True
+    )
+    _JOURNAL_THREAD.start()
+    atexit.register(_compact_on_exit)
+
+
+def _compact_on_exit():
+    # the flusher's own atexit hook may already have run
+    compact_all_journals()
+    flush_json()
+
+
+def attendance_partition_path(month):
+    return os.path.join(ATTENDANCE_DIR, f"{month}.json")
+
+
+def attendance_partition_months():
+    """Months with a partition on disk (snapshot, generation or journal)."""
+    months = set()
+    for fname in os.listdir(ATTENDANCE_DIR):
+        m = re.match(r"^(\d{4}-\d{2})\.json", fname)
+        if m:
+            months.add(m.group(1))
+    return sorted(months)
+
+
+def split_legacy_attendance():
+    """
+    One-shot: move the old single attendance.json (+ journal) into month
+    partitions, then rename it to attendance.json.migrated.
+    """
+    if not any(os.path.exists(p) for p in snapshot_generations(ATTENDANCE_PATH)
+               + [journal_path(ATTENDANCE_PATH), sealed_journal_path(ATTENDANCE_PATH)]):
+        return 0
+    legacy = load_json(ATTENDANCE_PATH, {})
+    by_month = {}
+    for date, node in legacy.items():
+        by_month.setdefault(date[:7], {})[date] = node
+    for month, dates in by_month.items():
+        path = attendance_partition_path(month)
+        part = load_json(path, {})
+        for date, node in dates.items():
+            part.setdefault(date, node)
+        _write_snapshot(path, part)
+    # partitions are durable; only now retire the legacy file
+    if os.path.exists(ATTENDANCE_PATH):
+        os.replace(ATTENDANCE_PATH, ATTENDANCE_PATH + ".migrated")
+    for p in snapshot_generations(ATTENDANCE_PATH)[1:] + [
+        journal_path(ATTENDANCE_PATH), sealed_journal_path(ATTENDANCE_PATH)
+    ]:
+        if os.path.exists(p):
+            os.remove(p)
+    return len(by_month)
 
 
 def new_id(prefix="id"):
@@ -0,0 +1,83 @@
+# context_packer.py
+"""
+Packs retrieved book chunks into the LLM prompt under a token budget.
+
+Chunks are taken in MMR order (relevance to the question against
+similarity to the chunks already taken), near-duplicates are dropped, and
+nothing is added past RAG_CONTEXT_TOKENS estimated tokens, so prompt size,
+and with it LLM latency and cost, stays predictable whatever the book's
+chunking.
+"""
+import numpy as np
+
+from app.chunking import estimate_tokens
+from app.config import RAG_CONTEXT_TOKENS, RAG_MMR_LAMBDA, RAG_CONTEXT_DEDUP
+
+
+def trim_to_tokens(text, budget):
+    """text cut at a word boundary to at most ~budget estimated tokens."""
+    while text and estimate_tokens(text) > budget:
+        keep = int(len(text) * budget / estimate_tokens(text) * 0.9)
+        cut = text.rfind(" ", 0, keep)
+        text = text[:cut if cut > 0 else keep].rstrip()
+    return text
+
+
+def _relevance(scores):
+    scores = np.asarray(scores, dtype=np.float32)
+    span = scores.max() - scores.min()
+    if span <= 0:
+        return np.ones_like(scores)
+    return (scores - scores.min()) / span
+
+
+def pack_context(retrieved, embeddings=None, budget=RAG_CONTEXT_TOKENS,
+                 lam=RAG_MMR_LAMBDA, dedup=RAG_CONTEXT_DEDUP, label=None, max_chunks=None):
+    """
+    retrieved: [(idx, score, text)] best first; embeddings: the book matrix
+    (rows are compared for MMR / duplicates), label(idx): block prefix,
+    max_chunks: stop after this many chunks.
+    Returns (packed [(idx, score, text)] in MMR order, stats dict).
+    """
+    label = label or (lambda idx: f"فقرة {idx}")
+    stats = {"candidates": len(retrieved), "duplicates": 0, "over_budget": 0,
+             "context_tokens": 0, "budget": budget}
+    if not retrieved:
+        stats["packed"] = 0
+        return [], stats
+
+    rel = _relevance([s for _, s, _ in retrieved])
+    sims = None
+    if embeddings is not None:
+        rows = np.asarray(embeddings[[i for i, _, _ in retrieved]], dtype=np.float32)
+        sims = rows @ rows.T
+
+    costs = [estimate_tokens(f"[{label(i)}] {t}") + 1 for i, _, t in retrieved]
+    left = list(range(len(retrieved)))
+    taken, packed, used = [], [], 0
+    while left and (not max_chunks or len(packed) < max_chunks):
+        if sims is not None and taken:
+            redundancy = sims[np.ix_(left, taken)].max(axis=1)
+        else:
+            redundancy = np.zeros(len(left), dtype=np.float32)
+        mmr = lam * rel[left] - (1.0 - lam) * redundancy
+        pick = int(np.argmax(mmr))
+        j = left.pop(pick)
+        if redundancy[pick] >= dedup:
+            stats["duplicates"] += 1
+            continue
+        idx, score, text = retrieved[j]
+        if budget and used + costs[j] > budget:
+            if packed:
+                stats["over_budget"] += 1
+                continue
+            # the best chunk alone is over budget: keep its beginning
+            head = estimate_tokens(f"[{label(idx)}] ") + 1
+            text = trim_to_tokens(text, budget - head)
+            costs[j] = head + estimate_tokens(text)
+        taken.append(j)
+        packed.append((idx, score, text))
+        used += costs[j]
+    stats["packed"] = len(packed)
+    stats["context_tokens"] = used
+    return packed, stats
@@ -0,0 +1,264 @@
+# ingest.py
+import json
+import os
+import queue
+import re
+import shutil
+import threading
+import time
+
+from app.config import SUBJECT_RAG_DIR, new_id, now_iso
+from app.chunking import chunking_strategy
+from app.rag_utils import ingest_book_file, upload_staging_path, subject_book_paths
+
+# ------------------ BOOK INGESTION JOBS ------------------
+# uploads are parsed / embedded / indexed by one background worker; the job
+# status lives in jobs/<job_id>.json so every server worker can report it
+JOBS_DIR = os.path.join(SUBJECT_RAG_DIR, "jobs")
+os.makedirs(JOBS_DIR, exist_ok=True)
+
+JOB_KEEP_SECONDS = 7 * 24 * 3600
+FINAL_STATES = ("done", "failed")
+
+_JOB_QUEUE = queue.Queue()
+_WORKER_LOCK = threading.Lock()
+_worker = None
+
+# (pid, boot token) of this process, the token also written to
+# jobs/proc_<pid>.boot at startup. A pid alone is not enough: a restarted
+# container runs the server as the same pid again
+_OWNER = None
+# job file name -> (mtime_ns, parsed job): list_jobs re-reads changed files only
+_JOB_CACHE = {}
+
+
+def _job_path(job_id):
+    return os.path.join(JOBS_DIR, job_id + ".json")
+
+
+def _boot_path(pid):
+    return os.path.join(JOBS_DIR, f"proc_{pid}.boot")
+
+
+def _file_version(path):
+    st = os.stat(path)
+    return st.st_mtime_ns, st.st_size
+
+
+def _save_job(job):
+    path = _job_path(job["id"])
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(job, f, ensure_ascii=False)
+    os.replace(tmp, path)
+    _JOB_CACHE[job["id"]] = (_file_version(path), dict(job))
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+
+def _owner_token():
+    """Boot token of this process (registered at import, again in a forked worker)."""
+    global _OWNER
+    pid = os.getpid()
+    if _OWNER is None or _OWNER[0] != pid:
+        token = f"{time.time():.6f}-{new_id('boot')}"
+        tmp = _boot_path(pid) + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(token)
+        os.replace(tmp, _boot_path(pid))
+        _OWNER = (pid, token)
+    return _OWNER[1]
+
+
+def _owner_alive(job):
+    """Is the process that queued this job still the one running (same pid and boot)?"""
+    pid = job.get("pid", 0)
+    if not _pid_alive(pid):
+        return False
+    try:
+        with open(_boot_path(pid), "r", encoding="utf-8") as f:
+            return f.read() == job.get("boot")
+    except OSError:
+        return False
+
+
+# every process registers, not only those that queue jobs: otherwise a fresh
+# process reusing a dead one's pid would vouch for that process's jobs
+_owner_token()
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_owner_token)
+
+
+def _read_job(job_id):
+    path = _job_path(job_id)
+    try:
+        version = _file_version(path)
+    except OSError:
+        _JOB_CACHE.pop(job_id, None)
+        return None
+    cached = _JOB_CACHE.get(job_id)
+    if cached is not None and cached[0] == version:
+        return dict(cached[1])
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            job = json.load(f)
+    except (OSError, ValueError):
+        return None
+    _JOB_CACHE[job_id] = (version, job)
+    return dict(job)
+
+
+def _check_interrupted(job):
+    # the process running it died or was restarted: it will never finish
+    if job["state"] not in FINAL_STATES and not _owner_alive(job):
+        job.update(state="failed", error="interrupted (server restarted)", finished_at=now_iso())
+        _save_job(job)
+    return job
+
+
+def get_job(job_id):
+    if not re.fullmatch(r"job_[a-z0-9]+", job_id or ""):
+        return None
+    job = _read_job(job_id)
+    return _check_interrupted(job) if job is not None else None
+
+
+def list_jobs(stage=None, section=None, subject=None, limit=20):
+    """Newest first, optionally for one subject (only the returned jobs are checked for interruption)."""
+    jobs = []
+    for fname in os.listdir(JOBS_DIR):
+        if not fname.endswith(".json"):
+            continue
+        job = _read_job(fname[:-len(".json")])
+        if job is None:
+            continue
+        if (stage, section, subject) != (None, None, None) and \
+                (job["stage"], job["section"], job["subject"]) != (stage, section, subject):
+            continue
+        jobs.append(job)
+    jobs.sort(key=lambda j: j["created_ts"], reverse=True)
+    return [_check_interrupted(job) for job in jobs[:limit]]
+
+
+def _prune_jobs():
+    cutoff = time.time() - JOB_KEEP_SECONDS
+    for job in list_jobs(limit=None):
+        if job["state"] in FINAL_STATES and job["created_ts"] < cutoff:
+            try:
+                os.remove(_job_path(job["id"]))
+            except OSError:
+                pass
+    # boot tokens of processes that are gone
+    for fname in os.listdir(JOBS_DIR):
+        m = re.fullmatch(r"proc_(\d+)\.boot", fname)
+        if m and not _pid_alive(int(m.group(1))):
+            try:
+                os.remove(os.path.join(JOBS_DIR, fname))
+            except OSError:
+                pass
+
+
+def _run_job(job_id, staging):
+    job = get_job(job_id)
+    if job is None:
+        return
+    t0 = time.time()
+
+    def progress(step, fraction):
+        job.update(state="running", step=step, progress=round(fraction, 3))
+        _save_job(job)
+
+    try:
+        ok, err = ingest_book_file(
+            staging, job["stage"], job["section"], job["subject"], progress=progress,
+            chunking=job.get("chunking"),
+        )
+    except Exception as e:
+        ok, err = False, str(e)
+    if os.path.exists(staging):
+        os.remove(staging)
+    job.update(
+        state="done" if ok else "failed",
+        step=None if ok else job.get("step"),
+        error=err,
+        progress=1.0 if ok else job.get("progress", 0.0),
+        finished_at=now_iso(),
+        seconds=round(time.time() - t0, 2),
+    )
+    _save_job(job)
+
+
+def _worker_loop():
+    while True:
+        job_id, staging = _JOB_QUEUE.get()
+        try:
+            _run_job(job_id, staging)
+        except Exception as e:
+            print("⚠️ ingestion job crashed:", job_id, e)
+        finally:
+            _JOB_QUEUE.task_done()
+
+
+def _ensure_worker():
+    global _worker
+    with _WORKER_LOCK:
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=_worker_loop, name="book-ingest", daemon=True)
+            _worker.start()
+
+
+def _queue_job(stage, section, subject, job_id, staging, chunking):
+    job = {
+        "id": job_id,
+        "stage": stage,
+        "section": section,
+        "subject": subject,
+        # None = keep the subject's current chunking strategy
+        "chunking": chunking_strategy(chunking) if chunking else None,
+        "state": "queued",
+        "step": None,
+        "progress": 0.0,
+        "error": None,
+        "created_at": now_iso(),
+        "created_ts": time.time(),
+        "finished_at": None,
+        "pid": os.getpid(),
+        "boot": _owner_token(),
+    }
+    _save_job(job)
+    _prune_jobs()
+    _ensure_worker()
+    _JOB_QUEUE.put((job_id, staging))
+    return job
+
+
+def submit_book_upload(file_storage, stage, section, subject, chunking=None):
+    """
+    Save the upload next to the current book and queue its ingestion.
+    Returns the job dict immediately; the current book keeps serving until
+    the new one is swapped in.
+    """
+    job_id = new_id("job")
+    staging = upload_staging_path(stage, section, subject, job_id)
+    os.makedirs(os.path.dirname(staging), exist_ok=True)
+    file_storage.save(staging)
+    return _queue_job(stage, section, subject, job_id, staging, chunking)
+
+
+def submit_book_rechunk(stage, section, subject, chunking):
+    """Queue the current Word book again with another chunking strategy (None if there is no book)."""
+    docx_path, _ = subject_book_paths(stage, section, subject)
+    if not os.path.exists(docx_path):
+        return None
+    job_id = new_id("job")
+    staging = upload_staging_path(stage, section, subject, job_id)
+    shutil.copyfile(docx_path, staging)
+    return _queue_job(stage, section, subject, job_id, staging, chunking)
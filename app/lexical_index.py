@@ -0,0 +1,116 @@
+# lexical_index.py
+"""
+BM25 keyword index over the normalized Arabic tokens of a book's paragraphs.
+
+An index is a plain dict:
+    {"kind": "bm25", "terms": {token: term id},
+     "ptr": (nterms + 1,) start of each term's postings in docs/tfs,
+     "docs": paragraph ids, "tfs": term frequencies, "idf": (nterms,),
+     "norm": (n,) k1 * (1 - b + b * len / avg len), "k1": float}
+It is built when a book is loaded and scored with numpy only: keyword
+questions never need the embedding model.
+"""
+import sys
+from collections import Counter
+
+import numpy as np
+
+from app.arabic_text import WORD, fold_arabic
+from app.config import RAG_BM25_K1, RAG_BM25_B
+from app.vector_index import top_k
+
+# light stemming: one prefix and one suffix, keeping at least 2 letters
+_PREFIXES = ("وال", "بال", "كال", "فال", "لل", "ال")
+_SUFFIXES = ("ات", "ون", "ين", "ان", "ها", "ه")
+
+_STOPWORDS_RAW = """
+في من على الى إلى عن ما ماذا هل هو هي هم هذا هذه ذلك تلك هناك التي الذي الذين
+و او أو ثم مع كل بين عند لماذا كيف كم متى اين أين لم لن لا ان أن إن كان كانت يكون
+قد ليس غير بعد قبل حتى اذا إذا
+"""
+
+
+def _stem(tok):
+    for p in _PREFIXES:
+        if tok.startswith(p) and len(tok) - len(p) >= 2:
+            tok = tok[len(p):]
+            break
+    for s in _SUFFIXES:
+        if tok.endswith(s) and len(tok) - len(s) >= 2:
+            tok = tok[:-len(s)]
+            break
+    return tok
+
+
+STOPWORDS = {_stem(w) for w in fold_arabic(_STOPWORDS_RAW).split()}
+
+
+def arabic_tokens(text):
+    """Normalized, lightly stemmed tokens of text, stopwords removed."""
+    out = []
+    for tok in WORD.findall(fold_arabic(text or "")):
+        tok = _stem(tok)
+        if len(tok) >= 2 and tok not in STOPWORDS:
+            out.append(tok)
+    return out
+
+
+def build_bm25(paragraphs, k1=RAG_BM25_K1, b=RAG_BM25_B):
+    n = len(paragraphs)
+    terms = {}
+    term_ids, doc_ids, tfs = [], [], []
+    doc_len = np.zeros(n, dtype=np.float32)
+    for d, p in enumerate(paragraphs):
+        counts = Counter(arabic_tokens(p))
+        doc_len[d] = sum(counts.values())
+        for tok, c in counts.items():
+            term_ids.append(terms.setdefault(tok, len(terms)))
+            doc_ids.append(d)
+            tfs.append(c)
+
+    term_ids = np.asarray(term_ids, dtype=np.int32)
+    order = np.argsort(term_ids, kind="stable")
+    df = np.bincount(term_ids, minlength=len(terms))
+    ptr = np.zeros(len(terms) + 1, dtype=np.int64)
+    np.cumsum(df, out=ptr[1:])
+    avgdl = float(doc_len.mean()) if n and doc_len.any() else 1.0
+    return {
+        "kind": "bm25",
+        "terms": terms,
+        "ptr": ptr,
+        "docs": np.asarray(doc_ids, dtype=np.int32)[order],
+        "tfs": np.asarray(tfs, dtype=np.float32)[order],
+        "idf": np.log1p((n - df + 0.5) / (df + 0.5)).astype(np.float32),
+        "norm": (k1 * (1.0 - b + b * doc_len / avgdl)).astype(np.float32),
+        "k1": float(k1),
+    }
+
+
+def bm25_scores(index, tokens):
+    """BM25 score of every paragraph for the query tokens (zeros if none match)."""
+    scores = np.zeros(index["norm"].shape[0], dtype=np.float32)
+    k1 = index["k1"]
+    for tok in set(tokens):
+        tid = index["terms"].get(tok)
+        if tid is None:
+            continue
+        s, e = index["ptr"][tid], index["ptr"][tid + 1]
+        docs, tf = index["docs"][s:e], index["tfs"][s:e]
+        scores[docs] += index["idf"][tid] * tf * (k1 + 1.0) / (tf + index["norm"][docs])
+    return scores
+
+
+def search_bm25(index, tokens, k):
+    """(paragraph indices, scores) of the k best matching paragraphs, best first."""
+    scores = bm25_scores(index, tokens)
+    idx = top_k(scores, k)
+    idx = idx[scores[idx] > 0]
+    return idx, scores[idx]
+
+
+def bm25_bytes(index):
+    total = sum(v.nbytes for v in index.values() if isinstance(v, np.ndarray))
+    total += sys.getsizeof(index["terms"])
+    total += sum(sys.getsizeof(t) for t in index["terms"])
+    return total
+
@@ -1,20 +1,52 @@
 # rag_utils.py
+import hashlib
+import json
 import os
 import re
+import sys
+import threading
+import time
+import xml.etree.ElementTree as ET
+import zipfile
+from collections import OrderedDict
 from types import SimpleNamespace
 
 import numpy as np
-from docx import Document
-from sentence_transformers import SentenceTransformer
 from urllib.parse import unquote_plus
 
-from app.config import SUBJECT_RAG_DIR, RAG_MODEL_NAME, RAG_TOP_K
+from app.config import (
+    SUBJECT_RAG_DIR, RAG_MODEL_NAME, RAG_TOP_K, RAG_CACHE_MAX_MB,
+    RAG_EMBED_BATCH, RAG_EMBED_WINDOW, RAG_RETRIEVAL, RAG_BM25_WEIGHT,
+    RAG_RERANK_CANDIDATES, RAG_RERANK_KEEP,
+    RAG_QUERY_CACHE_SIZE, RAG_QUERY_CACHE_TTL,
+    RAG_ANSWER_CACHE_SIZE, RAG_ANSWER_CACHE_TTL, RAG_ANSWER_CACHE_THRESHOLD, RAG_WARMUP
+)
 from app.ai_utils import openai_chat_completion
-
-# cache in-memory: key -> {"paragraphs": [...], "embeddings": np.ndarray}
-SUBJECT_RAG_CACHE = {}
-
-RAG_SYSTEM_PROMPT = """
+from app.vector_index import load_or_build_index, search_index, quantize, top_k
+from app.chunking import chunk_blocks, chunking_strategy, estimate_tokens
+from app.context_packer import pack_context
+from app.reranker import rerank, reranker_name, reranker_status, get_cross_encoder
+from app.lexical_index import arabic_tokens, build_bm25, bm25_scores, search_bm25, bm25_bytes
+
+# cache in-memory: key -> {"paragraphs": [...], "embeddings": np.ndarray, "index": {...},
+#                          "quant": {...} or None, "lexical": BM25 index, "version": hash}
+# paragraphs/embeddings/index/quant/lexical are the BOOK_VECTORS entry of the book's content
+# hash, so sections that uploaded the same book share one copy (embeddings
+# memory-mapped from the book store). Least recently used first; bounded by
+# RAG_CACHE_MAX_MB (see enforce_rag_cache_budget).
+SUBJECT_RAG_CACHE = OrderedDict()
+# content hash -> {"paragraphs", "embeddings", "index", "quant", "lexical", "bytes"}
+BOOK_VECTORS = {}
+_RAG_CACHE_LOCK = threading.RLock()
+_RAG_CACHE_COUNTS = {"loads": 0, "evictions": 0}
+
+BOOK_STORE_DIR = os.path.join(SUBJECT_RAG_DIR, "store")
+os.makedirs(BOOK_STORE_DIR, exist_ok=True)
+
+# what the model is told to say when the passages do not answer the question
+NOT_IN_BOOK_REPLY = "لا أستطيع إيجاد جواب مطابق لهذا السؤال في الكتاب."
+
+RAG_SYSTEM_PROMPT = f"""
 أنت روبوت معلم مواد علمية (مثل الأحياء والكيمياء) لطلبة الصف الأول المتوسط في العراق.
 سيتم تزويدك بمقاطع من كتاب مدرسي وسؤال طالب.
 
@@ -31,16 +63,79 @@ RAG_SYSTEM_PROMPT = """
 3- تجنّب الاقتباس الحرفي الطويل من الكتاب؛ إن احتجت اقتباساً حرفياً فليكن قصيراً (تعريف أو جملة واحدة).
 4- لا تعِد كتابة السؤال في الجواب، ولا تذكر رقم الفقرة أو اسم الكتاب أو أي تفاصيل تقنية.
 5- إذا لم يكن الجواب واضحاً في النص، قل حرفياً:
-"لا أستطيع إيجاد جواب مطابق لهذا السؤال في الكتاب."
+"{NOT_IN_BOOK_REPLY}"
 6- أجب بالعربية الفصحى المبسطة، وبإيجاز (من 2 إلى 5 جمل)، وكأنك تشرح لطلبة الصف الأول المتوسط.
 """
 
-print("🔧 Loading RAG embedding model...")
-try:
-    RAG_EMBED_MODEL = SentenceTransformer(RAG_MODEL_NAME)
-except Exception as e:
-    print("⚠️ RAG feature disabled (embedding model load error):", e)
-    RAG_EMBED_MODEL = None
+# ------------------ EMBEDDING MODEL (lazy) ------------------
+# loaded on first use (or by start_model_warmup), not at import time, so the
+# dashboard and robot heartbeats are served while the model is still loading
+RAG_EMBED_MODEL = None
+_MODEL_LOCK = threading.Lock()
+_MODEL_STATUS = {"state": "idle", "error": None, "load_seconds": None}
+
+
+def get_embed_model():
+    """SentenceTransformer for RAG_MODEL_NAME, loading it once; None if it failed."""
+    global RAG_EMBED_MODEL
+    if RAG_EMBED_MODEL is not None or _MODEL_STATUS["state"] == "failed":
+        return RAG_EMBED_MODEL
+    with _MODEL_LOCK:
+        if RAG_EMBED_MODEL is not None or _MODEL_STATUS["state"] == "failed":
+            return RAG_EMBED_MODEL
+        _MODEL_STATUS["state"] = "loading"
+        print("🔧 Loading RAG embedding model...")
+        t0 = time.time()
+        try:
+            # heavy import (torch) deferred together with the model
+            from sentence_transformers import SentenceTransformer
+            RAG_EMBED_MODEL = SentenceTransformer(RAG_MODEL_NAME)
+        except Exception as e:
+            print("⚠️ RAG feature disabled (embedding model load error):", e)
+            _MODEL_STATUS.update(state="failed", error=str(e))
+            return None
+        _MODEL_STATUS.update(state="ready", load_seconds=round(time.time() - t0, 2))
+        print(f"✅ RAG embedding model ready in {_MODEL_STATUS['load_seconds']}s")
+    return RAG_EMBED_MODEL
+
+
+def _warmup():
+    get_embed_model()
+    if reranker_name() == "cross-encoder":
+        get_cross_encoder()
+
+
+def start_model_warmup():
+    """Load the model(s) in a daemon thread; returns immediately."""
+    if _MODEL_STATUS["state"] != "idle":
+        return
+    threading.Thread(target=_warmup, name="rag-warmup", daemon=True).start()
+
+
+def rag_readiness():
+    """
+    "ready", "lazy" (RAG_WARMUP=0: the model loads on the first question,
+    nothing to wait for), "idle" (warmup not started yet), "loading" or "failed".
+    """
+    state = _MODEL_STATUS["state"]
+    if state == "idle" and not RAG_WARMUP:
+        return "lazy"
+    return state
+
+
+def rag_status():
+    readiness = rag_readiness()
+    return {
+        "model": RAG_MODEL_NAME,
+        "ready": readiness in ("ready", "lazy"),
+        "readiness": readiness,
+        **_MODEL_STATUS,
+        "retrieval": retrieval_mode(),
+        "rerank": reranker_status(),
+        "query_cache": query_cache_stats(),
+        "answer_cache": answer_cache_stats(),
+        "memory": rag_cache_stats(),
+    }
 
 
 def subject_rag_key(stage, section, subject):
@@ -57,109 +152,676 @@ def subject_book_paths(stage, section, subject):
     return docx_path, cleaned_path
 
 
+def book_store_paths(content_hash):
+    """
+    Content-addressed vectors of one book text (shared by every subject that
+    uploaded the same book): <hash>.npy float32 embeddings, <hash>.json
+    manifest, <hash>_ivf.npz vector index.
+    """
+    base = os.path.join(BOOK_STORE_DIR, content_hash)
+    return base + ".npy", base + ".json", base + "_ivf.npz"
+
+
 def subject_book_exists(stage, section, subject):
     docx_path, _ = subject_book_paths(stage, section, subject)
     return os.path.exists(docx_path)
 
 
-def rag_embed_texts(texts, is_query=False):
-    if RAG_EMBED_MODEL is None:
+def rag_embed_texts(texts, is_query=False, batch_size=RAG_EMBED_BATCH):
+    model = get_embed_model()
+    if model is None:
         raise RuntimeError("RAG embedding model is not available on this server.")
     prefix = "query: " if is_query else "passage: "
-    return RAG_EMBED_MODEL.encode(
+    return model.encode(
         [prefix + t for t in texts],
-        normalize_embeddings=True
+        normalize_embeddings=True,
+        batch_size=batch_size
     )
 
 
+def paragraphs_hash(paragraphs):
+    h = hashlib.sha256()
+    for p in paragraphs:
+        h.update(p.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def _replace_file(path, write):
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def load_cached_embeddings(emb_path, manifest_path, content_hash):
+    """
+    Embeddings from disk (memory-mapped, read-only) if the manifest matches
+    this exact paragraph list and RAG_MODEL_NAME, else None.
+    """
+    try:
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        if (manifest.get("model") != RAG_MODEL_NAME
+                or manifest.get("content_sha256") != content_hash):
+            return None
+        emb = np.load(emb_path, mmap_mode="r")
+    except (OSError, ValueError):
+        return None
+    if emb.dtype != np.float32 or emb.ndim != 2 or emb.shape[0] != manifest.get("count"):
+        return None
+    return emb
+
+
+def _write_manifest(manifest_path, content_hash, count, dim):
+    manifest = {
+        "model": RAG_MODEL_NAME,
+        "content_sha256": content_hash,
+        "count": int(count),
+        "dim": int(dim),
+        "dtype": "float32",
+    }
+    _replace_file(manifest_path, lambda f: f.write(json.dumps(manifest).encode("utf-8")))
+
+
+# ------------------ QUERY EMBEDDING CACHE ------------------
+# (model, normalized question) -> (stored_at, vector), oldest first (LRU order)
+_QUERY_CACHE = OrderedDict()
+_QUERY_CACHE_LOCK = threading.Lock()
+_QUERY_CACHE_COUNTS = {"hits": 0, "misses": 0}
+
+
+def _query_cache_key(question):
+    return RAG_MODEL_NAME, " ".join(question.split()).lower()
+
+
+def embed_query(question):
+    """Query embedding (float32, read-only), from the LRU when the same question was seen recently."""
+    if RAG_QUERY_CACHE_SIZE <= 0:
+        return rag_embed_texts([question], is_query=True)[0].astype("float32")
+    key = _query_cache_key(question)
+    now = time.time()
+    with _QUERY_CACHE_LOCK:
+        item = _QUERY_CACHE.get(key)
+        if item is not None and now - item[0] <= RAG_QUERY_CACHE_TTL:
+            _QUERY_CACHE.move_to_end(key)
+            _QUERY_CACHE_COUNTS["hits"] += 1
+            return item[1]
+        _QUERY_CACHE_COUNTS["misses"] += 1
+    # encode outside the lock: other questions keep being served meanwhile
+    vec = rag_embed_texts([question], is_query=True)[0].astype("float32")
+    vec.setflags(write=False)
+    with _QUERY_CACHE_LOCK:
+        _QUERY_CACHE[key] = (now, vec)
+        _QUERY_CACHE.move_to_end(key)
+        while len(_QUERY_CACHE) > RAG_QUERY_CACHE_SIZE:
+            _QUERY_CACHE.popitem(last=False)
+    return vec
+
+
+def query_cache_stats():
+    with _QUERY_CACHE_LOCK:
+        total = _QUERY_CACHE_COUNTS["hits"] + _QUERY_CACHE_COUNTS["misses"]
+        return {
+            **_QUERY_CACHE_COUNTS,
+            "size": len(_QUERY_CACHE),
+            "max_size": RAG_QUERY_CACHE_SIZE,
+            "hit_rate": round(_QUERY_CACHE_COUNTS["hits"] / total, 3) if total else 0.0,
+        }
+
+
+def _embed_windows(paragraphs, progress=None):
+    """
+    (start, order, vectors) for each window of RAG_EMBED_WINDOW passages.
+    A window is encoded sorted by length so each model batch pads to similar
+    lengths; vectors[j] belongs to paragraph start + order[j].
+    """
+    n = len(paragraphs)
+    for start in range(0, n, RAG_EMBED_WINDOW):
+        window = paragraphs[start:start + RAG_EMBED_WINDOW]
+        order = np.argsort([len(p) for p in window], kind="stable")
+        vecs = rag_embed_texts([window[i] for i in order], is_query=False)
+        yield start, order, np.asarray(vecs, dtype=np.float32)
+        if progress:
+            progress(min(1.0, (start + len(window)) / n))
+
+
+def embed_passages(paragraphs, progress=None):
+    """Passage embeddings in memory (used when the book store is not writable)."""
+    out = None
+    for start, order, vecs in _embed_windows(paragraphs, progress):
+        if out is None:
+            out = np.empty((len(paragraphs), vecs.shape[1]), dtype=np.float32)
+        out[start + order] = vecs
+    return out
+
+
+def embed_book_to_store(paragraphs, content_hash, progress=None):
+    """
+    Encode the passages window by window straight into <hash>.npy (an
+    on-disk memmap), then write the manifest. Only one window of vectors is
+    ever in memory, so large books embed in flat memory. Returns the
+    read-only memmap, or None if it could not be read back.
+    """
+    emb_path, manifest_path, _ = book_store_paths(content_hash)
+    tmp = f"{emb_path}.{os.getpid()}.tmp"
+    out = None
+    try:
+        for start, order, vecs in _embed_windows(paragraphs, progress):
+            if out is None:
+                out = np.lib.format.open_memmap(
+                    tmp, mode="w+", dtype=np.float32, shape=(len(paragraphs), vecs.shape[1])
+                )
+            out[start + order] = vecs
+            out.flush()
+        dim = out.shape[1]
+        del out
+        with open(tmp, "rb+") as f:
+            os.fsync(f.fileno())
+        # matrix first, manifest last: a manifest always describes a complete .npy
+        os.replace(tmp, emb_path)
+        _write_manifest(manifest_path, content_hash, len(paragraphs), dim)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return load_cached_embeddings(emb_path, manifest_path, content_hash)
+
+
+def load_book_vectors(paragraphs, content_hash, progress=None):
+    """
+    Embeddings + index for this exact paragraph list: shared in memory, else
+    from the book store, else computed (once per distinct book) and stored.
+    """
+    with _RAG_CACHE_LOCK:
+        vectors = BOOK_VECTORS.get(content_hash)
+    if vectors is not None:
+        return vectors, None
+    emb_path, manifest_path, index_path = book_store_paths(content_hash)
+    # recomputed only when the book text or the model changes
+    embeddings = load_cached_embeddings(emb_path, manifest_path, content_hash)
+    if embeddings is None:
+        try:
+            try:
+                embeddings = embed_book_to_store(paragraphs, content_hash, progress=progress)
+            except OSError as e:
+                print("⚠️ could not write embedding cache:", e)
+            if embeddings is None:
+                embeddings = embed_passages(paragraphs, progress=progress)
+        except Exception as e:
+            return None, f"خطأ في حساب الـ embeddings: {e}"
+    vectors = {
+        "paragraphs": paragraphs,
+        "embeddings": embeddings,
+        "index": load_or_build_index(index_path, embeddings, content_hash),
+        # RAG_EMB_DTYPE float16/int8: scoring runs on this, float32 only re-ranks
+        "quant": quantize(embeddings),
+        # keyword index: cheap to rebuild, so not persisted
+        "lexical": build_bm25(paragraphs),
+    }
+    vectors["bytes"] = _book_bytes(vectors)
+    with _RAG_CACHE_LOCK:
+        # another thread may have loaded the same book meanwhile: keep one copy
+        vectors = BOOK_VECTORS.setdefault(content_hash, vectors)
+    return vectors, None
+
+
+# ------------------ MEMORY BUDGET ------------------
+
+
+def _book_bytes(vectors):
+    total = sys.getsizeof(vectors["paragraphs"])
+    total += sum(sys.getsizeof(p) for p in vectors["paragraphs"])
+    total += sum(v.nbytes for v in vectors["index"].values() if isinstance(v, np.ndarray))
+    total += bm25_bytes(vectors["lexical"])
+    quant = vectors["quant"]
+    if quant is not None:
+        # float32 rows are only read for re-ranking; the codes are what stays hot
+        total += sum(v.nbytes for v in quant.values() if isinstance(v, np.ndarray))
+        if not isinstance(vectors["embeddings"], np.memmap):
+            total += vectors["embeddings"].nbytes
+    else:
+        # memory-mapped matrices count at full size: exact search touches every page
+        total += vectors["embeddings"].nbytes
+    return total
+
+
+def rag_cache_resident_bytes():
+    with _RAG_CACHE_LOCK:
+        return sum(v["bytes"] for v in BOOK_VECTORS.values())
+
+
+def _drop_subject_book(key):
+    """Forget one subject; its vectors go too once no other subject shares them."""
+    entry = SUBJECT_RAG_CACHE.pop(key, None)
+    if entry is None:
+        return
+    version = entry["version"]
+    if not any(e["version"] == version for e in SUBJECT_RAG_CACHE.values()):
+        BOOK_VECTORS.pop(version, None)
+
+
+def enforce_rag_cache_budget(keep=None):
+    """Evict least recently used subject books until under RAG_CACHE_MAX_MB (never `keep`)."""
+    budget = RAG_CACHE_MAX_MB * 1024 * 1024
+    with _RAG_CACHE_LOCK:
+        for key in list(SUBJECT_RAG_CACHE):
+            if rag_cache_resident_bytes() <= budget:
+                break
+            if key == keep:
+                continue
+            _drop_subject_book(key)
+            _RAG_CACHE_COUNTS["evictions"] += 1
+            print(f"♻️ RAG cache evicted {key}")
+
+
+def rag_cache_stats():
+    with _RAG_CACHE_LOCK:
+        return {
+            **_RAG_CACHE_COUNTS,
+            "resident_bytes": rag_cache_resident_bytes(),
+            "budget_bytes": RAG_CACHE_MAX_MB * 1024 * 1024,
+            "books": len(BOOK_VECTORS),
+            "subjects": len(SUBJECT_RAG_CACHE),
+        }
+
+
+def get_subject_book(stage, section, subject):
+    """(cache entry, None) for a subject book, loading it if needed; marks it recently used."""
+    key = subject_rag_key(stage, section, subject)
+    _, cleaned_path = subject_book_paths(stage, section, subject)
+    mtime = _mtime(cleaned_path)
+    with _RAG_CACHE_LOCK:
+        data = SUBJECT_RAG_CACHE.get(key)
+        # a changed cleaned text means the book was replaced (maybe by another worker)
+        if data is not None and data["mtime"] == mtime:
+            SUBJECT_RAG_CACHE.move_to_end(key)
+            return data, None
+    ok, err = load_subject_book_into_memory(stage, section, subject)
+    if not ok:
+        return None, err
+    with _RAG_CACHE_LOCK:
+        return SUBJECT_RAG_CACHE[key], None
+
+
+_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+
+def _docx_heading_styles(z):
+    """styleId -> heading level from word/styles.xml ("heading N", "Title", outline level)."""
+    levels = {}
+    try:
+        root = ET.fromstring(z.read("word/styles.xml"))
+    except (KeyError, ET.ParseError):
+        return levels
+    for style in root.iter(_W + "style"):
+        name = style.find(_W + "name")
+        name = (name.get(_W + "val") or "").lower() if name is not None else ""
+        outline = style.find(f"{_W}pPr/{_W}outlineLvl")
+        m = re.fullmatch(r"heading\s*(\d)", name)
+        if m:
+            levels[style.get(_W + "styleId")] = int(m.group(1))
+        elif name == "title":
+            levels[style.get(_W + "styleId")] = 1
+        elif outline is not None and int(outline.get(_W + "val", "9")) < 9:
+            levels[style.get(_W + "styleId")] = int(outline.get(_W + "val")) + 1
+    return levels
+
+
+def _paragraph_level(p, heading_styles):
+    ppr = p.find(_W + "pPr")
+    if ppr is None:
+        return 0
+    outline = ppr.find(_W + "outlineLvl")
+    if outline is not None and int(outline.get(_W + "val", "9")) < 9:
+        return int(outline.get(_W + "val")) + 1
+    style = ppr.find(_W + "pStyle")
+    return heading_styles.get(style.get(_W + "val"), 0) if style is not None else 0
+
+
+def iter_docx_blocks(docx_path):
+    """
+    (heading level, text) of the body paragraphs of a Word file (level 0 =
+    body text), streamed from word/document.xml: each paragraph is dropped
+    once read, so the XML tree of a large book is never held in memory.
+    """
+    with zipfile.ZipFile(docx_path) as z, z.open("word/document.xml") as f:
+        heading_styles = _docx_heading_styles(z)
+        body = None
+        depth = 0
+        for event, elem in ET.iterparse(f, events=("start", "end")):
+            if event == "start":
+                depth += 1
+                if depth == 2 and elem.tag == _W + "body":
+                    body = elem
+                continue
+            depth -= 1
+            # document / body / <block>: only top-level blocks are paragraphs
+            if depth != 2 or body is None:
+                continue
+            if elem.tag == _W + "p":
+                parts = []
+                for node in elem.iter():
+                    if node.tag == _W + "t":
+                        parts.append(node.text or "")
+                    elif node.tag in (_W + "tab", _W + "br", _W + "cr"):
+                        parts.append(" ")
+                yield _paragraph_level(elem, heading_styles), "".join(parts)
+            body.remove(elem)
+
+
+def _write_book_text(f, stage, section, subject, paragraphs):
+    f.write(f"{stage} / {section} / {subject}".encode("utf-8"))
+    for p in paragraphs:
+        f.write(b"\n\n")
+        f.write(p.encode("utf-8"))
+
+
+def read_book_docx(docx_path, strategy=None):
+    """Word file -> (cleaned chunks, chunk metadata), see app.chunking."""
+    return chunk_blocks(iter_docx_blocks(docx_path), strategy)
+
+
+def subject_chunks_path(stage, section, subject):
+    """Chunking strategy + per-chunk metadata of the subject's current book."""
+    _, cleaned_path = subject_book_paths(stage, section, subject)
+    return cleaned_path[:-len("_cleaned.txt")] + "_chunks.json"
+
+
+def _write_chunk_meta(path, strategy, content_hash, meta):
+    data = {"strategy": strategy, "content_sha256": content_hash, "chunks": meta}
+    _replace_file(path, lambda f: f.write(json.dumps(data, ensure_ascii=False).encode("utf-8")))
+
+
+def _read_chunk_meta(path):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def subject_chunking(stage, section, subject):
+    """Strategy the subject's book was (or will be) chunked with."""
+    saved = _read_chunk_meta(subject_chunks_path(stage, section, subject)).get("strategy")
+    return chunking_strategy(saved)
+
+
+def book_text_paragraphs(book_text, stage, section, subject):
+    paragraphs = [p.strip() for p in re.split(r"\n{2,}", book_text) if p.strip()]
+    # the "stage / section / subject" cover line is not book content; leaving
+    # it out makes identical books hash (and embed) identically across sections
+    if paragraphs and paragraphs[0] == f"{stage} / {section} / {subject}":
+        paragraphs = paragraphs[1:]
+    return paragraphs
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def _install_subject_book(key, vectors, content_hash, mtime, chunks=None):
+    with _RAG_CACHE_LOCK:
+        # release the replaced book first, or its vectors stay in BOOK_VECTORS
+        _drop_subject_book(key)
+        # (re-)register these vectors: the drop may have released this same content
+        BOOK_VECTORS.setdefault(content_hash, vectors)
+        SUBJECT_RAG_CACHE[key] = {
+            "paragraphs": vectors["paragraphs"],
+            "embeddings": vectors["embeddings"],
+            "index": vectors["index"],
+            "quant": vectors["quant"],
+            "lexical": vectors["lexical"],
+            "version": content_hash,
+            # per-chunk metadata (heading path, position), None for older books
+            "chunks": chunks,
+            # cleaned-text mtime: another worker replacing the book changes it
+            "mtime": mtime,
+        }
+        SUBJECT_RAG_CACHE.move_to_end(key)
+        _RAG_CACHE_COUNTS["loads"] += 1
+        enforce_rag_cache_budget(keep=key)
+
+
 def load_subject_book_into_memory(stage, section, subject):
     """
     تحميل كتاب المادة (Word) لهذه المادة إلى الذاكرة وبناء الفقرات + embeddings.
     """
     key = subject_rag_key(stage, section, subject)
     docx_path, cleaned_path = subject_book_paths(stage, section, subject)
+    chunks_path = subject_chunks_path(stage, section, subject)
     if not os.path.exists(docx_path):
         return False, "لم يتم رفع أي كتاب لهذه المادة حتى الآن."
 
+    meta = None
     if os.path.exists(cleaned_path):
         with open(cleaned_path, "r", encoding="utf-8") as f:
             book_text = f.read()
+        paragraphs = book_text_paragraphs(book_text, stage, section, subject)
     else:
         print(f"📖 قراءة ملف Word للمادة {stage}/{section}/{subject}: {docx_path}")
-        doc = Document(docx_path)
-        text = "\n".join(p.text for p in doc.paragraphs)
-
-        text = re.sub(r"[ـ]+", "", text)
-        text = re.sub(r"\s+", " ", text)
-        text = re.sub(r"اال", "ال", text)
-        text = re.sub(r"\s*([،؛:.؟])\s*", r"\1 ", text)
-        text = re.sub(r"(?<![\.\؟!])\n+", ". ", text)
-        text = text.strip()
-
-        sentences = re.split(r"(?<=[\.؟!])\s+", text)
-        paragraphs = []
-        temp = []
-        for s in sentences:
-            if not s.strip():
-                continue
-            temp.append(s.strip())
-            if len(temp) >= 3:
-                paragraphs.append(" ".join(temp))
-                temp = []
-        if temp:
-            paragraphs.append(" ".join(temp))
-
-        cover = f"{stage} / {section} / {subject}\n\n"
-        book_text = cover + "\n\n".join(paragraphs)
+        strategy = subject_chunking(stage, section, subject)
+        paragraphs, meta = read_book_docx(docx_path, strategy)
+        # metadata before the text: a worker seeing the new text finds it
+        _write_chunk_meta(chunks_path, strategy, paragraphs_hash(paragraphs), meta)
+        _replace_file(cleaned_path, lambda f: _write_book_text(f, stage, section, subject, paragraphs))
 
-        with open(cleaned_path, "w", encoding="utf-8") as f:
-            f.write(book_text)
-
-    paragraphs = [p.strip() for p in re.split(r"\n{2,}", book_text) if p.strip()]
     if not paragraphs:
         return False, "الكتاب فارغ بعد التنظيف، تحقق من الملف."
 
+    content_hash = paragraphs_hash(paragraphs)
+    if meta is None:
+        saved = _read_chunk_meta(chunks_path)
+        if saved.get("content_sha256") == content_hash:
+            meta = saved.get("chunks")
+    vectors, err = load_book_vectors(paragraphs, content_hash)
+    if err:
+        return False, err
+
+    _install_subject_book(key, vectors, content_hash, _mtime(cleaned_path), chunks=meta)
+    print(f"📘 RAG book loaded for {stage}/{section}/{subject}: {len(paragraphs)} فقرة.")
+    return True, None
+
+
+def ingest_book_file(upload_path, stage, section, subject, progress=None, chunking=None):
+    """
+    Parse, embed and index an uploaded .docx, then swap it in: the current
+    book keeps answering until the new vectors are ready. The upload file is
+    moved into place on success. progress(step, fraction) reports along the way.
+    chunking: strategy for this subject (default: the one it already uses).
+    """
+    report = progress or (lambda step, fraction: None)
+    report("parsing", 0.0)
+    strategy = chunking_strategy(chunking or subject_chunking(stage, section, subject))
     try:
-        para_embeddings = rag_embed_texts(paragraphs, is_query=False).astype("float32")
+        paragraphs, meta = read_book_docx(upload_path, strategy)
     except Exception as e:
-        return False, f"خطأ في حساب الـ embeddings: {e}"
+        return False, f"تعذّر قراءة ملف Word: {e}"
+    if not paragraphs:
+        return False, "الكتاب فارغ بعد التنظيف، تحقق من الملف."
 
-    SUBJECT_RAG_CACHE[key] = {
-        "paragraphs": paragraphs,
-        "embeddings": para_embeddings,
-    }
-    print(f"📘 RAG book loaded for {stage}/{section}/{subject}: {len(paragraphs)} فقرة.")
+    content_hash = paragraphs_hash(paragraphs)
+    report("embedding", 0.0)
+    vectors, err = load_book_vectors(
+        paragraphs, content_hash, progress=lambda f: report("embedding", f)
+    )
+    if err:
+        return False, err
+
+    # swap: Word file, chunk metadata, cleaned text, then the in-memory entry
+    report("swapping", 1.0)
+    docx_path, cleaned_path = subject_book_paths(stage, section, subject)
+    os.replace(upload_path, docx_path)
+    _write_chunk_meta(subject_chunks_path(stage, section, subject), strategy, content_hash, meta)
+    _replace_file(cleaned_path, lambda f: _write_book_text(f, stage, section, subject, paragraphs))
+    _install_subject_book(
+        subject_rag_key(stage, section, subject), vectors, content_hash, _mtime(cleaned_path),
+        chunks=meta,
+    )
+    drop_cached_answers(stage, section, subject)
+    print(f"📘 RAG book replaced for {stage}/{section}/{subject}: {len(paragraphs)} فقرة ({strategy}).")
     return True, None
 
 
-def retrieve_top_k_for_subject(question, stage, section, subject, k=RAG_TOP_K):
-    key = subject_rag_key(stage, section, subject)
-    if key not in SUBJECT_RAG_CACHE:
-        ok, err = load_subject_book_into_memory(stage, section, subject)
-        if not ok:
-            return [], err
-    data = SUBJECT_RAG_CACHE[key]
+RETRIEVAL_MODES = ("hybrid", "dense", "lexical")
+
+
+def retrieval_mode(mode=None):
+    """Effective retrieval mode for a request (RAG_RETRIEVAL when not given or not a string)."""
+    if not isinstance(mode, str):
+        mode = None
+    mode = (mode or RAG_RETRIEVAL or "hybrid").strip().lower()
+    if mode not in RETRIEVAL_MODES:
+        mode = "hybrid"
+    # do not wait for (or fail on) the model: keywords alone still answer
+    if mode == "hybrid" and _MODEL_STATUS["state"] in ("loading", "failed"):
+        mode = "lexical"
+    return mode
+
+
+def _search_book(data, q_emb, tokens, k, mode):
+    """(paragraph indices, scores) of one loaded book, best first."""
+    if mode == "lexical":
+        return search_bm25(data["lexical"], tokens, k)
+    idx, scores = search_index(data["index"], data["embeddings"], q_emb, k, quant=data["quant"])
+    if mode == "dense" or not tokens:
+        return idx, scores
+    bm25 = bm25_scores(data["lexical"], tokens)
+    best_bm25 = float(bm25.max()) if bm25.shape[0] else 0.0
+    if best_bm25 <= 0:
+        return idx, scores
+    # dense hits + keyword hits, all re-scored as cosine + weighted BM25
+    lexical_idx = top_k(bm25, k)
+    cand = np.union1d(idx, lexical_idx[bm25[lexical_idx] > 0])
+    fused = np.asarray(data["embeddings"][cand], dtype=np.float32) @ q_emb
+    fused += RAG_BM25_WEIGHT * bm25[cand] / best_bm25
+    best = top_k(fused, k)
+    return cand[best], fused[best]
+
+
+def retrieve_top_k_for_subject(question, stage, section, subject, k=RAG_TOP_K, mode=None):
+    data, err = get_subject_book(stage, section, subject)
+    if err:
+        return [], err
+    mode = retrieval_mode(mode)
+    q_emb = embed_query(question) if mode != "lexical" else None
+    idx, scores = _search_book(data, q_emb, arabic_tokens(question), k, mode)
     paragraphs = data["paragraphs"]
-    embeddings = data["embeddings"]
-    q_emb = rag_embed_texts([question], is_query=True)[0].astype("float32")
-    scores = np.dot(embeddings, q_emb)
-    idx = np.argsort(-scores)[:k]
-    results = [(int(i), float(scores[i]), paragraphs[i]) for i in idx]
+    results = [(int(i), float(s), paragraphs[i]) for i, s in zip(idx, scores)]
     return results, None
 
 
-def subject_rag_answer(question, stage, section, subject):
+def retrieve_top_k_for_stage(question, books, k=RAG_TOP_K, mode=None):
+    """
+    Stage-wide search over several subject books, books = [(stage, section, subject)].
+    Books are loaded and searched one at a time and only each book's top k
+    is kept, so the search never needs every book in memory at once (and
+    never evicts a book it is still using). Books with identical content
+    are searched once. Returns
+    ([(idx, score, text, (stage, section, subject))], err), best first.
+    """
+    mode = retrieval_mode(mode)
+    q_emb = None
+    tokens = arabic_tokens(question)
+    seen = set()
+    errors = []
+    # (cosine, raw BM25, idx, text, book) of each book's top k
+    cands = []
+    for book in books:
+        if not subject_book_exists(*book):
+            continue
+        data, err = get_subject_book(*book)
+        if err:
+            errors.append(err)
+            continue
+        if data["version"] in seen:
+            continue
+        seen.add(data["version"])
+        if mode != "lexical" and q_emb is None:
+            q_emb = embed_query(question)
+        idx, _ = _search_book(data, q_emb, tokens, k, mode)
+        if not len(idx):
+            continue
+        if mode != "lexical":
+            dense = np.asarray(data["embeddings"][idx], dtype=np.float32) @ q_emb
+        else:
+            dense = np.zeros(len(idx), dtype=np.float32)
+        if mode != "dense" and tokens:
+            bm25 = bm25_scores(data["lexical"], tokens)[idx]
+        else:
+            bm25 = np.zeros(len(idx), dtype=np.float32)
+        paragraphs = data["paragraphs"]
+        cands.extend(
+            (float(d), float(b), int(i), paragraphs[i], book) for d, b, i in zip(dense, bm25, idx)
+        )
+        del data
+    if not seen:
+        return [], (errors[0] if errors else "لم يتم رفع أي كتاب لهذه المرحلة بعد.")
+
+    # each book normalizes BM25 by its own best hit, so per-book scores do
+    # not compare: re-score on cosine + BM25 normalized over all books
+    best_bm25 = max((c[1] for c in cands), default=0.0)
+    hits = []
+    for dense, bm25, i, text, book in cands:
+        if mode == "lexical":
+            score = bm25
+        elif mode == "dense" or best_bm25 <= 0:
+            score = dense
+        else:
+            score = dense + RAG_BM25_WEIGHT * bm25 / best_bm25
+        hits.append((i, score, text, book))
+    hits.sort(key=lambda h: -h[1])
+    return hits[:k], None
+
+
+def chunk_label(stage, section, subject, idx):
+    """"فقرة idx", with its heading path when the book has chunk metadata."""
+    with _RAG_CACHE_LOCK:
+        data = SUBJECT_RAG_CACHE.get(subject_rag_key(stage, section, subject))
+    chunks = data.get("chunks") if data else None
+    if chunks and idx < len(chunks) and chunks[idx]["headings"]:
+        return f"فقرة {idx} — " + " › ".join(chunks[idx]["headings"])
+    return f"فقرة {idx}"
+
+
+def subject_rag_answer(question, stage, section, subject, mode=None, stats=None, reranker=None):
     """
     استدعاء GPT للإجابة على سؤال من كتاب المادة المحدد فقط.
+    مع reranker (RAG_RERANKER): RAG_RERANK_CANDIDATES مقطع ثم أفضل RAG_RERANK_KEEP.
+    المقاطع تُرتَّب وتُقصّ حسب RAG_CONTEXT_TOKENS (app.context_packer)؛
+    stats (dict اختياري) يُملأ بعدد المقاطع والـ tokens وزمن كل مرحلة (ms).
     """
-    retrieved, err = retrieve_top_k_for_subject(question, stage, section, subject, k=RAG_TOP_K)
+    reranker = reranker_name(reranker)
+    timings = {}
+    t0 = time.perf_counter()
+    k = RAG_RERANK_CANDIDATES if reranker != "off" else RAG_TOP_K
+    retrieved, err = retrieve_top_k_for_subject(question, stage, section, subject, k=k, mode=mode)
+    timings["retrieval_ms"] = round((time.perf_counter() - t0) * 1000, 1)
     if err:
         return None, [], err
 
-    context_blocks = []
-    for idx, score, text in retrieved:
-        context_blocks.append(f"[فقرة {idx}] {text}")
-    context_str = "\n\n".join(context_blocks)
+    data, _ = get_subject_book(stage, section, subject)
+    max_chunks = None
+    if reranker != "off":
+        t0 = time.perf_counter()
+        retrieved, reranker = rerank(
+            question, retrieved, reranker, lexical=data["lexical"] if data else None
+        )
+        timings["rerank_ms"] = round((time.perf_counter() - t0) * 1000, 1)
+        max_chunks = RAG_RERANK_KEEP
+
+    def label(idx):
+        return chunk_label(stage, section, subject, idx)
+
+    retrieved, pack = pack_context(
+        retrieved, embeddings=data["embeddings"] if data else None, label=label,
+        max_chunks=max_chunks,
+    )
+    context_str = "\n\n".join(f"[{label(idx)}] {text}" for idx, score, text in retrieved)
 
     prompt = f"""
 السؤال من الطالب:
@@ -170,38 +832,147 @@ def subject_rag_answer(question, stage, section, subject):
 
 أعطِ جوابك النهائي للطالب بأسلوب معلم يشرح الدرس، ملتزماً بالقواعد في رسالة النظام.
 """
+    pack["prompt_tokens"] = estimate_tokens(RAG_SYSTEM_PROMPT) + estimate_tokens(prompt)
+    pack["reranker"] = reranker
+    pack["timings"] = timings
+    if stats is not None:
+        stats.update(pack)
 
     answer, api_err = None, None
+    t0 = time.perf_counter()
     try:
         answer, api_err = openai_chat_completion(RAG_SYSTEM_PROMPT, prompt)
     except Exception as e:
         api_err = str(e)
+    timings["llm_ms"] = round((time.perf_counter() - t0) * 1000, 1)
 
     if api_err:
         return None, retrieved, api_err
     return (answer or "").strip(), retrieved, None
 
 
-def save_uploaded_book(file_storage, stage, section, subject):
-    """
-    تستعمل في صفحة الويب لرفع / استبدال كتاب المادة.
-    """
-    docx_path, cleaned_path = subject_book_paths(stage, section, subject)
-    os.makedirs(os.path.dirname(docx_path), exist_ok=True)
-    file_storage.save(docx_path)
-    if os.path.exists(cleaned_path):
-        os.remove(cleaned_path)
-    key = subject_rag_key(stage, section, subject)
-    if key in SUBJECT_RAG_CACHE:
-        del SUBJECT_RAG_CACHE[key]
-    ok, err = load_subject_book_into_memory(stage, section, subject)
-    return ok, err
+def upload_staging_path(stage, section, subject, tag):
+    docx_path, _ = subject_book_paths(stage, section, subject)
+    return f"{docx_path}.upload-{tag}"
+
 
+# ------------------ ANSWER CACHE (/api/book/query) ------------------
+# (stage, section, subject, book version, lang, retrieval mode, reranker) ->
+#   {"entries": [{"question", "reply", "intent", "stored_at"}], "matrix": question vectors}
+# entries are oldest first; the book version is its paragraph content hash
+_ANSWER_CACHE = {}
+_ANSWER_CACHE_LOCK = threading.Lock()
+_ANSWER_CACHE_COUNTS = {"hits": 0, "misses": 0, "stores": 0}
 
-def run_book_rag(stage, section, subject, question, lang="ar-SA"):
+
+def subject_book_version(stage, section, subject):
+    data, _ = get_subject_book(stage, section, subject)
+    return data["version"] if data else None
+
+
+def _answer_key(stage, section, subject, version, lang, mode, reranker):
+    # answers retrieved differently are not interchangeable
+    return (stage, section, subject, version, lang, retrieval_mode(mode), reranker_name(reranker))
+
+
+def _answer_slot_expire(slot, now):
+    entries = slot["entries"]
+    drop = 0
+    while drop < len(entries) and now - entries[drop]["stored_at"] > RAG_ANSWER_CACHE_TTL:
+        drop += 1
+    if drop:
+        del entries[:drop]
+        slot["matrix"] = slot["matrix"][drop:]
+
+
+def cached_book_answer(stage, section, subject, question, lang="ar-SA", mode=None, reranker=None):
+    """
+    Stored answer for a semantically equivalent earlier question on the same
+    book version, retrieval mode and reranker:
+    {"reply", "intent", "similarity", "question"} or None.
+    """
+    if RAG_ANSWER_CACHE_SIZE <= 0 or not (question or "").strip():
+        return None
+    try:
+        version = subject_book_version(stage, section, subject)
+        q = embed_query(question) if version else None
+    except Exception as e:
+        print("answer cache lookup skipped:", e)
+        return None
+    if q is None:
+        return None
+    key = _answer_key(stage, section, subject, version, lang, mode, reranker)
+    with _ANSWER_CACHE_LOCK:
+        slot = _ANSWER_CACHE.get(key)
+        if slot:
+            _answer_slot_expire(slot, time.time())
+        if slot and slot["entries"]:
+            sims = slot["matrix"] @ q
+            best = int(np.argmax(sims))
+            if sims[best] >= RAG_ANSWER_CACHE_THRESHOLD:
+                _ANSWER_CACHE_COUNTS["hits"] += 1
+                e = slot["entries"][best]
+                return {
+                    "reply": e["reply"],
+                    "intent": e["intent"],
+                    "similarity": round(float(sims[best]), 4),
+                    "question": e["question"],
+                }
+        _ANSWER_CACHE_COUNTS["misses"] += 1
+    return None
+
+
+def store_book_answer(stage, section, subject, question, reply, intent=None, lang="ar-SA",
+                      mode=None, reranker=None):
+    if RAG_ANSWER_CACHE_SIZE <= 0:
+        return
+    try:
+        version = subject_book_version(stage, section, subject)
+        q = embed_query(question) if version else None
+    except Exception:
+        return
+    if q is None:
+        return
+    key = _answer_key(stage, section, subject, version, lang, mode, reranker)
+    with _ANSWER_CACHE_LOCK:
+        slot = _ANSWER_CACHE.setdefault(
+            key, {"entries": [], "matrix": np.empty((0, q.shape[0]), dtype=np.float32)}
+        )
+        slot["entries"].append(
+            {"question": question, "reply": reply, "intent": intent, "stored_at": time.time()}
+        )
+        slot["matrix"] = np.vstack([slot["matrix"], q[None, :]])
+        if len(slot["entries"]) > RAG_ANSWER_CACHE_SIZE:
+            del slot["entries"][0]
+            slot["matrix"] = slot["matrix"][1:]
+        _ANSWER_CACHE_COUNTS["stores"] += 1
+
+
+def drop_cached_answers(stage, section, subject):
+    with _ANSWER_CACHE_LOCK:
+        for key in [k for k in _ANSWER_CACHE if k[:3] == (stage, section, subject)]:
+            del _ANSWER_CACHE[key]
+
+
+def answer_cache_stats():
+    with _ANSWER_CACHE_LOCK:
+        return {
+            **_ANSWER_CACHE_COUNTS,
+            "books": len(_ANSWER_CACHE),
+            "entries": sum(len(s["entries"]) for s in _ANSWER_CACHE.values()),
+            "threshold": RAG_ANSWER_CACHE_THRESHOLD,
+        }
+
+
+def run_book_rag(stage, section, subject, question, lang="ar-SA", intent=None, mode=None, stats=None,
+                 reranker=None):
     """
     دالة وسيطة تشغّل RAG على كتاب المادة المحددة فقط.
     ترجع نصّ الجواب الجاهز للطالب.
+    الأجوبة الناجحة تُحفظ في answer cache (cached_book_answer)، لا الرفض ولا أجوبة بلا مقاطع.
+    mode: "hybrid" / "dense" / "lexical" (see retrieval_mode).
+    stats: optional dict filled by subject_rag_answer (packed context size, timings).
+    reranker: "off" / "lexical" / "cross-encoder" (default RAG_RERANKER).
     """
     stage = unquote_plus(stage)
     section = unquote_plus(section)
@@ -214,7 +985,10 @@ def run_book_rag(stage, section, subject, question, lang="ar-SA"):
     if not subject_book_exists(stage, section, subject):
         return "لم يتم رفع كتاب لهذه المادة بعد."
 
-    answer, retrieved, err = subject_rag_answer(question, stage, section, subject)
+    mode = retrieval_mode(mode)
+    answer, retrieved, err = subject_rag_answer(
+        question, stage, section, subject, mode=mode, stats=stats, reranker=reranker
+    )
     if err:
         print("RAG error:", err)
         return "حدث خطأ في خادم الذكاء الاصطناعي أثناء قراءة الكتاب، حاول مرة أخرى لاحقاً."
@@ -222,7 +996,18 @@ def run_book_rag(stage, section, subject, question, lang="ar-SA"):
     if not (answer or "").strip():
         return "لا أستطيع إيجاد جواب واضح لهذا السؤال داخل الكتاب."
 
-    return (answer or "").strip()
+    answer = answer.strip()
+    if mode == "lexical":
+        # the answer cache is keyed by question embeddings
+        return answer
+    if not retrieved or NOT_IN_BOOK_REPLY.rstrip(".") in answer:
+        # a refusal may be right for this wording only; never replay it
+        return answer
+    store_book_answer(
+        stage, section, subject, question, answer, intent=intent, lang=lang, mode=mode,
+        reranker=reranker,
+    )
+    return answer
 
 
 def wrap_contexts(retrieved):
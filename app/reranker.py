@@ -0,0 +1,121 @@
+# reranker.py
+"""
+Optional second retrieval stage for book answers: the first stage returns
+RAG_RERANK_CANDIDATES chunks, they are re-scored here and only the best
+RAG_RERANK_KEEP go into the prompt.
+
+RAG_RERANKER:
+    off            first-stage order, RAG_TOP_K chunks (no re-ranking)
+    lexical        question/chunk overlap on normalized Arabic tokens
+                   (idf-weighted coverage + bigram matches) blended with the
+                   first-stage score; pure numpy/Python, no model
+    cross-encoder  a small local CPU cross-encoder (RAG_CROSS_ENCODER_MODEL,
+                   sentence-transformers); falls back to lexical if it
+                   cannot be loaded
+"""
+import threading
+import time
+
+import numpy as np
+
+from app.config import RAG_RERANKER, RAG_CROSS_ENCODER_MODEL
+from app.lexical_index import arabic_tokens
+
+RERANKERS = ("off", "lexical", "cross-encoder")
+
+CROSS_ENCODER = None
+_CE_LOCK = threading.Lock()
+_CE_STATUS = {"state": "idle", "error": None, "load_seconds": None}
+
+
+def reranker_name(name=None):
+    """Effective reranker (RAG_RERANKER when not given or not a string)."""
+    if not isinstance(name, str):
+        name = None
+    name = (name or RAG_RERANKER or "off").strip().lower()
+    return name if name in RERANKERS else "off"
+
+
+def get_cross_encoder():
+    """CrossEncoder for RAG_CROSS_ENCODER_MODEL, loaded once; None if it failed."""
+    global CROSS_ENCODER
+    if CROSS_ENCODER is not None or _CE_STATUS["state"] == "failed":
+        return CROSS_ENCODER
+    with _CE_LOCK:
+        if CROSS_ENCODER is not None or _CE_STATUS["state"] == "failed":
+            return CROSS_ENCODER
+        _CE_STATUS["state"] = "loading"
+        print("🔧 Loading cross-encoder re-ranker...")
+        t0 = time.time()
+        try:
+            from sentence_transformers import CrossEncoder
+            CROSS_ENCODER = CrossEncoder(RAG_CROSS_ENCODER_MODEL, device="cpu")
+        except Exception as e:
+            print("⚠️ cross-encoder unavailable, re-ranking lexically:", e)
+            _CE_STATUS.update(state="failed", error=str(e))
+            return None
+        _CE_STATUS.update(state="ready", load_seconds=round(time.time() - t0, 2))
+        print(f"✅ cross-encoder ready in {_CE_STATUS['load_seconds']}s")
+    return CROSS_ENCODER
+
+
+def reranker_status():
+    return {"reranker": reranker_name(), "cross_encoder": RAG_CROSS_ENCODER_MODEL, **_CE_STATUS}
+
+
+def _normalized(scores):
+    scores = np.asarray(scores, dtype=np.float32)
+    span = scores.max() - scores.min()
+    return (scores - scores.min()) / span if span > 0 else np.ones_like(scores)
+
+
+def lexical_scores(question, retrieved, lexical=None):
+    """
+    0.5 * first-stage score (min-max over the candidates)
+    + 0.4 * share of the question's idf weight found in the chunk
+    + 0.1 * share of the question's token bigrams found in the chunk.
+    lexical: the book's BM25 index, for idf weights (else all terms weigh 1).
+    """
+    q = arabic_tokens(question)
+    terms = set(q)
+    if lexical is not None:
+        weights = {
+            t: float(lexical["idf"][lexical["terms"][t]]) if t in lexical["terms"] else 0.0
+            for t in terms
+        }
+    else:
+        weights = dict.fromkeys(terms, 1.0)
+    total = sum(weights.values()) or 1.0
+    q_bigrams = set(zip(q, q[1:]))
+
+    out = []
+    for _, _, text in retrieved:
+        toks = arabic_tokens(text)
+        have = set(toks)
+        coverage = sum(w for t, w in weights.items() if t in have) / total
+        bigrams = len(q_bigrams & set(zip(toks, toks[1:]))) / len(q_bigrams) if q_bigrams else 0.0
+        out.append(0.4 * coverage + 0.1 * bigrams)
+    first = _normalized([s for _, s, _ in retrieved])
+    return 0.5 * first + np.asarray(out, dtype=np.float32)
+
+
+def rerank(question, retrieved, method=None, lexical=None):
+    """
+    retrieved [(idx, score, text)] -> (same chunks re-scored, best first,
+    reranker actually used).
+    """
+    method = reranker_name(method)
+    if method == "off" or len(retrieved) < 2:
+        # nothing to re-order, but report the reranker that was asked for
+        return retrieved, method
+    scores = None
+    if method == "cross-encoder":
+        model = get_cross_encoder()
+        if model is not None:
+            scores = np.asarray(model.predict([(question, t) for _, _, t in retrieved]), dtype=np.float32)
+        else:
+            method = "lexical"
+    if scores is None:
+        scores = lexical_scores(question, retrieved, lexical)
+    order = np.argsort(-scores, kind="stable")
+    return [(retrieved[i][0], float(scores[i]), retrieved[i][2]) for i in order], method
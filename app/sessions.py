@@ -0,0 +1,91 @@
+# sessions.py
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from app.config import SESSION_TTL_SECONDS, SESSION_MAX, SESSIONS_PERSIST
+
+if SESSIONS_PERSIST:
+    from app import sqlite_store
+
+# ------------------ QUIZ SESSIONS ------------------
+# in-memory: sid -> (last_used, data), oldest first (LRU order)
+_SESSIONS = OrderedDict()
+_LOCK = threading.Lock()
+
+# prune the persisted table every N creations instead of on every request
+_PRUNE_EVERY = 50
+_created = 0
+
+
+def new_session_id():
+    # uuid4: no collisions between workers or after a restart
+    return "sess_" + uuid.uuid4().hex
+
+
+def _expired_before(now):
+    return now - SESSION_TTL_SECONDS
+
+
+def _prune_memory(now):
+    cutoff = _expired_before(now)
+    while _SESSIONS:
+        sid, (last_used, _) = next(iter(_SESSIONS.items()))
+        if last_used >= cutoff and len(_SESSIONS) <= SESSION_MAX:
+            break
+        del _SESSIONS[sid]
+
+
+def create_session(data):
+    global _created
+    sid = new_session_id()
+    now = time.time()
+    if SESSIONS_PERSIST:
+        sqlite_store.session_put(sid, data, now)
+        _created += 1
+        if _created % _PRUNE_EVERY == 0:
+            sqlite_store.session_prune(_expired_before(now), SESSION_MAX)
+        return sid
+    with _LOCK:
+        _SESSIONS[sid] = (now, data)
+        _prune_memory(now)
+    return sid
+
+
+def get_session(sid):
+    """Session dict, or None if unknown / expired. Call save_session after changing it."""
+    if not sid:
+        return None
+    now = time.time()
+    if SESSIONS_PERSIST:
+        # touched like the in-memory store: an active quiz never expires mid-way
+        return sqlite_store.session_get(sid, _expired_before(now), now)
+    with _LOCK:
+        item = _SESSIONS.get(sid)
+        if item is None:
+            return None
+        if item[0] < _expired_before(now):
+            del _SESSIONS[sid]
+            return None
+        _SESSIONS[sid] = (now, item[1])
+        _SESSIONS.move_to_end(sid)
+        return item[1]
+
+
+def save_session(sid, data):
+    now = time.time()
+    if SESSIONS_PERSIST:
+        sqlite_store.session_put(sid, data, now)
+        return
+    with _LOCK:
+        _SESSIONS[sid] = (now, data)
+        _SESSIONS.move_to_end(sid)
+
+
+def delete_session(sid):
+    if SESSIONS_PERSIST:
+        sqlite_store.session_delete(sid)
+        return
+    with _LOCK:
+        _SESSIONS.pop(sid, None)
@@ -0,0 +1,736 @@
+# sqlite_store.py
+import contextlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+
+from app.config import (
+    SQLITE_PATH, COLLECTION_PATHS, load_json,
+    attendance_partition_path, attendance_partition_months
+)
+
+# ------------------ CONNECTION ------------------
+# one connection per thread, WAL so readers never block the writer
+
+_LOCAL = threading.local()
+
+# change_log rows kept per collection; a worker further behind reloads it all
+CHANGE_LOG_KEEP = 2000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS kv (
+    collection TEXT NOT NULL,
+    key        TEXT NOT NULL,
+    value      TEXT NOT NULL,
+    PRIMARY KEY (collection, key)
+);
+
+CREATE TABLE IF NOT EXISTS quizzes (
+    quiz_id    TEXT PRIMARY KEY,
+    stage      TEXT,
+    section    TEXT,
+    subject    TEXT,
+    created_at TEXT,
+    body       TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_quizzes_meta ON quizzes (stage, section, subject);
+
+CREATE TABLE IF NOT EXISTS quiz_totals (
+    quiz_id        TEXT PRIMARY KEY,
+    total_attempts INTEGER NOT NULL DEFAULT 0,
+    total_correct  INTEGER NOT NULL DEFAULT 0,
+    total_wrong    INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS quiz_stats (
+    quiz_id  TEXT NOT NULL,
+    qid      TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    correct  INTEGER NOT NULL DEFAULT 0,
+    wrong    INTEGER NOT NULL DEFAULT 0,
+    wrongs   TEXT NOT NULL DEFAULT '{}',
+    PRIMARY KEY (quiz_id, qid)
+);
+
+CREATE TABLE IF NOT EXISTS attendance (
+    date    TEXT NOT NULL,
+    stage   TEXT NOT NULL,
+    section TEXT NOT NULL,
+    subject TEXT NOT NULL DEFAULT '',
+    student TEXT NOT NULL,
+    present INTEGER NOT NULL,
+    PRIMARY KEY (date, stage, section, subject, student)
+);
+CREATE INDEX IF NOT EXISTS idx_attendance_section
+    ON attendance (stage, section, subject, date);
+
+CREATE TABLE IF NOT EXISTS progress (
+    student     TEXT NOT NULL,
+    quiz_id     TEXT NOT NULL,
+    score       INTEGER,
+    total       INTEGER,
+    finished_at TEXT,
+    PRIMARY KEY (student, quiz_id)
+);
+CREATE INDEX IF NOT EXISTS idx_progress_quiz ON progress (quiz_id);
+
+CREATE TABLE IF NOT EXISTS quiz_sessions (
+    sid        TEXT PRIMARY KEY,
+    data       TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_quiz_sessions_updated ON quiz_sessions (updated_at);
+
+-- bumped on every write; workers compare it to reload stale caches
+CREATE TABLE IF NOT EXISTS changes (
+    collection TEXT PRIMARY KEY,
+    version    INTEGER NOT NULL DEFAULT 0
+);
+
+-- which entry each version changed ('[]' = the whole collection), so a
+-- stale worker reloads only those entries
+CREATE TABLE IF NOT EXISTS change_log (
+    collection TEXT NOT NULL,
+    version    INTEGER NOT NULL,
+    key        TEXT NOT NULL,
+    PRIMARY KEY (collection, version)
+);
+"""
+
+def get_conn():
+    conn = getattr(_LOCAL, "conn", None)
+    if conn is None:
+        os.makedirs(os.path.dirname(SQLITE_PATH) or ".", exist_ok=True)
+        # autocommit; transactions are opened explicitly by transaction()
+        conn = sqlite3.connect(SQLITE_PATH, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(SCHEMA)
+        _LOCAL.conn = conn
+    return conn
+
+
+@contextlib.contextmanager
+def transaction(immediate=False):
+    """
+    Nestable transaction on this thread's connection. immediate=True takes the
+    database write lock up front, which serializes writers across processes.
+    """
+    conn = get_conn()
+    depth = getattr(_LOCAL, "depth", 0)
+    if depth == 0:
+        conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+    _LOCAL.depth = depth + 1
+    try:
+        yield conn
+    except BaseException:
+        _LOCAL.depth = depth
+        if depth == 0:
+            conn.rollback()
+        raise
+    _LOCAL.depth = depth
+    if depth == 0:
+        conn.commit()
+
+
+def _change_key(name, keys):
+    """Cached entry a write at `keys` touches: a quiz, else a top-level key."""
+    if name == "quizzes" and keys and keys[0] == "quizzes":
+        return list(keys[:2]) if len(keys) > 1 else []
+    return list(keys[:1])
+
+
+def _bump_version(conn, name, keys):
+    conn.execute(
+        "INSERT INTO changes (collection, version) VALUES (?, 1) "
+        "ON CONFLICT (collection) DO UPDATE SET version = version + 1",
+        (name,),
+    )
+    version = conn.execute(
+        "SELECT version FROM changes WHERE collection = ?", (name,)
+    ).fetchone()[0]
+    conn.execute(
+        "INSERT OR REPLACE INTO change_log (collection, version, key) VALUES (?, ?, ?)",
+        (name, version, _dumps(_change_key(name, list(keys)))),
+    )
+    conn.execute(
+        "DELETE FROM change_log WHERE collection = ? AND version <= ?",
+        (name, version - CHANGE_LOG_KEEP),
+    )
+    return version
+
+
+def collection_versions():
+    return dict(get_conn().execute("SELECT collection, version FROM changes"))
+
+
+def changed_entries(name, since):
+    """
+    Entry paths of `name` written after version `since` (see _change_key),
+    or None when the whole collection must be reloaded: a full rewrite, or
+    the log no longer reaches back to `since`.
+    """
+    rows = get_conn().execute(
+        "SELECT version, key FROM change_log WHERE collection = ? AND version > ? "
+        "ORDER BY version",
+        (name, since),
+    ).fetchall()
+    if not rows or rows[0][0] != since + 1:
+        return None
+    paths = []
+    for _, key in rows:
+        path = json.loads(key)
+        if not path:
+            return None
+        if path not in paths:
+            paths.append(path)
+    return paths
+
+
+def _dumps(obj):
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+
+def _set_path(obj, keys, value):
+    node = obj
+    for k in keys[:-1]:
+        node = node.setdefault(k, {})
+    node[keys[-1]] = value
+
+
+def _del_path(obj, keys):
+    node = obj
+    for k in keys[:-1]:
+        node = node.get(k)
+        if not isinstance(node, dict):
+            return
+    node.pop(keys[-1], None)
+
+
+# ------------------ KV (settings / robots / stages) ------------------
+
+
+def _kv_upsert(conn, collection, key, value):
+    conn.execute(
+        "INSERT INTO kv (collection, key, value) VALUES (?, ?, ?) "
+        "ON CONFLICT (collection, key) DO UPDATE SET value = excluded.value",
+        (collection, key, _dumps(value)),
+    )
+
+
+def _kv_get(conn, collection, key):
+    row = conn.execute(
+        "SELECT value FROM kv WHERE collection = ? AND key = ?", (collection, key)
+    ).fetchone()
+    return json.loads(row[0]) if row else None
+
+
+def _kv_set(conn, collection, keys, value):
+    if not keys:
+        conn.execute("DELETE FROM kv WHERE collection = ?", (collection,))
+        for k, v in value.items():
+            _kv_upsert(conn, collection, k, v)
+        return
+    top = keys[0]
+    if len(keys) > 1:
+        cur = _kv_get(conn, collection, top) or {}
+        _set_path(cur, keys[1:], value)
+        value = cur
+    _kv_upsert(conn, collection, top, value)
+
+
+def _kv_delete(conn, collection, keys):
+    if len(keys) == 1:
+        conn.execute(
+            "DELETE FROM kv WHERE collection = ? AND key = ?", (collection, keys[0])
+        )
+        return
+    cur = _kv_get(conn, collection, keys[0])
+    if cur is not None:
+        _del_path(cur, keys[1:])
+        _kv_upsert(conn, collection, keys[0], cur)
+
+
+def _kv_load(conn, collection):
+    rows = conn.execute(
+        "SELECT key, value FROM kv WHERE collection = ? ORDER BY rowid", (collection,)
+    ).fetchall()
+    return {k: json.loads(v) for k, v in rows}
+
+
+# ------------------ QUIZZES ------------------
+
+
+def _quiz_upsert(conn, quiz_id, quiz):
+    meta = quiz.get("meta", {}) or {}
+    conn.execute(
+        "INSERT INTO quizzes (quiz_id, stage, section, subject, created_at, body) "
+        "VALUES (?, ?, ?, ?, ?, ?) "
+        "ON CONFLICT (quiz_id) DO UPDATE SET stage = excluded.stage, "
+        "section = excluded.section, subject = excluded.subject, "
+        "created_at = excluded.created_at, body = excluded.body",
+        (
+            quiz_id,
+            meta.get("stage"),
+            meta.get("section"),
+            meta.get("subject"),
+            quiz.get("created_at"),
+            _dumps(quiz),
+        ),
+    )
+
+
+def _quizzes_set(conn, keys, value):
+    if not keys:
+        conn.execute("DELETE FROM quizzes")
+        for qid, quiz in (value.get("quizzes") or {}).items():
+            _quiz_upsert(conn, qid, quiz)
+        _kv_upsert(conn, "quizzes", "active_id", value.get("active_id"))
+    elif keys[0] == "quizzes" and len(keys) == 1:
+        conn.execute("DELETE FROM quizzes")
+        for qid, quiz in value.items():
+            _quiz_upsert(conn, qid, quiz)
+    elif keys[0] == "quizzes" and len(keys) == 2:
+        _quiz_upsert(conn, keys[1], value)
+    elif keys[0] == "quizzes":
+        row = conn.execute(
+            "SELECT body FROM quizzes WHERE quiz_id = ?", (keys[1],)
+        ).fetchone()
+        quiz = json.loads(row[0]) if row else {}
+        _set_path(quiz, keys[2:], value)
+        _quiz_upsert(conn, keys[1], quiz)
+    else:
+        _kv_set(conn, "quizzes", keys, value)
+
+
+def _quizzes_delete(conn, keys):
+    if keys[0] == "quizzes" and len(keys) == 2:
+        conn.execute("DELETE FROM quizzes WHERE quiz_id = ?", (keys[1],))
+    elif keys[0] == "quizzes":
+        raise ValueError(f"unsupported quizzes key path: {keys}")
+    else:
+        _kv_delete(conn, "quizzes", keys)
+
+
+def _quizzes_load(conn):
+    rows = conn.execute("SELECT quiz_id, body FROM quizzes ORDER BY rowid").fetchall()
+    return {
+        "active_id": _kv_get(conn, "quizzes", "active_id"),
+        "quizzes": {qid: json.loads(body) for qid, body in rows},
+    }
+
+
+# ------------------ QUIZ STATS ------------------
+
+
+def _quiz_stats_write(conn, quiz_id, entry):
+    conn.execute("DELETE FROM quiz_stats WHERE quiz_id = ?", (quiz_id,))
+    conn.execute(
+        "INSERT INTO quiz_totals (quiz_id, total_attempts, total_correct, total_wrong) "
+        "VALUES (?, ?, ?, ?) "
+        "ON CONFLICT (quiz_id) DO UPDATE SET total_attempts = excluded.total_attempts, "
+        "total_correct = excluded.total_correct, total_wrong = excluded.total_wrong",
+        (
+            quiz_id,
+            entry.get("total_attempts", 0),
+            entry.get("total_correct", 0),
+            entry.get("total_wrong", 0),
+        ),
+    )
+    conn.executemany(
+        "INSERT INTO quiz_stats (quiz_id, qid, attempts, correct, wrong, wrongs) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        [
+            (
+                quiz_id,
+                qid,
+                qs.get("attempts", 0),
+                qs.get("correct", 0),
+                qs.get("wrong", 0),
+                _dumps(qs.get("wrongs", {})),
+            )
+            for qid, qs in (entry.get("questions") or {}).items()
+        ],
+    )
+
+
+def _quiz_stats_set(conn, keys, value):
+    if not keys:
+        conn.execute("DELETE FROM quiz_stats")
+        conn.execute("DELETE FROM quiz_totals")
+        for quiz_id, entry in value.items():
+            _quiz_stats_write(conn, quiz_id, entry)
+    elif len(keys) == 1:
+        _quiz_stats_write(conn, keys[0], value)
+    else:
+        raise ValueError(f"unsupported quiz_stats key path: {keys}")
+
+
+def _quiz_stats_delete(conn, keys):
+    if len(keys) != 1:
+        raise ValueError(f"unsupported quiz_stats key path: {keys}")
+    conn.execute("DELETE FROM quiz_stats WHERE quiz_id = ?", (keys[0],))
+    conn.execute("DELETE FROM quiz_totals WHERE quiz_id = ?", (keys[0],))
+
+
+def _quiz_stats_load(conn, quiz_id=None):
+    where, params = (" WHERE quiz_id = ?", (quiz_id,)) if quiz_id is not None else ("", ())
+    out = {}
+    for quiz_id, ta, tc, tw in conn.execute(
+        "SELECT quiz_id, total_attempts, total_correct, total_wrong "
+        f"FROM quiz_totals{where} ORDER BY rowid", params
+    ):
+        out[quiz_id] = {
+            "questions": {},
+            "total_attempts": ta,
+            "total_correct": tc,
+            "total_wrong": tw,
+        }
+    for quiz_id, qid, attempts, correct, wrong, wrongs in conn.execute(
+        f"SELECT quiz_id, qid, attempts, correct, wrong, wrongs FROM quiz_stats{where} "
+        "ORDER BY rowid", params
+    ):
+        entry = out.setdefault(
+            quiz_id,
+            {"questions": {}, "total_attempts": 0, "total_correct": 0, "total_wrong": 0},
+        )
+        entry["questions"][qid] = {
+            "attempts": attempts,
+            "correct": correct,
+            "wrong": wrong,
+            "wrongs": json.loads(wrongs),
+        }
+    return out
+
+
+# ------------------ ATTENDANCE ------------------
+
+
+def _attendance_rows(prefix, node):
+    if len(prefix) < 3:
+        for k, v in node.items():
+            yield from _attendance_rows(prefix + [k], v)
+        return
+    date, stage, section = prefix
+    for student, present in node.items():
+        if student == "__subjects__":
+            for subject, smap in present.items():
+                for st, p in smap.items():
+                    yield (date, stage, section, subject, st, int(bool(p)))
+        else:
+            yield (date, stage, section, "", student, int(bool(present)))
+
+
+def _attendance_where(keys):
+    cols = ("date", "stage", "section")[: len(keys)]
+    if not cols:
+        return "", ()
+    return " WHERE " + " AND ".join(f"{c} = ?" for c in cols), tuple(keys)
+
+
+def _attendance_set(conn, keys, value):
+    if len(keys) > 3:
+        raise ValueError(f"unsupported attendance key path: {keys}")
+    where, params = _attendance_where(keys)
+    conn.execute("DELETE FROM attendance" + where, params)
+    conn.executemany(
+        "INSERT INTO attendance (date, stage, section, subject, student, present) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        list(_attendance_rows(list(keys), value)),
+    )
+
+
+def _attendance_delete(conn, keys):
+    if len(keys) > 3:
+        raise ValueError(f"unsupported attendance key path: {keys}")
+    where, params = _attendance_where(keys)
+    conn.execute("DELETE FROM attendance" + where, params)
+
+
+def _attendance_tree(rows):
+    out = {}
+    for date, stage, section, subject, student, present in rows:
+        secnode = out.setdefault(date, {}).setdefault(stage, {}).setdefault(section, {})
+        if subject:
+            secnode.setdefault("__subjects__", {}).setdefault(subject, {})[student] = bool(present)
+        else:
+            secnode[student] = bool(present)
+    return out
+
+
+def _attendance_load(conn):
+    return _attendance_tree(conn.execute(
+        "SELECT date, stage, section, subject, student, present FROM attendance "
+        "ORDER BY date, rowid"
+    ))
+
+
+def attendance_month(month):
+    """One month partition {date: {stage: {section: ...}}} (primary-key range scan)."""
+    return _attendance_tree(get_conn().execute(
+        "SELECT date, stage, section, subject, student, present FROM attendance "
+        "WHERE date BETWEEN ? AND ? ORDER BY date, rowid",
+        (month + "-00", month + "-99"),
+    ))
+
+
+def attendance_range(stage, section, subject=None, date_from=None, date_to=None,
+                     limit=None, offset=0):
+    """
+    [(date, {student: bool})] newest first for one section (and subject),
+    paginated by date, served from the (stage, section, subject, date) index.
+    """
+    where = "stage = ? AND section = ? AND subject = ?"
+    params = [stage, section, subject or ""]
+    if date_from:
+        where += " AND date >= ?"
+        params.append(date_from)
+    if date_to:
+        where += " AND date <= ?"
+        params.append(date_to)
+    conn = get_conn()
+    dates = [
+        r[0] for r in conn.execute(
+            f"SELECT DISTINCT date FROM attendance WHERE {where} "
+            "ORDER BY date DESC LIMIT ? OFFSET ?",
+            params + [-1 if limit is None else limit, offset],
+        )
+    ]
+    if not dates:
+        return []
+    rows = {d: {} for d in dates}
+    marks = ",".join("?" * len(dates))
+    for date, student, present in conn.execute(
+        f"SELECT date, student, present FROM attendance WHERE {where} "
+        f"AND date IN ({marks}) ORDER BY rowid",
+        params + dates,
+    ):
+        rows[date][student] = bool(present)
+    return list(rows.items())
+
+
+# ------------------ PROGRESS ------------------
+
+
+def _progress_insert(conn, student, quiz_id, rec):
+    conn.execute(
+        "INSERT INTO progress (student, quiz_id, score, total, finished_at) "
+        "VALUES (?, ?, ?, ?, ?) "
+        "ON CONFLICT (student, quiz_id) DO UPDATE SET score = excluded.score, "
+        "total = excluded.total, finished_at = excluded.finished_at",
+        (student, quiz_id, rec.get("score"), rec.get("total"), rec.get("finished_at")),
+    )
+
+
+def _progress_set(conn, keys, value):
+    if not keys:
+        conn.execute("DELETE FROM progress")
+        for student, udata in value.items():
+            for quiz_id, rec in (udata.get("completed") or {}).items():
+                _progress_insert(conn, student, quiz_id, rec)
+    elif len(keys) == 1:
+        conn.execute("DELETE FROM progress WHERE student = ?", (keys[0],))
+        for quiz_id, rec in (value.get("completed") or {}).items():
+            _progress_insert(conn, keys[0], quiz_id, rec)
+    elif len(keys) == 3 and keys[1] == "completed":
+        _progress_insert(conn, keys[0], keys[2], value)
+    else:
+        raise ValueError(f"unsupported progress key path: {keys}")
+
+
+def _progress_delete(conn, keys):
+    if len(keys) == 1:
+        conn.execute("DELETE FROM progress WHERE student = ?", (keys[0],))
+    elif len(keys) == 3 and keys[1] == "completed":
+        conn.execute(
+            "DELETE FROM progress WHERE student = ? AND quiz_id = ?", (keys[0], keys[2])
+        )
+    else:
+        raise ValueError(f"unsupported progress key path: {keys}")
+
+
+def _progress_load(conn, student=None):
+    where, params = (" WHERE student = ?", (student,)) if student is not None else ("", ())
+    out = {}
+    for student, quiz_id, score, total, finished_at in conn.execute(
+        f"SELECT student, quiz_id, score, total, finished_at FROM progress{where} "
+        "ORDER BY rowid", params
+    ):
+        out.setdefault(student, {}).setdefault("completed", {})[quiz_id] = {
+            "score": score,
+            "total": total,
+            "finished_at": finished_at,
+        }
+    return out
+
+
+# ------------------ QUIZ SESSIONS ------------------
+
+
+def session_get(sid, min_updated_at, now):
+    """Session data if not expired; reading it counts as use (updated_at = now)."""
+    with transaction() as conn:
+        row = conn.execute(
+            "SELECT data FROM quiz_sessions WHERE sid = ? AND updated_at >= ?",
+            (sid, min_updated_at),
+        ).fetchone()
+        if row is None:
+            return None
+        conn.execute("UPDATE quiz_sessions SET updated_at = ? WHERE sid = ?", (now, sid))
+    return json.loads(row[0])
+
+
+def session_put(sid, data, updated_at):
+    with transaction() as conn:
+        conn.execute(
+            "INSERT INTO quiz_sessions (sid, data, updated_at) VALUES (?, ?, ?) "
+            "ON CONFLICT (sid) DO UPDATE SET data = excluded.data, "
+            "updated_at = excluded.updated_at",
+            (sid, _dumps(data), updated_at),
+        )
+
+
+def session_delete(sid):
+    with transaction() as conn:
+        conn.execute("DELETE FROM quiz_sessions WHERE sid = ?", (sid,))
+
+
+def session_prune(min_updated_at, max_sessions):
+    """Drop expired sessions, then the least recently used beyond max_sessions."""
+    with transaction() as conn:
+        conn.execute("DELETE FROM quiz_sessions WHERE updated_at < ?", (min_updated_at,))
+        conn.execute(
+            "DELETE FROM quiz_sessions WHERE sid IN ("
+            "SELECT sid FROM quiz_sessions ORDER BY updated_at DESC LIMIT -1 OFFSET ?)",
+            (max_sessions,),
+        )
+
+
+# ------------------ PUBLIC API (same shape as the JSON backend) ------------------
+
+_SETTERS = {
+    "quizzes": _quizzes_set,
+    "quiz_stats": _quiz_stats_set,
+    "attendance": _attendance_set,
+    "progress": _progress_set,
+}
+_DELETERS = {
+    "quizzes": _quizzes_delete,
+    "quiz_stats": _quiz_stats_delete,
+    "attendance": _attendance_delete,
+    "progress": _progress_delete,
+}
+_LOADERS = {
+    "quizzes": _quizzes_load,
+    "quiz_stats": _quiz_stats_load,
+    "attendance": _attendance_load,
+    "progress": _progress_load,
+}
+
+
+def set_value(name, keys, value):
+    """
+    Persist `value` at key path `keys` of collection `name` ([] = whole collection).
+    Returns the collection's new version.
+    """
+    with transaction() as conn:
+        if name in _SETTERS:
+            _SETTERS[name](conn, list(keys), value)
+        else:
+            _kv_set(conn, name, list(keys), value)
+        return _bump_version(conn, name, keys)
+
+
+def delete_value(name, keys):
+    with transaction() as conn:
+        if name in _DELETERS:
+            _DELETERS[name](conn, list(keys))
+        else:
+            _kv_delete(conn, name, list(keys))
+        return _bump_version(conn, name, keys)
+
+
+def load_collection(name, default):
+    conn = get_conn()
+    if name in _LOADERS:
+        obj = _LOADERS[name](conn)
+    else:
+        obj = _kv_load(conn, name)
+    if name == "quizzes":
+        if not obj["quizzes"] and obj["active_id"] is None:
+            return default
+        return obj
+    return obj or default
+
+
+def load_entry(name, path):
+    """
+    (found, value) of one cached entry, path as returned by changed_entries:
+    [key] of a collection, or ["quizzes", quiz_id] / ["active_id"] of quizzes.
+    Attendance is cached per month and reloaded lazily, not per entry.
+    """
+    conn = get_conn()
+    key = path[-1]
+    if name == "quizzes" and path[0] == "quizzes":
+        row = conn.execute("SELECT body FROM quizzes WHERE quiz_id = ?", (key,)).fetchone()
+        return (True, json.loads(row[0])) if row else (False, None)
+    if name == "quiz_stats":
+        obj = _quiz_stats_load(conn, key)
+    elif name == "progress":
+        obj = _progress_load(conn, key)
+    elif name in _LOADERS and name != "quizzes":
+        raise ValueError(f"no per-entry loader for {name}")
+    else:
+        row = conn.execute(
+            "SELECT value FROM kv WHERE collection = ? AND key = ?", (name, key)
+        ).fetchone()
+        obj = {key: json.loads(row[0])} if row else {}
+    return (key in obj, obj.get(key))
+
+
+def is_empty():
+    conn = get_conn()
+    for table in ("kv", "quizzes", "quiz_totals", "attendance", "progress"):
+        if conn.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone():
+            return False
+    return True
+
+
+def migrate_if_empty(defaults=None):
+    # workers start at the same time: only the first one migrates
+    with transaction(immediate=True):
+        if not is_empty():
+            return None
+        print("🗄️ Empty SQLite store, migrating JSON data...")
+        return migrate_from_json(defaults)
+
+
+def migrate_from_json(defaults=None):
+    """
+    One-shot migration: copy every JSON collection (snapshot + journal) into the DB.
+    Existing rows of each migrated collection are replaced.
+    """
+    defaults = defaults or {}
+    counts = {}
+    for name, path in COLLECTION_PATHS.items():
+        obj = load_json(path, defaults.get(name))
+        if name == "attendance":
+            obj = dict(obj or {})
+            for month in attendance_partition_months():
+                obj.update(load_json(attendance_partition_path(month), {}))
+        if obj is None:
+            continue
+        set_value(name, [], obj)
+        counts[name] = len(obj)
+    return counts
+
+
+if __name__ == "__main__":
+    # python -m app.sqlite_store  -> migrate data/*.json into SQLITE_PATH
+    result = migrate_from_json()
+    for name, n in result.items():
+        print(f"✅ {name}: {n} top-level entries")
+    print("Database:", SQLITE_PATH)
+    sys.exit(0)
@@ -1,63 +1,305 @@
 # storage.py
+import contextlib
+import copy
 import datetime
-import re
+import itertools
 import random
+import threading
 from collections import Counter
 
+from app.arabic_text import normalize_answer
 from app.config import (
-    SETTINGS_PATH, ROBOTS_PATH, STAGES_PATH, QUIZ_PATH,
-    QUIZ_STATS_PATH, ATTENDANCE_PATH, PROGRESS_PATH,
-    DEFAULT_SETTINGS, DEFAULT_STAGES, DEFAULT_SUBJECTS,
-    load_json, save_json, new_id
+    COLLECTION_PATHS, STORAGE_BACKEND, SHARED_STATE,
+    DEFAULT_SETTINGS, DEFAULT_STAGES, DEFAULT_SUBJECTS, ATTENDANCE_PAGE_SIZE,
+    load_json, save_json, new_id,
+    journal_set, journal_delete, track_json, start_journal_compactor,
+    attendance_partition_path, attendance_partition_months, split_legacy_attendance
 )
 
+USE_SQLITE = STORAGE_BACKEND == "sqlite"
+if USE_SQLITE:
+    from app import sqlite_store
+
+COLLECTION_DEFAULTS = {
+    "settings":   DEFAULT_SETTINGS,
+    "robots":     {},
+    "stages":     DEFAULT_STAGES,
+    "quizzes":    {"active_id": None, "quizzes": {}},
+    "quiz_stats": {},
+    "attendance": {},
+    "progress":   {},
+}
+
+COLLECTION_LOCKS = {name: threading.RLock() for name in COLLECTION_PATHS}
+
+# shared mode: collection version this worker's in-memory copy reflects
+_SEEN_VERSIONS = {}
+
+# per thread: collection -> modes ("r"/"w") of the collection locks it holds
+_HELD = threading.local()
+
+
+def _held_modes(name):
+    held = getattr(_HELD, "modes", None)
+    if held is None:
+        held = _HELD.modes = {}
+    return held.setdefault(name, [])
+
+
+@contextlib.contextmanager
+def collection_lock(name, write=True):
+    """
+    Lock guarding one collection. Hold it while mutating or iterating the
+    in-memory dict; persist_set/persist_delete must be called under it.
+    In shared mode a write lock is also a cross-process SQLite write
+    transaction, and the cached copy is refreshed first so other workers'
+    changes are never overwritten.
+    The refresh only runs on the outermost acquisition: a nested lock never
+    rewrites the dict an enclosing block of this thread is iterating. For the
+    same reason a write lock cannot be taken inside a read lock.
+    """
+    with COLLECTION_LOCKS[name]:
+        modes = _held_modes(name)
+        if write and modes and "w" not in modes:
+            raise RuntimeError(f"write lock on {name!r} requested inside its read lock")
+        outer = not modes
+        modes.append("w" if write else "r")
+        try:
+            if not SHARED_STATE:
+                yield
+            elif write:
+                with sqlite_store.transaction(immediate=True):
+                    if outer:
+                        refresh_collection(name)
+                    yield
+            else:
+                if outer:
+                    refresh_collection(name)
+                yield
+        finally:
+            modes.pop()
+
+
+def _replace_in_place(obj, fresh):
+    # keep the same dict object: server.py imported it by reference
+    for k in list(obj):
+        if k not in fresh:
+            del obj[k]
+    obj.update(fresh)
+
+
+def refresh_collection(name, version=None):
+    """
+    Reload one collection if another worker wrote it since we last looked.
+    Runs with the collection lock held and nobody on this thread inside it,
+    so no reader is iterating the dict while it is rewritten.
+    """
+    if not SHARED_STATE:
+        return False
+    with COLLECTION_LOCKS[name]:
+        if len(_held_modes(name)) > 1:
+            # called from within a locked block of this thread: keep its view
+            return False
+        if version is None:
+            version = sqlite_store.collection_versions().get(name, 0)
+        seen = _SEEN_VERSIONS.get(name, 0)
+        if seen == version:
+            return False
+        # only the entries written since `seen`, when the change log has them
+        paths = sqlite_store.changed_entries(name, seen)
+        if name == "attendance":
+            # month partitions reload lazily on next access
+            if paths is None:
+                ATTENDANCE.clear()
+            for path in paths or ():
+                ATTENDANCE.pop(path[0][:7], None)
+        elif paths is None:
+            _replace_in_place(COLLECTIONS[name], load_collection(name))
+            if name == "quizzes":
+                rebuild_quiz_index()
+        else:
+            for path in paths:
+                _reload_entry(name, path)
+        _SEEN_VERSIONS[name] = version
+    return True
+
+
+def _reload_entry(name, path):
+    found, value = sqlite_store.load_entry(name, path)
+    node = COLLECTIONS[name]
+    for k in path[:-1]:
+        node = node.setdefault(k, {})
+    key = path[-1]
+    if name == "quizzes" and path[0] == "quizzes":
+        # keep QUIZ_INDEX in step with the one quiz that changed
+        old = node.get(key)
+        if old is not None and found:
+            node[key] = value
+            rebuild_quiz_index()
+            return
+        if old is not None:
+            _unindex_quiz(key, old)
+        if found:
+            _index_quiz(key, value)
+    if found:
+        node[key] = value
+    else:
+        node.pop(key, None)
+
+
+def refresh_stale_collections():
+    """Called once per request in shared mode (a single small SELECT)."""
+    if not SHARED_STATE:
+        return
+    for name, version in sqlite_store.collection_versions().items():
+        if name in COLLECTIONS and _SEEN_VERSIONS.get(name, 0) != version:
+            refresh_collection(name, version)
+
+
+def read_copy(name, *keys, default=None):
+    """
+    Deep copy of collection `name` (or of the node at keys...), taken under
+    its read lock: for templates / JSON that iterate after the lock is gone.
+    """
+    with collection_lock(name, write=False):
+        node = COLLECTIONS[name]
+        for k in keys:
+            if not isinstance(node, dict) or k not in node:
+                return default
+            node = node[k]
+        return copy.deepcopy(node)
+
+
+# ------------------ BACKEND (json files + journal, or sqlite) ------------------
+
+
+def load_collection(name):
+    default = copy.deepcopy(COLLECTION_DEFAULTS[name])
+    if USE_SQLITE:
+        return sqlite_store.load_collection(name, default)
+    return load_json(COLLECTION_PATHS[name], default)
+
+
+def _json_path(name, keys):
+    # attendance keys start with the date, which picks the month partition
+    if name == "attendance":
+        return attendance_partition_path(keys[0][:7])
+    return COLLECTION_PATHS[name]
+
+
+def persist_set(name, keys, value):
+    """Persist one change: collection[name][keys...] = value."""
+    if USE_SQLITE:
+        _SEEN_VERSIONS[name] = sqlite_store.set_value(name, keys, value)
+    else:
+        journal_set(_json_path(name, keys), keys, value)
+
+
+def persist_delete(name, keys):
+    if USE_SQLITE:
+        _SEEN_VERSIONS[name] = sqlite_store.delete_value(name, keys)
+    else:
+        journal_delete(_json_path(name, keys), keys)
+
+
+def persist_collection(name):
+    """
+    Full rewrite of one collection (rare: structure changes, settings).
+    Call it after releasing the collection lock; the writer takes it itself.
+    """
+    if name == "attendance":
+        # only loaded months can have changed
+        with collection_lock(name):
+            for month, part in ATTENDANCE.items():
+                if USE_SQLITE:
+                    for date, node in part.items():
+                        _SEEN_VERSIONS[name] = sqlite_store.set_value(name, [date], node)
+                else:
+                    save_json(attendance_partition_path(month), part)
+    elif USE_SQLITE:
+        with collection_lock(name):
+            _SEEN_VERSIONS[name] = sqlite_store.set_value(name, [], COLLECTIONS[name])
+    else:
+        save_json(COLLECTION_PATHS[name], COLLECTIONS[name])
+
+
+def persist_all():
+    for name in COLLECTIONS:
+        persist_collection(name)
+
+
 # ------------------ GLOBAL STATE (LOADED FROM DISK) ------------------
-SETTINGS   = load_json(SETTINGS_PATH, DEFAULT_SETTINGS.copy())
-ROBOTS     = load_json(ROBOTS_PATH, {})
-STAGES     = load_json(STAGES_PATH, DEFAULT_STAGES.copy())
-QUIZZES    = load_json(QUIZ_PATH, {"active_id": None, "quizzes": {}})
-QUIZ_STATS = load_json(QUIZ_STATS_PATH, {})
-ATTENDANCE = load_json(ATTENDANCE_PATH, {})
-PROGRESS   = load_json(PROGRESS_PATH, {})
+if USE_SQLITE:
+    sqlite_store.migrate_if_empty(COLLECTION_DEFAULTS)
+    # versions first, then data: a write in between only causes an extra reload
+    _SEEN_VERSIONS.update(sqlite_store.collection_versions())
+
+SETTINGS   = load_collection("settings")
+ROBOTS     = load_collection("robots")
+STAGES     = load_collection("stages")
+QUIZZES    = load_collection("quizzes")
+QUIZ_STATS = load_collection("quiz_stats")
+# month "YYYY-MM" -> {date: {stage: {section: ...}}}, filled lazily by _attendance_month
+ATTENDANCE = {}
+PROGRESS   = load_collection("progress")
+
+COLLECTIONS = {
+    "settings":   SETTINGS,
+    "robots":     ROBOTS,
+    "stages":     STAGES,
+    "quizzes":    QUIZZES,
+    "quiz_stats": QUIZ_STATS,
+    "attendance": ATTENDANCE,
+    "progress":   PROGRESS,
+}
+
+if not USE_SQLITE:
+    split_legacy_attendance()
+    for _name, _obj in COLLECTIONS.items():
+        if _name != "attendance":
+            track_json(COLLECTION_PATHS[_name], _obj, COLLECTION_LOCKS[_name])
+    start_journal_compactor()
 
 # ------------------ STAGES / STUDENTS HELPERS ------------------
 
 
 def ensure_stage_structure():
     global STAGES
-    changed = False
-    for s in ["Stage 1", "Stage 2", "Stage 3"]:
-        if s not in STAGES:
-            STAGES[s] = {
-                "sections": {"A": _new_section(), "B": _new_section()}
-            }
-            changed = True
-        else:
-            if "sections" not in STAGES[s]:
-                STAGES[s]["sections"] = {
-                    "A": _new_section(),
-                    "B": _new_section()
+    # mutated and persisted under one lock: a refresh in between would drop it
+    with collection_lock("stages"):
+        for s in ["Stage 1", "Stage 2", "Stage 3"]:
+            changed = False
+            if s not in STAGES:
+                STAGES[s] = {
+                    "sections": {"A": _new_section(), "B": _new_section()}
                 }
                 changed = True
-            for sec in ("A", "B"):
-                if sec not in STAGES[s]["sections"]:
-                    STAGES[s]["sections"][sec] = _new_section()
+            else:
+                if "sections" not in STAGES[s]:
+                    STAGES[s]["sections"] = {
+                        "A": _new_section(),
+                        "B": _new_section()
+                    }
                     changed = True
-                else:
-                    secobj = STAGES[s]["sections"][sec]
-                    if "subjects" not in secobj:
-                        secobj["subjects"] = DEFAULT_SUBJECTS[:]
-                        changed = True
-                    if "subject_students" not in secobj:
-                        secobj["subject_students"] = {x: [] for x in DEFAULT_SUBJECTS}
+                for sec in ("A", "B"):
+                    if sec not in STAGES[s]["sections"]:
+                        STAGES[s]["sections"][sec] = _new_section()
                         changed = True
                     else:
-                        for sub in DEFAULT_SUBJECTS:
-                            if sub not in secobj["subject_students"]:
-                                secobj["subject_students"][sub] = []
-                                changed = True
-    if changed:
-        save_json(STAGES_PATH, STAGES)
+                        secobj = STAGES[s]["sections"][sec]
+                        if "subjects" not in secobj:
+                            secobj["subjects"] = DEFAULT_SUBJECTS[:]
+                            changed = True
+                        if "subject_students" not in secobj:
+                            secobj["subject_students"] = {x: [] for x in DEFAULT_SUBJECTS}
+                            changed = True
+                        else:
+                            for sub in DEFAULT_SUBJECTS:
+                                if sub not in secobj["subject_students"]:
+                                    secobj["subject_students"][sub] = []
+                                    changed = True
+            if changed:
+                persist_set("stages", [s], STAGES[s])
 
 
 def _new_section():
@@ -69,44 +311,119 @@ def _new_section():
 
 
 def get_students(stage, section):
-    return STAGES.get(stage, {}).get("sections", {}).get(section, {}).get(
-        "students", []
-    )
+    """Copy of the section's student list (read under the stages lock)."""
+    with collection_lock("stages", write=False):
+        return list(STAGES.get(stage, {}).get("sections", {}).get(section, {}).get(
+            "students", []
+        ))
 
 
 def set_students(stage, section, students):
-    STAGES.setdefault(stage, {}).setdefault(
-        "sections", {}
-    ).setdefault(section, _new_section())["students"] = students
-    save_json(STAGES_PATH, STAGES)
+    with collection_lock("stages"):
+        sec = STAGES.setdefault(stage, {}).setdefault(
+            "sections", {}
+        ).setdefault(section, _new_section())
+        sec["students"] = students
+        persist_set("stages", [stage, "sections", section], sec)
 
 
 def add_student_to_section(stage, section, name):
-    sec = STAGES.setdefault(stage, {}).setdefault(
-        "sections", {}
-    ).setdefault(section, _new_section())
-    lst = sec.setdefault("students", [])
-    if name not in lst:
-        lst.append(name)
-        save_json(STAGES_PATH, STAGES)
-        return True
+    with collection_lock("stages"):
+        sec = STAGES.setdefault(stage, {}).setdefault(
+            "sections", {}
+        ).setdefault(section, _new_section())
+        lst = sec.setdefault("students", [])
+        if name not in lst:
+            lst.append(name)
+            persist_set("stages", [stage, "sections", section], sec)
+            return True
+    return False
+
+
+def remove_student_from_section(stage, section, name):
+    with collection_lock("stages"):
+        sec = STAGES.get(stage, {}).get("sections", {}).get(section)
+        if sec and name in sec.get("students", []):
+            sec["students"].remove(name)
+            persist_set("stages", [stage, "sections", section], sec)
+            return True
     return False
 
 
+def ensure_subject_students(stage, section):
+    """Section's {subject: [students]} (a copy), created for older sections; None if no section."""
+    with collection_lock("stages"):
+        sec = STAGES.get(stage, {}).get("sections", {}).get(section)
+        if sec is None:
+            return None
+        if "subject_students" not in sec:
+            sec["subject_students"] = {
+                s: [] for s in sec.get("subjects", DEFAULT_SUBJECTS[:])
+            }
+            persist_set("stages", [stage, "sections", section], sec)
+        return copy.deepcopy(sec["subject_students"])
+
+
 def add_student_to_subject(stage, section, subject, name):
-    sec = STAGES.setdefault(stage, {}).setdefault(
-        "sections", {}
-    ).setdefault(section, _new_section())
-    subjmap = sec.setdefault("subject_students", {})
-    lst = subjmap.setdefault(subject, [])
-    if name not in lst:
-        lst.append(name)
-        save_json(STAGES_PATH, STAGES)
-        return True
+    with collection_lock("stages"):
+        sec = STAGES.setdefault(stage, {}).setdefault(
+            "sections", {}
+        ).setdefault(section, _new_section())
+        subjmap = sec.setdefault("subject_students", {})
+        lst = subjmap.setdefault(subject, [])
+        if name not in lst:
+            lst.append(name)
+            persist_set("stages", [stage, "sections", section], sec)
+            return True
     return False
 
 
 # ------------------ ATTENDANCE (subject-level + legacy) ------------------
+# stored per month; a month is read from disk / sqlite the first time it is needed
+
+
+def _attendance_month(month):
+    """Month partition, loaded on first use (caller holds the attendance lock)."""
+    part = ATTENDANCE.get(month)
+    if part is None:
+        if USE_SQLITE:
+            part = sqlite_store.attendance_month(month)
+        else:
+            path = attendance_partition_path(month)
+            part = load_json(path, {})
+            track_json(path, part, COLLECTION_LOCKS["attendance"])
+        ATTENDANCE[month] = part
+    return part
+
+
+def attendance_months():
+    """Months that have attendance in the JSON backend, newest first."""
+    return sorted(set(attendance_partition_months()) | set(ATTENDANCE), reverse=True)
+
+
+def _attendance_row(secnode, subject):
+    if subject:
+        return dict(secnode.get("__subjects__", {}).get(subject, {}))
+    return {k: v for k, v in secnode.items() if k != "__subjects__"}
+
+
+def _iter_attendance(stage, section, subject=None, date_from=None, date_to=None):
+    """(date, {student: bool}) newest first; stops loading months once past date_from."""
+    for month in attendance_months():
+        if date_to and month > date_to[:7]:
+            continue
+        if date_from and month < date_from[:7]:
+            return
+        with collection_lock("attendance", write=False):
+            part = _attendance_month(month)
+            rows = []
+            for date in sorted(part, reverse=True):
+                if (date_to and date > date_to) or (date_from and date < date_from):
+                    continue
+                row = _attendance_row(part[date].get(stage, {}).get(section, {}), subject)
+                if row:
+                    rows.append((date, row))
+        yield from rows
 
 
 def mark_attendance(stage, section, date_str, present_map, subject=None):
@@ -115,36 +432,187 @@ def mark_attendance(stage, section, date_str, present_map, subject=None):
     وإلا -> خزّن بالشكل القديم (قسم كامل)
     present_map: dict {student: bool}
     """
-    secnode = ATTENDANCE.setdefault(date_str, {}).setdefault(
-        stage, {}
-    ).setdefault(section, {})
-    if subject:
-        subnode = secnode.setdefault("__subjects__", {}).setdefault(subject, {})
-        subnode.update(present_map)
-    else:
-        secnode.update(present_map)
-    save_json(ATTENDANCE_PATH, ATTENDANCE)
+    with collection_lock("attendance"):
+        secnode = _attendance_month(date_str[:7]).setdefault(date_str, {}).setdefault(
+            stage, {}
+        ).setdefault(section, {})
+        if subject:
+            subnode = secnode.setdefault("__subjects__", {}).setdefault(subject, {})
+            subnode.update(present_map)
+        else:
+            secnode.update(present_map)
+        persist_set("attendance", [date_str, stage, section], secnode)
 
 
 def get_attendance_for_subject(stage, section, date_str, subject):
-    secnode = ATTENDANCE.get(date_str, {}).get(stage, {}).get(section, {})
-    subnode = secnode.get("__subjects__", {}).get(subject, {})
-    return dict(subnode)
+    with collection_lock("attendance", write=False):
+        secnode = _attendance_month(date_str[:7]).get(date_str, {}).get(stage, {}).get(section, {})
+        return _attendance_row(secnode, subject)
 
 
-def get_attendance_history(stage, section, subject=None):
-    hist = {}
-    for date in sorted(ATTENDANCE.keys(), reverse=True):
-        secnode = ATTENDANCE.get(date, {}).get(stage, {}).get(section, {})
-        if subject:
-            subnode = secnode.get("__subjects__", {}).get(subject, {})
-            if subnode:
-                hist[date] = subnode
+def get_attendance_for_date(date_str):
+    """All stages/sections for one day (analytics)."""
+    with collection_lock("attendance", write=False):
+        return copy.deepcopy(_attendance_month(date_str[:7]).get(date_str, {}))
+
+
+def query_attendance(stage, section, subject=None, date_from=None, date_to=None,
+                     page=1, per_page=ATTENDANCE_PAGE_SIZE):
+    """
+    Range query for one section (and subject), newest date first.
+    date_from / date_to: inclusive 'YYYY-MM-DD'; per_page=None -> everything.
+    Only the months needed to fill the requested page are loaded.
+    """
+    page = max(1, int(page or 1))
+    offset = (page - 1) * per_page if per_page else 0
+    # one extra date tells us whether there is a next page
+    limit = None if per_page is None else per_page + 1
+    if USE_SQLITE:
+        items = sqlite_store.attendance_range(
+            stage, section, subject, date_from, date_to, limit=limit, offset=offset
+        )
+    else:
+        rows = _iter_attendance(stage, section, subject, date_from, date_to)
+        items = list(itertools.islice(rows, offset, None if limit is None else offset + limit))
+    has_more = per_page is not None and len(items) > per_page
+    if has_more:
+        items = items[:per_page]
+    return {"items": items, "page": page, "per_page": per_page, "has_more": has_more}
+
+
+def get_attendance_history(stage, section, subject=None, date_from=None, date_to=None):
+    res = query_attendance(stage, section, subject, date_from, date_to, per_page=None)
+    return dict(res["items"])
+
+
+# ------------------ QUIZ INDEX (stage, section, subject) ------------------
+
+SUBJECT_SYNONYMS = {
+    "math": "mathematics",
+    "mathematics": "mathematics",
+    "computer": "computer",
+    "computing": "computer",
+    "cs": "computer",
+    "eng": "english",
+    "english": "english",
+    "arabic": "arabic",
+    "science": "science",
+    "history": "history",
+    "geography": "geography",
+    "religion": "religion",
+}
+
+# (stage, section) normalized -> {subject normalized: [quiz_id, ...]}
+QUIZ_INDEX = {}
+# quiz_id -> creation sequence, to return results in QUIZZES order; the
+# counter only goes up so a delete never hands its number to a later quiz
+_QUIZ_SEQ = {}
+_QUIZ_COUNTER = itertools.count()
+# quiz_id -> {qid: (question, normalized correct answer)}; built on first
+# submission (quiz_question_map), dropped whenever the quiz is (un)indexed
+_QUESTION_MAPS = {}
+
+
+def norm_key(s):
+    return (s or "").strip().lower()
+
+
+def subject_matches(meta_subject, query_subj):
+    """Synonym / partial subject match used by the robot quiz listing."""
+    if not query_subj:
+        return True
+    ms = norm_key(meta_subject)
+    qs = norm_key(query_subj)
+    if not ms or not qs:
+        return False
+    if ms == qs:
+        return True
+    if qs in SUBJECT_SYNONYMS and SUBJECT_SYNONYMS.get(qs) == ms:
+        return True
+    if ms in SUBJECT_SYNONYMS and SUBJECT_SYNONYMS.get(ms) == qs:
+        return True
+    if len(qs) >= 4 and (qs in ms or ms in qs):
+        return True
+    return False
+
+
+def _index_quiz(qid, quiz):
+    meta = quiz.get("meta", {}) or {}
+    bucket = QUIZ_INDEX.setdefault(
+        (norm_key(meta.get("stage")), norm_key(meta.get("section"))), {}
+    )
+    bucket.setdefault(norm_key(meta.get("subject")), []).append(qid)
+    _QUIZ_SEQ[qid] = next(_QUIZ_COUNTER)
+    _QUESTION_MAPS.pop(qid, None)
+
+
+def _unindex_quiz(qid, quiz):
+    meta = quiz.get("meta", {}) or {}
+    bkey = (norm_key(meta.get("stage")), norm_key(meta.get("section")))
+    skey = norm_key(meta.get("subject"))
+    bucket = QUIZ_INDEX.get(bkey, {})
+    ids = bucket.get(skey, [])
+    if qid in ids:
+        ids.remove(qid)
+    if not ids:
+        bucket.pop(skey, None)
+    if not bucket:
+        QUIZ_INDEX.pop(bkey, None)
+    _QUIZ_SEQ.pop(qid, None)
+    _QUESTION_MAPS.pop(qid, None)
+
+
+def rebuild_quiz_index():
+    with collection_lock("quizzes", write=False):
+        QUIZ_INDEX.clear()
+        _QUIZ_SEQ.clear()
+        _QUESTION_MAPS.clear()
+        for qid, quiz in QUIZZES.get("quizzes", {}).items():
+            _index_quiz(qid, quiz)
+
+
+def find_quizzes(stage=None, section=None, subject=None, fuzzy=False, match_title=False):
+    """
+    [(quiz_id, quiz)] in creation order, via QUIZ_INDEX instead of a scan.
+    stage/section/subject compare normalized (strip + lower); None = any.
+    fuzzy: subject_matches() rules (synonyms, partial names).
+    match_title: also quizzes of other subjects whose title contains `subject`.
+    """
+    st, sec, qs = norm_key(stage), norm_key(section), norm_key(subject)
+    with collection_lock("quizzes", write=False):
+        quizzes = QUIZZES.get("quizzes", {})
+        if stage is not None and section is not None:
+            buckets = [QUIZ_INDEX.get((st, sec), {})]
         else:
-            row = {k: v for k, v in secnode.items() if k != "__subjects__"}
-            if row:
-                hist[date] = row
-    return hist
+            buckets = [
+                b for (bst, bsec), b in QUIZ_INDEX.items()
+                if (stage is None or bst == st) and (section is None or bsec == sec)
+            ]
+        qids = []
+        for bucket in buckets:
+            if subject is None:
+                for ids in bucket.values():
+                    qids.extend(ids)
+                continue
+            # only the section's distinct subjects are compared, not every quiz
+            keys = [
+                k for k in bucket
+                if (subject_matches(k, qs) if fuzzy else k == qs)
+            ]
+            for k in keys:
+                qids.extend(bucket[k])
+            if match_title:
+                for k, ids in bucket.items():
+                    if k not in keys:
+                        qids.extend(
+                            q for q in ids
+                            if qs in norm_key(quizzes[q].get("title", ""))
+                        )
+        qids.sort(key=_QUIZ_SEQ.get)
+        return [(q, quizzes[q]) for q in qids]
+
+
+rebuild_quiz_index()
 
 
 # ------------------ QUIZZES / STATS ------------------
@@ -152,77 +620,133 @@ def get_attendance_history(stage, section, subject=None):
 
 def add_quiz(quiz_obj, meta):
     qid = new_id("quiz")
-    QUIZZES.setdefault("quizzes", {})[qid] = {
-        "title": quiz_obj.get("title", ""),
-        "questions": quiz_obj.get("questions", []),
-        "meta": meta,
-        "created_at": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-    }
-    QUIZZES["active_id"] = qid
-    save_json(QUIZ_PATH, QUIZZES)
+    with collection_lock("quizzes"):
+        QUIZZES.setdefault("quizzes", {})[qid] = {
+            "title": quiz_obj.get("title", ""),
+            "questions": quiz_obj.get("questions", []),
+            "meta": meta,
+            "created_at": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        QUIZZES["active_id"] = qid
+        _index_quiz(qid, QUIZZES["quizzes"][qid])
+        persist_set("quizzes", ["quizzes", qid], QUIZZES["quizzes"][qid])
+        persist_set("quizzes", ["active_id"], qid)
     return qid
 
 
 def delete_quiz(quiz_id):
-    if quiz_id in QUIZZES.get("quizzes", {}):
-        del QUIZZES["quizzes"][quiz_id]
-        save_json(QUIZ_PATH, QUIZZES)
+    with collection_lock("quizzes"):
+        if quiz_id not in QUIZZES.get("quizzes", {}):
+            return False
+        _unindex_quiz(quiz_id, QUIZZES["quizzes"].pop(quiz_id))
+        persist_delete("quizzes", ["quizzes", quiz_id])
+    with collection_lock("quiz_stats"):
         if quiz_id in QUIZ_STATS:
             del QUIZ_STATS[quiz_id]
-            save_json(QUIZ_STATS_PATH, QUIZ_STATS)
-        modified = False
-        for user, udata in list(PROGRESS.items()):
+            persist_delete("quiz_stats", [quiz_id])
+    with collection_lock("progress"):
+        for user, udata in PROGRESS.items():
             if "completed" in udata and quiz_id in udata["completed"]:
-                del PROGRESS[user]["completed"][quiz_id]
-                modified = True
-        if modified:
-            save_json(PROGRESS_PATH, PROGRESS)
-        return True
-    return False
+                del udata["completed"][quiz_id]
+                persist_delete("progress", [user, "completed", quiz_id])
+    return True
+
+
+def _empty_quiz_stats():
+    return {
+        "questions": {},
+        "total_attempts": 0,
+        "total_correct": 0,
+        "total_wrong": 0,
+    }
 
 
 def ensure_quiz_stats(quiz_id):
-    if quiz_id not in QUIZ_STATS:
-        QUIZ_STATS[quiz_id] = {
-            "questions": {},
-            "total_attempts": 0,
-            "total_correct": 0,
-            "total_wrong": 0,
-        }
-        save_json(QUIZ_STATS_PATH, QUIZ_STATS)
+    with collection_lock("quiz_stats"):
+        if quiz_id not in QUIZ_STATS:
+            QUIZ_STATS[quiz_id] = _empty_quiz_stats()
+            persist_set("quiz_stats", [quiz_id], QUIZ_STATS[quiz_id])
+
+
+def apply_quiz_results(quiz_id, results):
+    """
+    Add graded answers [(qid, correct, wrong_answer)] to the quiz stats
+    in one locked update and a single persist.
+    """
+    if not results:
+        return
+    with collection_lock("quiz_stats"):
+        entry = QUIZ_STATS.setdefault(quiz_id, _empty_quiz_stats())
+        for qid, correct, wrong_answer in results:
+            qs = entry["questions"].setdefault(
+                qid, {"attempts": 0, "correct": 0, "wrong": 0, "wrongs": {}}
+            )
+            qs["attempts"] += 1
+            if correct:
+                qs["correct"] += 1
+                entry["total_correct"] += 1
+            else:
+                qs["wrong"] += 1
+                entry["total_wrong"] += 1
+                if wrong_answer:
+                    qs["wrongs"][wrong_answer] = qs["wrongs"].get(wrong_answer, 0) + 1
+            entry["total_attempts"] += 1
+        persist_set("quiz_stats", [quiz_id], entry)
 
 
 def update_quiz_stats(quiz_id, qid, correct, wrong_answer=None):
-    ensure_quiz_stats(quiz_id)
-    qs = QUIZ_STATS[quiz_id]["questions"].setdefault(
-        qid, {"attempts": 0, "correct": 0, "wrong": 0, "wrongs": {}}
-    )
-    qs["attempts"] += 1
-    if correct:
-        qs["correct"] += 1
-        QUIZ_STATS[quiz_id]["total_correct"] += 1
-    else:
-        qs["wrong"] += 1
-        QUIZ_STATS[quiz_id]["total_wrong"] += 1
-        if wrong_answer:
-            qs["wrongs"][wrong_answer] = qs["wrongs"].get(wrong_answer, 0) + 1
-    QUIZ_STATS[quiz_id]["total_attempts"] += 1
-    save_json(QUIZ_STATS_PATH, QUIZ_STATS)
+    apply_quiz_results(quiz_id, [(qid, correct, wrong_answer)])
 
 
-ART_NUM_MAP = str.maketrans("٠١٢٣٤٥٦٧٨٩", "0123456789")
+# ------------------ QUIZ GRADING ------------------
+
+def quiz_question_map(quiz_id):
+    qmap = _QUESTION_MAPS.get(quiz_id)
+    if qmap is not None:
+        return qmap
+    with collection_lock("quizzes", write=False):
+        quiz = QUIZZES.get("quizzes", {}).get(quiz_id)
+        if quiz is None:
+            return {}
+        qmap = {}
+        for q in quiz.get("questions", []):
+            # first question wins on duplicate ids, like the old linear search
+            qmap.setdefault(q.get("id"), (q, normalize_ans(q.get("a", ""))))
+        _QUESTION_MAPS[quiz_id] = qmap
+    return qmap
+
+
+def grade_answers(quiz_id, answers):
+    """
+    answers: [{"qid": ..., "answer": ...}] -> (score, [(qid, correct, wrong_answer)]).
+    Unknown qids are skipped.
+    """
+    qmap = quiz_question_map(quiz_id)
+    score = 0
+    results = []
+    for a in answers:
+        qid = a.get("qid")
+        item = qmap.get(qid)
+        if item is None:
+            continue
+        ans = str(a.get("answer", ""))
+        correct = normalize_ans(ans) == item[1]
+        results.append((qid, correct, ans if not correct else None))
+        if correct:
+            score += 1
+    return score, results
+
+
+def record_progress(student, quiz_id, score, total, finished_at):
+    rec = {"score": score, "total": total, "finished_at": finished_at}
+    with collection_lock("progress"):
+        PROGRESS.setdefault(student, {}).setdefault("completed", {})[quiz_id] = rec
+        persist_set("progress", [student, "completed", quiz_id], rec)
+    return rec
 
 
 def normalize_ans(s):
-    if s is None:
-        return ""
-    t = str(s).strip().lower()
-    t = t.translate(ART_NUM_MAP)
-    t = re.sub(
-        r"[^\w\s\-\+\=x/آأإءؤئًٌٍَُِّٰٔٱٔ]", "", t
-    )
-    t = re.sub(r"\s+", " ", t).strip()
-    return t
+    return normalize_answer(s)
 
 
 def build_subject_pool(subject):
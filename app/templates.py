@@ -563,6 +563,12 @@ ATTENDANCE_VIEW_HTML = """
     <div><a class="btn ghost" href="{{ url_for('section_subjects_page', stage=stage, section=section) }}">Back</a></div>
   </div>
 
+  <form method="get" style="margin-top:12px;display:flex;gap:8px;align-items:center">
+    <label class="small">From <input type="date" name="from" value="{{ date_from }}"></label>
+    <label class="small">To <input type="date" name="to" value="{{ date_to }}"></label>
+    <button class="btn ghost" type="submit">Filter</button>
+  </form>
+
   <div style="margin-top:12px">
     {% if history %}
       <table class="table">
@@ -581,6 +587,10 @@ ATTENDANCE_VIEW_HTML = """
     {% else %}
       <div class="empty">No attendance records.</div>
     {% endif %}
+    <div style="margin-top:12px;display:flex;justify-content:space-between">
+      <div>{% if newer_url %}<a class="btn ghost" href="{{ newer_url }}">← Newer</a>{% endif %}</div>
+      <div>{% if older_url %}<a class="btn ghost" href="{{ older_url }}">Older →</a>{% endif %}</div>
+    </div>
   </div>
 </div>
 """
@@ -665,14 +675,41 @@ SUBJECT_RAG_HTML = """
     </div>
   </div>
 
+  {% if job and job.state not in ("done", "failed") %}
+    <meta http-equiv="refresh" content="3">
+    <div class="card" style="margin-top:12px">
+      <div class="small">
+        ⏳ معالجة الكتاب الجديد: {{ job.step or "في الانتظار" }}
+        — {{ (job.progress * 100)|round|int }}%
+      </div>
+    </div>
+  {% elif job and job.state == "failed" %}
+    <div class="card" style="margin-top:12px">
+      <div class="small">⚠️ فشلت معالجة آخر كتاب مرفوع ({{ job.created_at }}): {{ job.error }}</div>
+    </div>
+  {% endif %}
+
   <div style="margin-top:12px;display:grid;grid-template-columns:repeat(auto-fit,minmax(260px,1fr));gap:16px">
     <div class="card">
       <h3>رفع / استبدال ملف Word</h3>
       <form method="post" enctype="multipart/form-data">
         <label class="small">ملف Word للمادة (docx فقط)</label>
         <input class="input" type="file" name="file" accept=".docx">
+        <label class="small">طريقة تقسيم الكتاب إلى فقرات</label>
+        <select class="input" name="chunking">
+          {% for s in strategies %}
+            <option value="{{ s }}" {% if s == chunking %}selected{% endif %}>{{ s }}</option>
+          {% endfor %}
+        </select>
+        <div class="small">
+          sentences: 3 جمل لكل فقرة — tokens: فقرات بطول ثابت تقريباً —
+          headings: لا تتجاوز الفقرة عنوان الدرس — window: مثل headings مع تداخل جملة بين الفقرات
+        </div>
         <div style="margin-top:8px">
           <button class="btn" type="submit">Upload / Replace</button>
+          {% if has_book %}
+            <button class="btn ghost" type="submit" name="action" value="rechunk">Re-chunk current book</button>
+          {% endif %}
         </div>
       </form>
     </div>
@@ -705,6 +742,13 @@ SUBJECT_RAG_HTML = """
   {% if contexts %}
     <div class="card" style="margin-top:12px">
       <h3 class="small">أقرب الفقرات من الكتاب (للمراجعة فقط):</h3>
+      {% if pack %}
+        <div class="small">
+          {{ pack.packed }} / {{ pack.candidates }} فقرات أُرسلت —
+          ~{{ pack.context_tokens }} token للمقاطع (الحد {{ pack.budget or "∞" }})،
+          ~{{ pack.prompt_tokens }} للطلب كاملاً
+        </div>
+      {% endif %}
       <div class="small">
         {% for c in contexts %}
           <p><b>فقرة #{{ c.index }}</b> (score={{ "%.3f"|format(c.score) }}):<br>{{ c.text }}</p>
@@ -0,0 +1,225 @@
+# vector_index.py
+"""
+Vector search over a book's paragraph embeddings (rows L2-normalized, so a
+dot product is the cosine score).
+
+An index is a plain dict:
+    {"kind": "exact"}
+    {"kind": "ivf", "centroids": (nlist, dim), "order": ids grouped by list,
+     "offsets": (nlist + 1,) start of each list in `order`}
+Small books use exact search; from RAG_ANN_MIN_PARAGRAPHS on, an IVF index
+(spherical k-means) is built once and persisted next to the embeddings.
+
+Optionally the resident copy is quantized (RAG_EMB_DTYPE):
+    {"dtype": "float16", "codes": (n, dim) float16}
+    {"dtype": "int8", "codes": (n, dim) int8, "scales": (n,) float32}
+Searches then score against the codes and re-rank the best candidates with
+the float32 rows (memory-mapped, so only those rows are read).
+"""
+import os
+
+import numpy as np
+
+from app.config import (
+    RAG_ANN_MIN_PARAGRAPHS, RAG_IVF_NLIST, RAG_IVF_NPROBE, RAG_IVF_TRAIN_ITERS,
+    RAG_EMB_DTYPE, RAG_RERANK_FACTOR, RAG_MODEL_NAME
+)
+
+# rows per block when scoring the whole matrix against the centroids
+_ASSIGN_BLOCK = 8192
+# rows per block when upcasting quantized codes (bounds the float32 temporary)
+_SCORE_BLOCK = 1024
+
+
+def top_k(scores, k):
+    """Indices of the k best scores, best first (argpartition, no full sort)."""
+    n = scores.shape[0]
+    if k <= 0 or n == 0:
+        return np.empty(0, dtype=np.int64)
+    if k < n:
+        idx = np.argpartition(-scores, k - 1)[:k]
+    else:
+        idx = np.arange(n)
+    return idx[np.argsort(-scores[idx], kind="stable")]
+
+
+# ------------------ QUANTIZATION ------------------
+
+
+def quantize(embeddings, dtype=RAG_EMB_DTYPE):
+    """Quantized resident copy of the matrix, or None for float32."""
+    if dtype == "float16":
+        codes = np.empty(embeddings.shape, dtype=np.float16)
+        for i in range(0, embeddings.shape[0], _SCORE_BLOCK):
+            codes[i:i + _SCORE_BLOCK] = embeddings[i:i + _SCORE_BLOCK]
+        return {"dtype": "float16", "codes": codes}
+    if dtype == "int8":
+        codes = np.empty(embeddings.shape, dtype=np.int8)
+        scales = np.empty(embeddings.shape[0], dtype=np.float32)
+        for i in range(0, embeddings.shape[0], _SCORE_BLOCK):
+            block = np.asarray(embeddings[i:i + _SCORE_BLOCK], dtype=np.float32)
+            s = np.abs(block).max(axis=1) / 127.0
+            s[s == 0] = 1.0
+            scales[i:i + _SCORE_BLOCK] = s
+            codes[i:i + _SCORE_BLOCK] = np.rint(block / s[:, None])
+        return {"dtype": "int8", "codes": codes, "scales": scales}
+    if dtype not in ("", "float32"):
+        print(f"⚠️ unknown RAG_EMB_DTYPE={dtype!r}, keeping float32")
+    return None
+
+
+def quantized_scores(quant, q, rows=None):
+    codes = quant["codes"] if rows is None else quant["codes"][rows]
+    out = np.empty(codes.shape[0], dtype=np.float32)
+    buf = np.empty((min(_SCORE_BLOCK, codes.shape[0]), codes.shape[1]), dtype=np.float32)
+    for i in range(0, codes.shape[0], _SCORE_BLOCK):
+        block = buf[:codes[i:i + _SCORE_BLOCK].shape[0]]
+        block[...] = codes[i:i + _SCORE_BLOCK]
+        out[i:i + _SCORE_BLOCK] = block @ q
+    if quant["dtype"] == "int8":
+        out *= quant["scales"] if rows is None else quant["scales"][rows]
+    return out
+
+
+def _rerank(embeddings, q, cand, k):
+    """Exact float32 scores for the candidate rows, best k first."""
+    cand = np.sort(cand)  # sequential reads from the (memory-mapped) matrix
+    scores = np.asarray(embeddings[cand], dtype=np.float32) @ q
+    best = top_k(scores, k)
+    return cand[best].astype(np.int64), scores[best]
+
+
+def search_exact(embeddings, q, k, quant=None):
+    if quant is None:
+        scores = embeddings @ q
+        idx = top_k(scores, k)
+        return idx, scores[idx]
+    cand = top_k(quantized_scores(quant, q), k * RAG_RERANK_FACTOR)
+    return _rerank(embeddings, q, cand, k)
+
+
+def _assign(embeddings, centroids):
+    out = np.empty(embeddings.shape[0], dtype=np.int32)
+    for i in range(0, embeddings.shape[0], _ASSIGN_BLOCK):
+        block = np.asarray(embeddings[i:i + _ASSIGN_BLOCK], dtype=np.float32)
+        out[i:i + _ASSIGN_BLOCK] = np.argmax(block @ centroids.T, axis=1)
+    return out
+
+
+def _normalize(m):
+    norms = np.linalg.norm(m, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return m / norms
+
+
+def default_nlist(n):
+    return RAG_IVF_NLIST or max(1, int(round(np.sqrt(n))))
+
+
+def build_ivf(embeddings, nlist=None, iters=RAG_IVF_TRAIN_ITERS, seed=0):
+    """Spherical k-means on (a sample of) the rows, then every row assigned to its list."""
+    n = embeddings.shape[0]
+    nlist = min(nlist or default_nlist(n), n)
+    rng = np.random.default_rng(seed)
+    # ~64 points per centroid are plenty to place them
+    sample_n = min(n, nlist * 64)
+    sample = np.asarray(embeddings[np.sort(rng.choice(n, sample_n, replace=False))], dtype=np.float32)
+    centroids = sample[rng.choice(sample_n, nlist, replace=False)].copy()
+    for _ in range(iters):
+        assign = _assign(sample, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, sample)
+        counts = np.bincount(assign, minlength=nlist)
+        # empty lists keep their previous centroid
+        filled = counts > 0
+        centroids[filled] = _normalize(sums[filled])
+
+    assign = _assign(embeddings, centroids)
+    order = np.argsort(assign, kind="stable").astype(np.int32)
+    offsets = np.zeros(nlist + 1, dtype=np.int64)
+    np.cumsum(np.bincount(assign, minlength=nlist), out=offsets[1:])
+    return {"kind": "ivf", "centroids": centroids, "order": order, "offsets": offsets}
+
+
+def search_ivf(index, embeddings, q, k, nprobe=RAG_IVF_NPROBE, quant=None):
+    centroids, order, offsets = index["centroids"], index["order"], index["offsets"]
+    probe = top_k(centroids @ q, min(nprobe, centroids.shape[0]))
+    cand = np.concatenate([order[offsets[c]:offsets[c + 1]] for c in probe])
+    if cand.shape[0] < k:
+        # probed lists too small for k results: fall back to the full scan
+        return search_exact(embeddings, q, k, quant=quant)
+    if quant is not None:
+        cand = cand[top_k(quantized_scores(quant, q, rows=cand), k * RAG_RERANK_FACTOR)]
+    return _rerank(embeddings, q, cand, k)
+
+
+def build_index(embeddings):
+    if embeddings.shape[0] < RAG_ANN_MIN_PARAGRAPHS:
+        return {"kind": "exact"}
+    return build_ivf(embeddings)
+
+
+def search_index(index, embeddings, q, k, nprobe=RAG_IVF_NPROBE, quant=None):
+    """(paragraph indices, scores) of the k best rows, best first."""
+    if index.get("kind") == "ivf":
+        return search_ivf(index, embeddings, q, k, nprobe=nprobe, quant=quant)
+    return search_exact(embeddings, q, k, quant=quant)
+
+
+# ------------------ PERSISTENCE ------------------
+
+
+def save_index(path, index, content_hash):
+    if index.get("kind") != "ivf":
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    tmp = path + ".tmp.npz"
+    np.savez(
+        tmp,
+        centroids=index["centroids"],
+        order=index["order"],
+        offsets=index["offsets"],
+        content_sha256=np.array(content_hash),
+        # centroids live in the model's vector space: a new model needs a new index
+        model=np.array(RAG_MODEL_NAME),
+    )
+    os.replace(tmp, path)
+
+
+def load_index(path, content_hash, n, dim):
+    """Persisted IVF index for exactly this content, RAG_MODEL_NAME and dim, else None."""
+    try:
+        with np.load(path) as z:
+            if str(z["content_sha256"]) != content_hash:
+                return None
+            # files written before the model was recorded count as stale
+            if "model" not in z.files or str(z["model"]) != RAG_MODEL_NAME:
+                return None
+            index = {
+                "kind": "ivf",
+                "centroids": z["centroids"],
+                "order": z["order"],
+                "offsets": z["offsets"],
+            }
+    except (OSError, KeyError, ValueError):
+        return None
+    if int(index["offsets"][-1]) != n or index["centroids"].shape[1] != dim:
+        return None
+    if RAG_IVF_NLIST and index["centroids"].shape[0] != min(RAG_IVF_NLIST, n):
+        return None
+    return index
+
+
+def load_or_build_index(path, embeddings, content_hash):
+    n = embeddings.shape[0]
+    if n < RAG_ANN_MIN_PARAGRAPHS:
+        return {"kind": "exact"}
+    index = load_index(path, content_hash, n, embeddings.shape[1])
+    if index is None:
+        index = build_index(embeddings)
+        try:
+            save_index(path, index, content_hash)
+        except OSError as e:
+            print("⚠️ could not write vector index:", e)
+    return index
@@ -0,0 +1,119 @@
+# arabic_text.py
+"""
+Benchmark: book cleaning / segmentation throughput (MB/s), the previous
+whole-text re.sub pipeline vs the live one (app.arabic_text sentences cut
+by app.chunking, "sentences" strategy), plus quiz answer normalization.
+
+    python -m benchmarks.arabic_text [book.docx | megabytes]
+
+Pass a Word book to measure on real text; otherwise synthetic Arabic text
+of the given size (default 8 MB) is used.
+"""
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+
+from app.arabic_text import normalize_answer
+from app.chunking import chunk_blocks
+
+ART_NUM_MAP = str.maketrans("٠١٢٣٤٥٦٧٨٩", "0123456789")
+WORDS = "الخلية وحدة بناء الكائنات الحية وتتكون من الغشاء والسايتوبلازم والنواة ـ اال ٣٤".split()
+
+
+def old_clean(raw_paragraphs):
+    # the previous clean_book_docx body, after reading the paragraphs
+    text = "\n".join(raw_paragraphs)
+    text = re.sub(r"[ـ]+", "", text)
+    text = re.sub(r"\s+", " ", text)
+    text = re.sub(r"اال", "ال", text)
+    text = re.sub(r"\s*([،؛:.؟])\s*", r"\1 ", text)
+    text = re.sub(r"(?<![\.\؟!])\n+", ". ", text)
+    text = text.strip()
+    sentences = re.split(r"(?<=[\.؟!])\s+", text)
+    paragraphs = []
+    temp = []
+    for s in sentences:
+        if not s.strip():
+            continue
+        temp.append(s.strip())
+        if len(temp) >= 3:
+            paragraphs.append(" ".join(temp))
+            temp = []
+    if temp:
+        paragraphs.append(" ".join(temp))
+    return paragraphs
+
+
+def old_normalize_ans(s):
+    t = str(s).strip().lower()
+    t = t.translate(ART_NUM_MAP)
+    t = re.sub(r"[^\w\s\-\+\=x/آأإءؤئًٌٍَُِّٰٔٱٔ]", "", t)
+    return re.sub(r"\s+", " ", t).strip()
+
+
+def synthetic_paragraphs(megabytes, rng):
+    out, size = [], 0
+    while size < megabytes * 1e6:
+        words = [rng.choice(WORDS) for _ in range(rng.randint(5, 60))]
+        for i in range(len(words) - 1):
+            if rng.random() < 0.1:
+                words[i] += rng.choice([".", "،", "؟", " :", "!"])
+        p = "  ".join(words) if rng.random() < 0.2 else " ".join(words)
+        out.append(p)
+        size += len(p.encode("utf-8"))
+    return out
+
+
+def docx_blocks(path):
+    os.environ.setdefault("DATA_DIR", tempfile.mkdtemp(prefix="kebbi_bench_"))
+    from app.rag_utils import iter_docx_blocks
+    return list(iter_docx_blocks(path))
+
+
+def new_clean(blocks):
+    return chunk_blocks(blocks, "sentences")[0]
+
+
+def timed(fn, *args, repeat=3):
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        out = fn(*args)
+        t = time.perf_counter() - t0
+        best = t if best is None else min(best, t)
+    return best, out
+
+
+def main():
+    arg = sys.argv[1] if len(sys.argv) > 1 else "8"
+    if arg.endswith(".docx"):
+        blocks = docx_blocks(arg)
+        raw = [text for _, text in blocks]
+    else:
+        raw = synthetic_paragraphs(float(arg), random.Random(0))
+        blocks = [(0, p) for p in raw]
+    mb = sum(len(p.encode("utf-8")) for p in raw) / 1e6
+
+    t_old, p_old = timed(old_clean, raw)
+    t_new, p_new = timed(new_clean, blocks)
+    assert p_old == p_new, "cleaning results differ"
+    print(f"book text: {mb:.1f} MB, {len(raw)} Word paragraphs -> {len(p_new)} chunks")
+    for name, t in (("old (6 re.sub passes)", t_old), ("live (chunking)", t_new)):
+        print(f"  {name:22s} {t * 1000:9.1f} ms  {mb / t:7.1f} MB/s")
+    print(f"  speedup x{t_old / t_new:.1f}")
+
+    answers = [w for p in raw[:20000] for w in p.split()[:3]]
+    amb = sum(len(a.encode("utf-8")) for a in answers) / 1e6
+    t_old, a_old = timed(lambda xs: [old_normalize_ans(a) for a in xs], answers)
+    t_new, a_new = timed(lambda xs: [normalize_answer(a) for a in xs], answers)
+    assert a_old == a_new, "normalize_ans results differ"
+    print(f"quiz answers: {len(answers)} ({amb:.2f} MB)")
+    for name, t in (("old normalize_ans", t_old), ("normalize_answer", t_new)):
+        print(f"  {name:22s} {t * 1000:9.1f} ms  {amb / t:7.1f} MB/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+# quantization.py
+"""
+Benchmark: RAM, latency and recall@k of float16 / int8 resident embeddings
+(with float32 re-rank) against plain float32 exact search.
+
+    python -m benchmarks.quantization [book_store/<hash>.npy | paragraphs] [queries]
+
+Pass a stored book matrix (subject_rag_books/store/<hash>.npy) to measure on a
+real textbook; queries are then perturbed paragraphs of that book. Without
+one, synthetic topic-clustered vectors are used.
+"""
+import sys
+import time
+
+import numpy as np
+
+from app.config import RAG_TOP_K, RAG_RERANK_FACTOR
+from app.vector_index import quantize, quantized_scores, search_exact, top_k
+
+
+def unit(m):
+    return (m / np.linalg.norm(m, axis=1, keepdims=True)).astype(np.float32)
+
+
+def synthetic(n, dim, rng):
+    centers = rng.standard_normal((max(8, n // 100), dim))
+    return unit(centers[rng.integers(0, centers.shape[0], n)] + 2.5 * rng.standard_normal((n, dim)))
+
+
+def recall(results, truth):
+    return sum(len(set(r.tolist()) & set(t.tolist())) for r, t in zip(results, truth)) / sum(len(t) for t in truth)
+
+
+def main():
+    arg = sys.argv[1] if len(sys.argv) > 1 else "20000"
+    nq = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    rng = np.random.default_rng(0)
+    if arg.endswith(".npy"):
+        emb = np.load(arg, mmap_mode="r")
+        src = arg
+    else:
+        emb = synthetic(int(arg), 768, rng)
+        src = "synthetic"
+    emb_ram = np.asarray(emb, dtype=np.float32)
+    n, dim = emb_ram.shape
+    # questions look like (noisy) paragraphs of the book
+    queries = unit(emb_ram[rng.integers(0, n, nq)] + 0.05 * rng.standard_normal((nq, dim)))
+    k = RAG_TOP_K
+
+    truth = [search_exact(emb_ram, q, k)[0] for q in queries]
+    t0 = time.perf_counter()
+    for q in queries:
+        search_exact(emb_ram, q, k)
+    t_f32 = (time.perf_counter() - t0) / nq * 1e6
+
+    print(f"{src}: paragraphs={n} dim={dim} k={k} rerank={RAG_RERANK_FACTOR}*k")
+    print(f"  {'float32':26s} {emb_ram.nbytes / 2**20:8.1f} MB {t_f32:9.1f} µs/query  recall 1.000")
+    for dtype in ("float16", "int8"):
+        quant = quantize(emb, dtype)
+        mb = sum(v.nbytes for v in quant.values() if isinstance(v, np.ndarray)) / 2**20
+        # quantized scores alone, then with the float32 re-rank
+        raw = [top_k(quantized_scores(quant, q), k) for q in queries]
+        t0 = time.perf_counter()
+        res = [search_exact(emb, q, k, quant=quant)[0] for q in queries]
+        t = (time.perf_counter() - t0) / nq * 1e6
+        print(f"  {dtype + ' (no re-rank)':26s} {mb:8.1f} MB {'':9s}             recall {recall(raw, truth):.3f}")
+        print(f"  {dtype + ' + re-rank':26s} {mb:8.1f} MB {t:9.1f} µs/query  recall {recall(res, truth):.3f}")
+
+
+if __name__ == "__main__":
+    main()
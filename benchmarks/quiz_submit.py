@@ -0,0 +1,134 @@
+# quiz_submit.py
+"""
+Microbenchmark: quiz_submit grading, old per-answer path vs batch path.
+"old" is the original code, copied here: linear question lookup and a full
+quiz_stats.json rewrite per answer. "batch" is grade_answers +
+apply_quiz_results on the configured backend.
+
+    python -m benchmarks.quiz_submit [questions] [submissions]
+
+Runs against a throw-away DATA_DIR so real data is never touched.
+"""
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+os.environ["DATA_DIR"] = tempfile.mkdtemp(prefix="kebbi_bench_")
+
+from app import storage  # noqa: E402
+from app.config import QUIZ_STATS_PATH, flush_json  # noqa: E402
+from benchmarks.arabic_text import old_normalize_ans  # noqa: E402
+
+OLD_FILE_LOCK = threading.Lock()
+
+
+def make_quiz(n_questions, subject="math"):
+    questions = [
+        {"id": f"q{i}", "q": f"{i} × 7 = ?", "a": str(i * 7)} for i in range(n_questions)
+    ]
+    return storage.add_quiz(
+        {"title": "bench", "questions": questions},
+        {"stage": "Stage 1", "section": "A", "subject": subject},
+    )
+
+
+def make_answers(n_questions):
+    # every third answer wrong, Arabic-Indic digits for the right ones
+    out = []
+    for i in range(n_questions):
+        ans = str(i * 7).translate(str.maketrans("0123456789", "٠١٢٣٤٥٦٧٨٩"))
+        out.append({"qid": f"q{i}", "answer": "x" if i % 3 == 0 else ans})
+    return out
+
+
+def old_save_json(path, obj):
+    # the previous config.save_json: the whole file, synchronously
+    with OLD_FILE_LOCK:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(obj, f, ensure_ascii=False, indent=2)
+
+
+def old_update_quiz_stats(quiz_id, qid, correct, wrong_answer=None):
+    # the previous update_quiz_stats: in-memory update + full quiz_stats.json rewrite
+    stats = storage.QUIZ_STATS.setdefault(quiz_id, storage._empty_quiz_stats())
+    qs = stats["questions"].setdefault(
+        qid, {"attempts": 0, "correct": 0, "wrong": 0, "wrongs": {}}
+    )
+    qs["attempts"] += 1
+    if correct:
+        qs["correct"] += 1
+        stats["total_correct"] += 1
+    else:
+        qs["wrong"] += 1
+        stats["total_wrong"] += 1
+        if wrong_answer:
+            qs["wrongs"][wrong_answer] = qs["wrongs"].get(wrong_answer, 0) + 1
+    stats["total_attempts"] += 1
+    old_save_json(QUIZ_STATS_PATH, storage.QUIZ_STATS)
+
+
+def submit_old(quiz_id, answers):
+    # the previous quiz_submit body: linear search + stats update per answer
+    quiz = storage.QUIZZES["quizzes"][quiz_id]
+    score = 0
+    for a in answers:
+        qid = a.get("qid")
+        ans = str(a.get("answer", ""))
+        qobj = next((it for it in quiz.get("questions", []) if it.get("id") == qid), None)
+        if not qobj:
+            continue
+        correct = old_normalize_ans(ans) == old_normalize_ans(str(qobj.get("a", "")))
+        old_update_quiz_stats(quiz_id, qid, correct, wrong_answer=(ans if not correct else None))
+        if correct:
+            score += 1
+    return score
+
+
+def submit_batch(quiz_id, answers):
+    score, results = storage.grade_answers(quiz_id, answers)
+    storage.apply_quiz_results(quiz_id, results)
+    return score
+
+
+def check_order():
+    # find_quizzes must follow QUIZZES order, also after a delete then add
+    ids = [make_quiz(1), make_quiz(1, "science"), make_quiz(1, "science")]
+    storage.delete_quiz(ids.pop(1))
+    ids.append(make_quiz(1))
+    found = [qid for qid, _ in storage.find_quizzes("Stage 1", "A")]
+    assert found == list(storage.QUIZZES["quizzes"]), found
+    for qid in ids:
+        storage.delete_quiz(qid)
+
+
+def run(fn, quiz_id, answers, submissions):
+    t0 = time.perf_counter()
+    for _ in range(submissions):
+        score = fn(quiz_id, answers)
+    flush_json()
+    return time.perf_counter() - t0, score
+
+
+def main():
+    n_questions = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    submissions = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    check_order()
+    answers = make_answers(n_questions)
+    qa, qb = make_quiz(n_questions), make_quiz(n_questions)
+
+    t_old, s_old = run(submit_old, qa, answers, submissions)
+    t_new, s_new = run(submit_batch, qb, answers, submissions)
+    assert s_old == s_new, (s_old, s_new)
+    assert storage.QUIZ_STATS[qa] == storage.QUIZ_STATS[qb]
+
+    print(f"backend={storage.STORAGE_BACKEND} questions={n_questions} submissions={submissions}")
+    for name, t in (("old (per answer)", t_old), ("batch", t_new)):
+        print(f"  {name:18s} {t * 1000:9.1f} ms  {t / submissions * 1e6:9.1f} µs/submit")
+    print(f"  speedup x{t_old / t_new:.1f}")
+
+
+if __name__ == "__main__":
+    main()
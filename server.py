@@ -6,19 +6,20 @@ from urllib.parse import unquote_plus
 import datetime
 from collections import Counter
 import requests
-from app.config import (
-    SETTINGS_PATH, ROBOTS_PATH, STAGES_PATH,
-    QUIZ_PATH, QUIZ_STATS_PATH, ATTENDANCE_PATH,
-    PROGRESS_PATH, save_json, now_iso, DEFAULT_SUBJECTS, new_id
-)
+from app.config import now_iso, DEFAULT_SUBJECTS, new_id, RAG_WARMUP, RAG_TOP_K
 
 from app.storage import (
     SETTINGS,                      # ← هذا اللي ينقصك
-    ROBOTS, STAGES, QUIZZES, QUIZ_STATS, ATTENDANCE, PROGRESS,
+    ROBOTS, STAGES, QUIZZES, QUIZ_STATS, PROGRESS,
     ensure_stage_structure, get_students, set_students,
-    mark_attendance, get_attendance_for_subject, get_attendance_history,
-    add_quiz, delete_quiz, update_quiz_stats,
-    generate_subject_questions, normalize_ans
+    add_student_to_section, remove_student_from_section, ensure_subject_students,
+    mark_attendance, get_attendance_for_subject, get_attendance_for_date,
+    query_attendance,
+    add_quiz, delete_quiz, update_quiz_stats, grade_answers, apply_quiz_results,
+    generate_subject_questions, normalize_ans,
+    persist_set, persist_delete, persist_all,
+    collection_lock, record_progress, refresh_stale_collections,
+    find_quizzes, read_copy
 )
 
 
@@ -34,15 +35,27 @@ from app.templates import (
 
 from app.ai_utils import classify_intent, lang_rule_system
 
+from app.sessions import create_session, get_session, save_session
+
+from app.ingest import submit_book_upload, submit_book_rechunk, get_job, list_jobs
+from app.chunking import CHUNKING_STRATEGIES
 from app.rag_utils import (
-    subject_book_exists, save_uploaded_book,
-    subject_rag_answer, run_book_rag, wrap_contexts
+    subject_book_exists, subject_chunking,
+    subject_rag_answer, run_book_rag, wrap_contexts,
+    start_model_warmup, rag_status, cached_book_answer, retrieve_top_k_for_stage,
+    retrieval_mode
 )
 
 
 # ------------------ FLASK APP ------------------
 app = Flask(__name__)
 
+
+@app.before_request
+def sync_shared_state():
+    # shared mode (several workers): pick up other workers' writes
+    refresh_stale_collections()
+
 # ------------------ ROUTES ------------------
 
 
@@ -51,8 +64,8 @@ def home_page():
     ensure_stage_structure()
     return render_template_string(
         layout("Home", "home", HOME_HTML),
-        robots=ROBOTS,
-        stages=STAGES.keys(),
+        robots=read_copy("robots"),
+        stages=list(read_copy("stages")),
     )
 
 
@@ -65,33 +78,36 @@ def robot_add():
     linked_section = (request.form.get("linked_section") or "").strip()
     if not serial:
         return "Missing serial", 400
-    ROBOTS[serial] = {
-        "name": name,
-        "linked_stage": linked_stage or None,
-        "linked_section": linked_section or None,
-        "active": True,
-        "connected": False,
-        "created_at": now_iso(),
-    }
-    save_json(ROBOTS_PATH, ROBOTS)
+    with collection_lock("robots"):
+        ROBOTS[serial] = {
+            "name": name,
+            "linked_stage": linked_stage or None,
+            "linked_section": linked_section or None,
+            "active": True,
+            "connected": False,
+            "created_at": now_iso(),
+        }
+        persist_set("robots", [serial], ROBOTS[serial])
     return redirect(url_for("home_page"))
 
 
 @app.route("/robot/toggle", methods=["POST"])
 def robot_toggle():
     serial = (request.form.get("serial") or "").strip()
-    if serial in ROBOTS:
-        ROBOTS[serial]["active"] = not ROBOTS[serial].get("active", False)
-        save_json(ROBOTS_PATH, ROBOTS)
+    with collection_lock("robots"):
+        if serial in ROBOTS:
+            ROBOTS[serial]["active"] = not ROBOTS[serial].get("active", False)
+            persist_set("robots", [serial], ROBOTS[serial])
     return redirect(url_for("home_page"))
 
 
 @app.route("/robot/delete", methods=["POST"])
 def robot_delete():
     serial = (request.form.get("serial") or "").strip()
-    if serial in ROBOTS:
-        del ROBOTS[serial]
-        save_json(ROBOTS_PATH, ROBOTS)
+    with collection_lock("robots"):
+        if serial in ROBOTS:
+            del ROBOTS[serial]
+            persist_delete("robots", [serial])
     return redirect(url_for("home_page"))
 
 
@@ -101,14 +117,14 @@ def stages_page():
     ensure_stage_structure()
     return render_template_string(
         layout("Stages", "stages", STAGES_HTML),
-        stages=STAGES,
+        stages=read_copy("stages"),
     )
 
 
 # Stage page
 @app.route("/stages/<stage>")
 def stage_page(stage):
-    s = STAGES.get(stage)
+    s = read_copy("stages", stage)
     if not s:
         return "Not found", 404
     return render_template_string(
@@ -121,14 +137,13 @@ def stage_page(stage):
 # Section dashboard
 @app.route("/stages/<stage>/<section>")
 def section_dashboard(stage, section):
-    sdata = STAGES.get(stage, {}).get("sections", {}).get(section)
+    sdata = read_copy("stages", stage, "sections", section)
     if sdata is None:
         return "Not found", 404
     students = sdata.get("students", [])
     subjects = sdata.get("subjects", DEFAULT_SUBJECTS[:])
     if "subject_students" not in sdata:
-        sdata["subject_students"] = {s: [] for s in DEFAULT_SUBJECTS}
-        save_json(STAGES_PATH, STAGES)
+        ensure_subject_students(stage, section)
     return render_template_string(
         layout(f"{stage} — Section {section}", "stages", SECTION_DASH_HTML),
         stage=stage,
@@ -141,7 +156,7 @@ def section_dashboard(stage, section):
 # Students page
 @app.route("/stages/<stage>/<section>/students", methods=["GET"])
 def section_students_page(stage, section):
-    sdata = STAGES.get(stage, {}).get("sections", {}).get(section)
+    sdata = read_copy("stages", stage, "sections", section)
     if sdata is None:
         return "Not found", 404
     students = sdata.get("students", [])
@@ -156,13 +171,12 @@ def section_students_page(stage, section):
 # Subjects page
 @app.route("/stages/<stage>/<section>/subjects", methods=["GET"])
 def section_subjects_page(stage, section):
-    sdata = STAGES.get(stage, {}).get("sections", {}).get(section)
+    sdata = read_copy("stages", stage, "sections", section)
     if sdata is None:
         return "Not found", 404
     subjects = sdata.get("subjects", DEFAULT_SUBJECTS[:])
     if "subject_students" not in sdata:
-        sdata["subject_students"] = {s: [] for s in subjects}
-        save_json(STAGES_PATH, STAGES)
+        ensure_subject_students(stage, section)
     return render_template_string(
         layout("Subjects", "stages", SUBJECTS_PAGE_HTML),
         stage=stage,
@@ -174,7 +188,7 @@ def section_subjects_page(stage, section):
 # Subject page
 @app.route("/stages/<stage>/<section>/subjects/<subject>")
 def subject_page(stage, section, subject):
-    sdata = STAGES.get(stage, {}).get("sections", {}).get(section)
+    sdata = read_copy("stages", stage, "sections", section)
     if sdata is None:
         return "Not found", 404
     subjects = sdata.get("subjects", DEFAULT_SUBJECTS[:])
@@ -193,17 +207,13 @@ def subject_page(stage, section, subject):
     methods=["GET"],
 )
 def attendance_subject_page(stage, section, subject):
-    sdata = STAGES.get(stage, {}).get("sections", {}).get(section)
+    sdata = read_copy("stages", stage, "sections", section)
     if sdata is None:
         return "Not found", 404
 
     subj_map = sdata.get("subject_students")
     if subj_map is None:
-        sdata["subject_students"] = {
-            s: [] for s in sdata.get("subjects", DEFAULT_SUBJECTS[:])
-        }
-        subj_map = sdata["subject_students"]
-        save_json(STAGES_PATH, STAGES)
+        subj_map = ensure_subject_students(stage, section) or {}
 
     students = subj_map.get(subject, [])
     today = datetime.date.today().isoformat()
@@ -222,7 +232,7 @@ def attendance_subject_page(stage, section, subject):
 # NEW: Subject RAG page
 @app.route("/stages/<stage>/<section>/subjects/<subject>/book", methods=["GET", "POST"])
 def subject_rag_page(stage, section, subject):
-    sdata = STAGES.get(stage, {}).get("sections", {}).get(section)
+    sdata = read_copy("stages", stage, "sections", section)
     if sdata is None:
         return "Not found", 404
     subjects = sdata.get("subjects", DEFAULT_SUBJECTS[:])
@@ -234,20 +244,22 @@ def subject_rag_page(stage, section, subject):
     answer = ""
     message = ""
     ctx_list = []
+    pack = {}
 
     if request.method == "POST":
         file = request.files.get("file")
+        chunking = request.form.get("chunking") or None
         if file and file.filename:
             if not file.filename.lower().endswith(".docx"):
                 message = "الرجاء رفع ملف بصيغة .docx فقط."
             else:
-                ok, err = save_uploaded_book(file, stage, section, subject)
-                if ok:
-                    message = "تم رفع الكتاب ومعالجته بنجاح. يمكنك الآن طرح الأسئلة."
-                    has_book = True
-                else:
-                    message = f"حدث خطأ أثناء معالجة الكتاب: {err}"
-                    has_book = subject_book_exists(stage, section, subject)
+                submit_book_upload(file, stage, section, subject, chunking=chunking)
+                message = "تم استلام الكتاب، وتجري معالجته في الخلفية. الكتاب الحالي (إن وجد) يبقى متاحاً حتى تنتهي المعالجة."
+        elif request.form.get("action") == "rechunk":
+            if submit_book_rechunk(stage, section, subject, chunking):
+                message = "يُعاد تقسيم الكتاب الحالي في الخلفية، ويبقى التقسيم القديم متاحاً حتى تنتهي المعالجة."
+            else:
+                message = "لم يتم رفع كتاب لهذه المادة بعد."
         else:
             question = (request.form.get("question") or "").strip()
             if question:
@@ -255,7 +267,7 @@ def subject_rag_page(stage, section, subject):
                     message = "لم يتم رفع كتاب لهذه المادة بعد."
                 else:
                     ans, retrieved, err = subject_rag_answer(
-                        question, stage, section, subject
+                        question, stage, section, subject, stats=pack
                     )
                     if err:
                         message = f"خطأ في استدعاء الذكاء الاصطناعي: {err}"
@@ -263,27 +275,32 @@ def subject_rag_page(stage, section, subject):
                         answer = ans
                         ctx_list = wrap_contexts(retrieved)
 
+    jobs = list_jobs(stage, section, subject, limit=1)
     return render_template_string(
         layout("Book Assistant", "stages", SUBJECT_RAG_HTML),
         stage=stage,
         section=section,
         subject=subject,
         has_book=has_book,
+        chunking=subject_chunking(stage, section, subject),
+        strategies=CHUNKING_STRATEGIES,
+        job=jobs[0] if jobs else None,
         question=question,
         answer=answer,
         message=message,
         contexts=ctx_list,
+        pack=pack,
     )
 
 
 # Quizzes for a subject (list + create/generate)
 @app.route("/stages/<stage>/<section>/<subject>/quizzes")
 def quizzes_subject_page(stage, section, subject):
-    sdata = STAGES.get(stage, {}).get("sections", {}).get(section)
+    sdata = read_copy("stages", stage, "sections", section)
     if sdata is None:
         return "Not found", 404
     qlist = []
-    for qid, q in QUIZZES.get("quizzes", {}).items():
+    for qid, q in find_quizzes(stage, section, subject):
         meta = q.get("meta", {})
         if (
             meta.get("stage") == stage
@@ -314,20 +331,14 @@ def add_student(stage, section):
         return redirect(
             url_for("section_students_page", stage=stage, section=section)
         )
-    students = get_students(stage, section)
-    if name not in students:
-        students.append(name)
-        set_students(stage, section, students)
+    add_student_to_section(stage, section, name)
     return redirect(url_for("section_students_page", stage=stage, section=section))
 
 
 @app.route("/stages/<stage>/<section>/student/remove", methods=["POST"])
 def remove_student(stage, section):
     name = (request.form.get("name") or "").strip()
-    students = get_students(stage, section)
-    if name in students:
-        students.remove(name)
-        set_students(stage, section, students)
+    remove_student_from_section(stage, section, name)
     return redirect(url_for("section_students_page", stage=stage, section=section))
 
 
@@ -364,19 +375,63 @@ def attendance_mark(stage, section):
     return redirect(url_for("section_students_page", stage=stage, section=section))
 
 
-@app.route("/stages/<stage>/<section>/attendance/view")
-def attendance_view(stage, section):
-    students = get_students(stage, section)
-    history = get_attendance_history(stage, section)
+def _attendance_query_args():
+    """?from=YYYY-MM-DD&to=YYYY-MM-DD&page=N (all optional)."""
+    try:
+        page = max(1, int(request.args.get("page") or 1))
+    except ValueError:
+        page = 1
+    return {
+        "date_from": (request.args.get("from") or "").strip() or None,
+        "date_to": (request.args.get("to") or "").strip() or None,
+        "page": page,
+    }
+
+
+def _render_attendance_view(stage, section, subject=None):
+    args = _attendance_query_args()
+    res = query_attendance(stage, section, subject, **args)
+
+    def page_url(page):
+        return url_for(
+            request.endpoint, **request.view_args, page=page,
+            **{"from": args["date_from"], "to": args["date_to"]}
+        )
+
     return render_template_string(
         layout("Attendance History", "stages", ATTENDANCE_VIEW_HTML),
         stage=stage,
         section=section,
-        students=students,
-        history=history,
+        students=get_students(stage, section),
+        history=dict(res["items"]),
+        date_from=args["date_from"] or "",
+        date_to=args["date_to"] or "",
+        newer_url=page_url(res["page"] - 1) if res["page"] > 1 else None,
+        older_url=page_url(res["page"] + 1) if res["has_more"] else None,
     )
 
 
+@app.route("/stages/<stage>/<section>/attendance/view")
+def attendance_view(stage, section):
+    return _render_attendance_view(stage, section)
+
+
+@app.route("/api/attendance/<stage>/<section>")
+def api_attendance_range(stage, section):
+    """JSON range query: ?subject=&from=&to=&page=&per_page="""
+    subject = (request.args.get("subject") or "").strip() or None
+    kwargs = _attendance_query_args()
+    try:
+        per_page = int(request.args.get("per_page") or 0)
+    except ValueError:
+        per_page = 0
+    if per_page > 0:
+        kwargs["per_page"] = min(per_page, 366)
+    res = query_attendance(stage, section, subject, **kwargs)
+    res["items"] = [{"date": d, "attendance": row} for d, row in res["items"]]
+    return jsonify({"ok": True, **res})
+
+
 # QUIZZES: list all (disabled)
 @app.route("/quizzes")
 def quizzes_list_page():
@@ -577,7 +632,7 @@ def parse_ai_output_to_qa(text, qtype="short"):
 
 @app.route("/quizzes/preview/<quiz_id>")
 def quiz_preview(quiz_id):
-    q = QUIZZES.get("quizzes", {}).get(quiz_id)
+    q = read_copy("quizzes", "quizzes", quiz_id)
     if not q:
         return "Not found", 404
     meta = q.get("meta", {})
@@ -591,10 +646,10 @@ def quiz_preview(quiz_id):
 
 @app.route("/quizzes/stats/<quiz_id>")
 def quiz_stats_page(quiz_id):
-    q = QUIZZES.get("quizzes", {}).get(quiz_id)
+    q = read_copy("quizzes", "quizzes", quiz_id)
     if not q:
         return "Not found", 404
-    stats = QUIZ_STATS.get(quiz_id, {})
+    stats = read_copy("quiz_stats", quiz_id, default={})
     totals = {
         "total_attempts": stats.get("total_attempts", 0),
         "total_correct": stats.get("total_correct", 0),
@@ -646,7 +701,7 @@ def quiz_delete(quiz_id):
 
 @app.route("/quizzes/scores/<quiz_id>")
 def quiz_scores_page(quiz_id):
-    q = QUIZZES.get("quizzes", {}).get(quiz_id)
+    q = read_copy("quizzes", "quizzes", quiz_id)
     if not q:
         return "Not found", 404
     meta = q.get("meta", {})
@@ -656,9 +711,15 @@ def quiz_scores_page(quiz_id):
     students = []
     if stage and section:
         students = get_students(stage, section)
+    with collection_lock("progress", write=False):
+        done = {
+            s: dict(PROGRESS[s]["completed"][quiz_id])
+            for s in students
+            if quiz_id in PROGRESS.get(s, {}).get("completed", {})
+        }
     rows = []
     for s in students:
-        rec = PROGRESS.get(s, {}).get("completed", {}).get(quiz_id)
+        rec = done.get(s)
         if rec:
             rows.append(
                 {
@@ -694,34 +755,14 @@ def quiz_submit(quiz_id):
     answers = data.get("answers", [])
     if not student:
         return jsonify({"ok": False, "error": "missing student"}), 400
-    quiz = QUIZZES.get("quizzes", {}).get(quiz_id)
+    quiz = read_copy("quizzes", "quizzes", quiz_id)
     if not quiz:
         return jsonify({"ok": False, "error": "invalid quiz_id"}), 400
-    score = 0
-    for a in answers:
-        qid = a.get("qid")
-        ans = str(a.get("answer", ""))
-        qobj = next(
-            (it for it in quiz.get("questions", []) if it.get("id") == qid), None
-        )
-        if not qobj:
-            continue
-        correct_ans = str(qobj.get("a", ""))
-        correct = normalize_ans(ans) == normalize_ans(correct_ans)
-        update_quiz_stats(
-            quiz_id, qid, correct, wrong_answer=(ans if not correct else None)
-        )
-        if correct:
-            score += 1
-    PROGRESS.setdefault(student, {}).setdefault("completed", {})[quiz_id] = {
-        "score": score,
-        "total": len(quiz.get("questions", [])),
-        "finished_at": now_iso(),
-    }
-    save_json(PROGRESS_PATH, PROGRESS)
-    return jsonify(
-        {"ok": True, "score": score, "total": len(quiz.get("questions", []))}
-    )
+    score, results = grade_answers(quiz_id, answers)
+    apply_quiz_results(quiz_id, results)
+    total = len(quiz.get("questions", []))
+    record_progress(student, quiz_id, score, total, now_iso())
+    return jsonify({"ok": True, "score": score, "total": total})
 
 
 # ANALYTICS
@@ -729,16 +770,17 @@ def quiz_submit(quiz_id):
 def analytics_page():
     per_stage = {}
     total_students = 0
-    for sname, sdata in STAGES.items():
-        cnt = 0
-        for sec, secdata in sdata.get("sections", {}).items():
-            cnt += len(secdata.get("students", []))
-        per_stage[sname] = cnt
-        total_students += cnt
+    with collection_lock("stages", write=False):
+        for sname, sdata in STAGES.items():
+            cnt = 0
+            for sec, secdata in sdata.get("sections", {}).items():
+                cnt += len(secdata.get("students", []))
+            per_stage[sname] = cnt
+            total_students += cnt
     today = datetime.date.today().isoformat()
-    attendance_today = ATTENDANCE.get(today, {})
     present = 0
     checked = 0
+    attendance_today = get_attendance_for_date(today)
     for sname, sdata in attendance_today.items():
         for sec, secmap in sdata.items():
             for st, val in secmap.items():
@@ -746,9 +788,10 @@ def analytics_page():
                 if val:
                     present += 1
     pct = round((100.0 * present / checked), 1) if checked else 0.0
-    total_quiz_attempts = sum(
-        v.get("total_attempts", 0) for v in QUIZ_STATS.values()
-    )
+    with collection_lock("quiz_stats", write=False):
+        total_quiz_attempts = sum(
+            v.get("total_attempts", 0) for v in QUIZ_STATS.values()
+        )
     totals = {
         "total_students": total_students,
         "attendance_pct": pct,
@@ -778,20 +821,22 @@ def settings_page():
             max_tokens = 400
         system_prompt = (request.form.get("system_prompt") or "").strip()
         always_correct = request.form.get("always_correct", "0").strip() == "1"
-        SETTINGS.update(
-            {
-                "api_key": api_key,
-                "model": model,
-                "temperature": temperature,
-                "max_tokens": max_tokens,
-                "system_prompt": system_prompt,
-                "always_correct": always_correct,
-            }
-        )
-        save_json(SETTINGS_PATH, SETTINGS)
+        new_values = {
+            "api_key": api_key,
+            "model": model,
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+            "system_prompt": system_prompt,
+            "always_correct": always_correct,
+        }
+        # one acquisition: a refresh before a separate persist would drop the update
+        with collection_lock("settings"):
+            SETTINGS.update(new_values)
+            for key, value in new_values.items():
+                persist_set("settings", [key], value)
         return redirect(url_for("settings_page"))
     return render_template_string(
-        layout("Settings", "settings", SETTINGS_HTML), **SETTINGS
+        layout("Settings", "settings", SETTINGS_HTML), **read_copy("settings")
     )
 
 
@@ -847,22 +892,23 @@ def api_robot_heartbeat():
     if not serial:
         return jsonify({"ok": False, "error": "missing serial"}), 400
     now = now_iso()
-    r = ROBOTS.get(serial)
-    if not r:
-        ROBOTS[serial] = {
-            "name": serial,
-            "linked_stage": None,
-            "linked_section": None,
-            "active": True,
-            "connected": True,
-            "created_at": now,
-            "last_seen": now,
-        }
-    else:
-        r["connected"] = True
-        r["active"] = True
-        r["last_seen"] = now
-    save_json(ROBOTS_PATH, ROBOTS)
+    with collection_lock("robots"):
+        r = ROBOTS.get(serial)
+        if not r:
+            ROBOTS[serial] = {
+                "name": serial,
+                "linked_stage": None,
+                "linked_section": None,
+                "active": True,
+                "connected": True,
+                "created_at": now,
+                "last_seen": now,
+            }
+        else:
+            r["connected"] = True
+            r["active"] = True
+            r["last_seen"] = now
+        persist_set("robots", [serial], ROBOTS[serial])
     return jsonify({"ok": True, "serial": serial, "connected": True, "last_seen": now})
 
 
@@ -872,9 +918,10 @@ def api_robot_disconnect():
     serial = (data.get("serial") or "").strip()
     if not serial:
         return jsonify({"ok": False, "error": "missing serial"}), 400
-    if serial in ROBOTS:
-        ROBOTS[serial]["connected"] = False
-        save_json(ROBOTS_PATH, ROBOTS)
+    with collection_lock("robots"):
+        if serial in ROBOTS:
+            ROBOTS[serial]["connected"] = False
+            persist_set("robots", [serial], ROBOTS[serial])
     return jsonify({"ok": True, "serial": serial, "connected": False})
 
 
@@ -882,8 +929,9 @@ def api_robot_disconnect():
 def api_get_stages():
     ensure_stage_structure()
     out = {}
-    for sname, sdata in STAGES.items():
-        out[sname] = {"sections": list(sdata.get("sections", {}).keys())}
+    with collection_lock("stages", write=False):
+        for sname, sdata in STAGES.items():
+            out[sname] = {"sections": list(sdata.get("sections", {}).keys())}
     return jsonify({"ok": True, "stages": out})
 
 
@@ -901,14 +949,15 @@ def api_get_set_subjects(stage, section):
     subs = data.get("subjects")
     if not isinstance(subs, list):
         return jsonify({"ok": False, "error": "invalid subjects"}), 400
-    sec = STAGES.setdefault(stage, {}).setdefault(
-        "sections", {}
-    ).setdefault(section, _section_default())
-    sec["subjects"] = subs
-    ss = sec.setdefault("subject_students", {})
-    for sname in subs:
-        ss.setdefault(sname, [])
-    save_json(STAGES_PATH, STAGES)
+    with collection_lock("stages"):
+        sec = STAGES.setdefault(stage, {}).setdefault(
+            "sections", {}
+        ).setdefault(section, _section_default())
+        sec["subjects"] = subs
+        ss = sec.setdefault("subject_students", {})
+        for sname in subs:
+            ss.setdefault(sname, [])
+        persist_set("stages", [stage, "sections", section], sec)
     return jsonify({"ok": True, "stage": stage, "section": section, "subjects": subs})
 
 
@@ -922,7 +971,7 @@ def _section_default():
 
 @app.route("/api/subject_students/<stage>/<section>/<subject>", methods=["GET"])
 def api_get_subject_students(stage, section, subject):
-    s = STAGES.get(stage, {}).get("sections", {}).get(section)
+    s = read_copy("stages", stage, "sections", section)
     if s is None:
         return jsonify({"ok": False, "error": "not found"}), 404
     subjmap = s.get("subject_students", {})
@@ -944,7 +993,7 @@ def api_get_lessons(stage, section, subject):
         )
 
     items = []
-    for qid, q in QUIZZES.get("quizzes", {}).items():
+    for qid, q in find_quizzes(stage, section, subj):
         meta = q.get("meta", {})
         if (
             meta.get("stage") == stage
@@ -979,56 +1028,57 @@ def registration_mark():
     found_stage = None
     found_section = None
 
-    if stage_hint and section_hint and STAGES.get(stage_hint, {}).get(
-        "sections", {}
-    ).get(section_hint):
-        found_stage, found_section = stage_hint, section_hint
-
-    if not found_stage and serial and serial in ROBOTS:
-        r = ROBOTS.get(serial, {})
+    if not found_stage and serial:
+        r = read_copy("robots", serial, default={})
         if r.get("linked_stage") and r.get("linked_section"):
             found_stage = r.get("linked_stage")
             found_section = r.get("linked_section")
 
-    if not found_stage and subject:
-        subj_lower = subject.lower()
-        for sname, sdata in STAGES.items():
-            for secname, secdata in sdata.get("sections", {}).items():
-                subs = [x.lower() for x in secdata.get("subjects", [])]
-                if subj_lower in subs:
-                    found_stage, found_section = sname, secname
+    with collection_lock("stages"):
+        if stage_hint and section_hint and STAGES.get(stage_hint, {}).get(
+            "sections", {}
+        ).get(section_hint):
+            found_stage, found_section = stage_hint, section_hint
+
+        if not found_stage and subject:
+            subj_lower = subject.lower()
+            for sname, sdata in STAGES.items():
+                for secname, secdata in sdata.get("sections", {}).items():
+                    subs = [x.lower() for x in secdata.get("subjects", [])]
+                    if subj_lower in subs:
+                        found_stage, found_section = sname, secname
+                        break
+                if found_stage:
                     break
-            if found_stage:
-                break
 
-    if not found_stage:
-        found_stage, found_section = "Stage 1", "A"
+        if not found_stage:
+            found_stage, found_section = "Stage 1", "A"
 
-    secobj = STAGES.setdefault(found_stage, {}).setdefault(
-        "sections", {}
-    ).setdefault(found_section, _section_default())
+        secobj = STAGES.setdefault(found_stage, {}).setdefault(
+            "sections", {}
+        ).setdefault(found_section, _section_default())
 
-    already_in_section = name in secobj.get("students", [])
-    subjmap = secobj.setdefault("subject_students", {})
-    if subject:
-        s_list = subjmap.setdefault(subject, [])
-        already_in_subject = name in s_list
-    else:
-        already_in_subject = False
+        already_in_section = name in secobj.get("students", [])
+        subjmap = secobj.setdefault("subject_students", {})
+        if subject:
+            s_list = subjmap.setdefault(subject, [])
+            already_in_subject = name in s_list
+        else:
+            already_in_subject = False
 
-    added_to_section = False
-    added_to_subject = False
-    if not already_in_section:
-        secobj.setdefault("students", []).append(name)
-        added_to_section = True
+        added_to_section = False
+        added_to_subject = False
+        if not already_in_section:
+            secobj.setdefault("students", []).append(name)
+            added_to_section = True
 
-    if subject:
-        s_list = subjmap.setdefault(subject, [])
-        if name not in s_list:
-            s_list.append(name)
-            added_to_subject = True
+        if subject:
+            s_list = subjmap.setdefault(subject, [])
+            if name not in s_list:
+                s_list.append(name)
+                added_to_subject = True
 
-    save_json(STAGES_PATH, STAGES)
+        persist_set("stages", [found_stage, "sections", found_section], secobj)
 
     date_str = datetime.date.today().isoformat()
     mark_attendance(
@@ -1056,21 +1106,9 @@ def __routes():
     return {"routes": [str(r) for r in app.url_map.iter_rules()]}
 
 
-# --- Simple in-memory sessions (not persisted) ---
-SESSIONS = {}
-
-
 @app.route("/stages/<stage>/<section>/subjects/<subject>/attendance/view")
 def attendance_view_subject(stage, section, subject):
-    students = get_students(stage, section)
-    history = get_attendance_history(stage, section, subject=subject)
-    return render_template_string(
-        layout("Attendance History", "stages", ATTENDANCE_VIEW_HTML),
-        stage=stage,
-        section=section,
-        students=students,
-        history=history,
-    )
+    return _render_attendance_view(stage, section, subject)
 
 
 @app.route("/quizzes/api/list")
@@ -1083,56 +1121,15 @@ def api_quizzes_list():
     if not subj and not (stage_filter and section_filter):
         return jsonify({"ok": True, "quizzes": []})
 
-    synonyms = {
-        "math": "mathematics",
-        "mathematics": "mathematics",
-        "computer": "computer",
-        "computing": "computer",
-        "cs": "computer",
-        "eng": "english",
-        "english": "english",
-        "arabic": "arabic",
-        "science": "science",
-        "history": "history",
-        "geography": "geography",
-        "religion": "religion",
-    }
-
-    def norm(s):
-        return (s or "").strip().lower()
-
-    def subject_matches(meta_subject, query_subj):
-        if not query_subj:
-            return True
-        ms = norm(meta_subject)
-        qs = norm(query_subj)
-        if not ms or not qs:
-            return False
-        if ms == qs:
-            return True
-        if qs in synonyms and synonyms.get(qs) == ms:
-            return True
-        if ms in synonyms and synonyms.get(ms) == qs:
-            return True
-        if len(qs) >= 4 and (qs in ms or ms in qs):
-            return True
-        return False
-
     items = []
-    for qid, q in QUIZZES.get("quizzes", {}).items():
+    for qid, q in find_quizzes(
+        stage=stage_filter or None,
+        section=section_filter or None,
+        subject=subj or None,
+        fuzzy=True,
+        match_title=True,
+    ):
         meta = q.get("meta", {}) or {}
-        qstage = meta.get("stage") or ""
-        qsection = meta.get("section") or ""
-        qsubject = meta.get("subject") or ""
-        if stage_filter and norm(qstage) != norm(stage_filter):
-            continue
-        if section_filter and norm(qsection) != norm(section_filter):
-            continue
-        if subj:
-            if not subject_matches(qsubject, subj):
-                title = q.get("title", "")
-                if subj not in norm(title):
-                    continue
         items.append(
             {
                 "quiz_id": qid,
@@ -1146,10 +1143,9 @@ def api_quizzes_list():
 
 @app.route("/quizzes/api/active")
 def api_quizzes_active():
-    aid = QUIZZES.get("active_id")
-    if not aid:
-        return jsonify({"ok": True, "active": None})
-    q = QUIZZES.get("quizzes", {}).get(aid)
+    with collection_lock("quizzes", write=False):
+        aid = QUIZZES.get("active_id")
+        q = read_copy("quizzes", "quizzes", aid) if aid else None
     if not q:
         return jsonify({"ok": True, "active": None})
     return jsonify(
@@ -1170,12 +1166,12 @@ def api_quizzes_start():
     data = request.get_json(silent=True) or {}
     quiz_id = (data.get("quiz_id") or "").strip()
     student = (data.get("student_name") or "").strip()
-    q = QUIZZES.get("quizzes", {}).get(quiz_id)
+    q = read_copy("quizzes", "quizzes", quiz_id)
     if not q:
         return jsonify({"ok": False, "error": "invalid_quiz_id"}), 400
     total = len(q.get("questions", []))
     if student:
-        rec = PROGRESS.get(student, {}).get("completed", {}).get(quiz_id)
+        rec = read_copy("progress", student, "completed", quiz_id)
         if rec:
             return jsonify(
                 {
@@ -1185,25 +1181,26 @@ def api_quizzes_start():
                     "total": rec.get("total", total),
                 }
             )
-    sid = f"sess_{len(SESSIONS)+1}"
-    SESSIONS[sid] = {
-        "quiz_id": quiz_id,
-        "student": student or None,
-        "index": 0,
-        "score": 0,
-        "total": total,
-        "started_at": now_iso(),
-    }
+    sid = create_session(
+        {
+            "quiz_id": quiz_id,
+            "student": student or None,
+            "index": 0,
+            "score": 0,
+            "total": total,
+            "started_at": now_iso(),
+        }
+    )
     return jsonify({"ok": True, "session_id": sid, "total": total})
 
 
 @app.route("/quizzes/api/next")
 def api_quizzes_next():
     sid = request.args.get("session_id", "").strip()
-    s = SESSIONS.get(sid)
+    s = get_session(sid)
     if not s:
         return jsonify({"ok": False, "error": "invalid_session"}), 400
-    quiz = QUIZZES.get("quizzes", {}).get(s["quiz_id"])
+    quiz = read_copy("quizzes", "quizzes", s["quiz_id"])
     if not quiz:
         return jsonify({"ok": False, "error": "invalid_quiz"}), 400
     idx = s["index"]
@@ -1230,10 +1227,10 @@ def api_quizzes_answer():
     data = request.get_json(silent=True) or {}
     sid = (data.get("session_id") or "").strip()
     ans = data.get("answer", "")
-    s = SESSIONS.get(sid)
+    s = get_session(sid)
     if not s:
         return jsonify({"ok": False, "error": "invalid_session"}), 400
-    quiz = QUIZZES.get("quizzes", {}).get(s["quiz_id"])
+    quiz = read_copy("quizzes", "quizzes", s["quiz_id"])
     if not quiz:
         return jsonify({"ok": False, "error": "invalid_quiz"}), 400
     idx = s["index"]
@@ -1251,18 +1248,14 @@ def api_quizzes_answer():
     if correct_flag:
         s["score"] = s.get("score", 0) + 1
     s["index"] = idx + 1
+    save_session(sid, s)
     remaining = s.get("total", 0) - s["index"]
     if s["index"] >= s.get("total", 0):
         student = s.get("student")
         if student:
-            PROGRESS.setdefault(student, {}).setdefault(
-                "completed", {}
-            )[s["quiz_id"]] = {
-                "score": s.get("score", 0),
-                "total": s.get("total", 0),
-                "finished_at": now_iso(),
-            }
-            save_json(PROGRESS_PATH, PROGRESS)
+            record_progress(
+                student, s["quiz_id"], s.get("score", 0), s.get("total", 0), now_iso()
+            )
     return jsonify(
         {
             "ok": True,
@@ -1276,21 +1269,14 @@ def api_quizzes_answer():
 @app.route("/quizzes/api/finish")
 def api_quizzes_finish():
     sid = request.args.get("session_id", "").strip()
-    s = SESSIONS.get(sid)
+    s = get_session(sid)
     if not s:
         return jsonify({"ok": False, "error": "invalid_session"}), 400
     score = s.get("score", 0)
     total = s.get("total", 0)
     student = s.get("student")
     if student:
-        PROGRESS.setdefault(student, {}).setdefault("completed", {})[
-            s["quiz_id"]
-        ] = {
-            "score": score,
-            "total": total,
-            "finished_at": now_iso(),
-        }
-        save_json(PROGRESS_PATH, PROGRESS)
+        record_progress(student, s["quiz_id"], score, total, now_iso())
     return jsonify({"ok": True, "score": score, "total": total})
 
 
@@ -1371,6 +1357,12 @@ def api_book_query(stage, section, subject):
     payload = request.get_json(force=True) or {}
     question = (payload.get("question") or "").strip()
     lang = (payload.get("lang") or "ar-SA").strip()
+    if not isinstance(payload.get("mode", ""), str):
+        return jsonify({"ok": False, "error": "invalid_mode"}), 400
+    if not isinstance(payload.get("rerank", ""), str):
+        return jsonify({"ok": False, "error": "invalid_rerank"}), 400
+    # "lexical" answers from the keyword index only (no embedding model)
+    mode = retrieval_mode(payload.get("mode"))
 
     if not question:
         return (
@@ -1402,12 +1394,38 @@ def api_book_query(stage, section, subject):
             }
         )
 
+    # near-duplicate of an already answered question on this book version,
+    # with the same retrieval mode and reranker: no retrieval or LLM call
+    cached = None
+    if mode != "lexical":
+        cached = cached_book_answer(
+            stage, section, subject, question, lang=lang, mode=mode, reranker=payload.get("rerank")
+        )
+    if cached:
+        return jsonify(
+            {
+                "ok": True,
+                "reply": cached["reply"],
+                "intent": intent,
+                "from": "cache",
+                "similarity": cached["similarity"],
+                "stage": stage,
+                "section": section,
+                "subject": subject,
+            }
+        )
+
+    rag_stats = {}
     rag_reply = run_book_rag(
         stage=stage,
         section=section,
         subject=subject,
         question=question,
         lang=lang,
+        intent=intent,
+        mode=mode,
+        stats=rag_stats,
+        reranker=payload.get("rerank"),
     )
 
     return jsonify(
@@ -1416,6 +1434,10 @@ def api_book_query(stage, section, subject):
             "reply": rag_reply,
             "intent": intent,
             "from": "rag",
+            "retrieval": mode,
+            # packed context (chunks, estimated tokens), reranker and
+            # retrieval / rerank / llm timings in ms
+            "rag": rag_stats,
             "stage": stage,
             "section": section,
             "subject": subject,
@@ -1423,15 +1445,88 @@ def api_book_query(stage, section, subject):
     )
 
 
+@app.route("/api/book/search/<stage>", methods=["POST"])
+def api_book_search_stage(stage):
+    """
+    Stage-wide retrieval over every subject book of the stage (optionally one
+    section): {"question": ..., "section": ..., "k": ..., "mode": ...} -> ranked passages.
+    """
+    stage = unquote_plus(stage)
+    payload = request.get_json(force=True, silent=True) or {}
+    question = (payload.get("question") or "").strip()
+    section_filter = (payload.get("section") or "").strip()
+    if not question:
+        return jsonify({"ok": False, "error": "missing_question"}), 400
+    if not isinstance(payload.get("mode", ""), str):
+        return jsonify({"ok": False, "error": "invalid_mode"}), 400
+    try:
+        k = max(1, min(int(payload.get("k") or RAG_TOP_K), 50))
+    except (TypeError, ValueError):
+        k = RAG_TOP_K
+
+    with collection_lock("stages", write=False):
+        sections = STAGES.get(stage, {}).get("sections", {})
+        books = [
+            (stage, sec, subj)
+            for sec, sdata in sections.items()
+            if not section_filter or sec == section_filter
+            for subj in sdata.get("subjects", DEFAULT_SUBJECTS)
+        ]
+    if not books:
+        return jsonify({"ok": False, "error": "stage_not_found"}), 404
+
+    mode = retrieval_mode(payload.get("mode"))
+    try:
+        hits, err = retrieve_top_k_for_stage(question, books, k=k, mode=mode)
+    except RuntimeError as e:
+        return jsonify({"ok": False, "error": str(e)}), 503
+    if err:
+        return jsonify({"ok": False, "error": err}), 404
+    return jsonify(
+        {
+            "ok": True,
+            "stage": stage,
+            "retrieval": mode,
+            "results": [
+                {"section": sec, "subject": subj, "index": idx, "score": round(score, 4), "text": text}
+                for idx, score, text, (_, sec, subj) in hits
+            ],
+        }
+    )
+
+
+@app.route("/api/book/jobs/<job_id>")
+def api_book_job(job_id):
+    """Status of one book ingestion job (state, step, progress, error)."""
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({"ok": False, "error": "job_not_found"}), 404
+    return jsonify({"ok": True, "job": job})
+
+
+@app.route("/api/book/jobs/<stage>/<section>/<subject>")
+def api_book_jobs_for_subject(stage, section, subject):
+    jobs = list_jobs(unquote_plus(stage), unquote_plus(section), unquote_plus(subject))
+    return jsonify({"ok": True, "jobs": jobs})
+
+
+@app.route("/api/rag/ready")
+def api_rag_ready():
+    """
+    Readiness of the book assistant: 200 once the embedding model is loaded,
+    or right away with RAG_WARMUP=0 (readiness "lazy"); 503 while it is
+    loading, failed, or warmup has not started yet.
+    """
+    status = rag_status()
+    return jsonify({"ok": status["ready"], **status}), (200 if status["ready"] else 503)
+
+
 # ------------------ START ------------------
+if RAG_WARMUP:
+    start_model_warmup()
+
 if __name__ == "__main__":
     ensure_stage_structure()
-    save_json(SETTINGS_PATH, SETTINGS)
-    save_json(ROBOTS_PATH, ROBOTS)
-    save_json(STAGES_PATH, STAGES)
-    save_json(QUIZ_PATH, QUIZZES)
-    save_json(QUIZ_STATS_PATH, QUIZ_STATS)
-    save_json(ATTENDANCE_PATH, ATTENDANCE)
-    save_json(PROGRESS_PATH, PROGRESS)
+    persist_all()
     port = int(os.environ.get("PORT", "5001"))
     app.run(host="0.0.0.0", port=port, debug=False)
\ No newline at end of file